@@ -11,6 +11,7 @@ from llama_index.core import QueryBundle
 from llama_index.core.schema import NodeWithScore
 from config import Settings
 from utils import logger, clean_for_sse_text
+from core.retriever import tokenize_query
 from pathlib import Path
 from prompts import (
     get_knowledge_assistant_context_prefix,
@@ -66,7 +67,9 @@ class KnowledgeHandler:
         # 子问题分解器（可选）
         sub_question_decomposer=None,
         # 隐藏知识库检索器（可选）
-        hidden_kb_retriever=None
+        hidden_kb_retriever=None,
+        # Embedding 模型（InsertBlock 语义缓存使用，可选）
+        embed_model=None
     ):
         # 通用知识库组件
         self.retriever = retriever
@@ -93,7 +96,7 @@ class KnowledgeHandler:
         # 如果提供了 llm_service，初始化 InsertBlock 过滤器
         if llm_service:
             from core.node_filter import InsertBlockFilter
-            self.insert_block_filter = InsertBlockFilter(llm_service)
+            self.insert_block_filter = InsertBlockFilter(llm_service, embed_model=embed_model)
         
         # 知识库功能状态（仅在调试时启用）
         # enabled_features = []
@@ -1102,8 +1105,8 @@ class KnowledgeHandler:
             
             # 7. 收集并输出全局关键字（去重后限制数量）
             # 6.1 提取问题中的关键词
-            import jieba
-            all_keywords = list(jieba.lcut(question))
+            # 复用检索阶段的查询分词缓存，避免对同一问题重复分词
+            all_keywords, _ = tokenize_query(question)
             # 过滤单字即可，保留所有多字词
             question_keywords = [kw for kw in all_keywords if len(kw) > 1]
             
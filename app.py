@@ -303,7 +303,8 @@ def create_app():
         # 子问题分解器（可选）
         sub_question_decomposer=sub_question_decomposer,
         # 隐藏知识库检索器（可选）
-        hidden_kb_retriever=hidden_kb_retriever
+        hidden_kb_retriever=hidden_kb_retriever,
+        embed_model=embed_model
     )
     
     # 5.1 初始化12367专用的知识问答处理器（使用通用知识库B）
@@ -319,7 +320,8 @@ def create_app():
             multi_kb_retriever=multi_kb_retriever,
             intent_classifier=intent_classifier,
             sub_question_decomposer=sub_question_decomposer,
-            hidden_kb_retriever=hidden_kb_retriever
+            hidden_kb_retriever=hidden_kb_retriever,
+            embed_model=embed_model
         )
         logger.info("12367专用知识问答处理器初始化完成")
     
@@ -417,12 +419,15 @@ def main():
         logger.error("应用初始化失败，无法启动服务器")
         return
 
-    # 启动服务器
-    app.run(
-        host=Settings.SERVER_HOST,
-        port=Settings.SERVER_PORT,
-        debug=Settings.SERVER_DEBUG_MODE
-    )
+    # 启动服务器（停止时释放常驻线程池）
+    try:
+        app.run(
+            host=Settings.SERVER_HOST,
+            port=Settings.SERVER_PORT,
+            debug=Settings.SERVER_DEBUG_MODE
+        )
+    finally:
+        app.knowledge_service.close()
 
 
 if __name__ == "__main__":
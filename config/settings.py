@@ -73,6 +73,9 @@ class Settings:
     # ==================== RAG 核心参数 ====================
     RETRIEVAL_TOP_K = 30
     RETRIEVAL_TOP_K_BM25 = 5  # BM25检索数量
+    HYBRID_RETRIEVE_WORKERS = int(os.getenv("HYBRID_RETRIEVE_WORKERS", 8))  # 混合检索中并行执行向量检索的线程数（所有请求共用）
+    MULTI_KB_RETRIEVE_WORKERS = int(os.getenv("MULTI_KB_RETRIEVE_WORKERS", 12))  # 多库检索中并行检索各库的线程数（所有实例和请求共用）
+    BM25_TOKEN_CACHE_DIR = os.getenv("BM25_TOKEN_CACHE_DIR", "")  # BM25 语料分词缓存目录（为空表示每次启动重新分词）
     RERANK_TOP_N = 15  # 通用问题默认返回数量（可被前端参数覆盖）
     RERANKER_INPUT_TOP_N = 30  # 送入重排序的数量（三库检索最大30条）
     RETRIEVAL_SCORE_THRESHOLD = 0.2
@@ -154,6 +157,15 @@ class Settings:
     
     # InsertBlock 精准检索配置
     INSERTBLOCK_MAX_WORKERS = 10  # 并发处理的最大线程数（默认5，提高到10可加快处理速度）
+    INSERTBLOCK_USE_ASYNC = os.getenv("INSERTBLOCK_USE_ASYNC", "false").lower() == "true"  # 使用 asyncio + acomplete 替代线程池
+    INSERTBLOCK_JSON_MODE = os.getenv("INSERTBLOCK_JSON_MODE", "false").lower() == "true"  # 请求 response_format=json_object，跳过 JSON 提取
+    INSERTBLOCK_USE_BATCH = os.getenv("INSERTBLOCK_USE_BATCH", "false").lower() == "true"  # 整批交给 LLMService.chat_batch 下发
+    INSERTBLOCK_SCORE_MIN = float(os.getenv("INSERTBLOCK_SCORE_MIN", "0"))  # 重排分数低于该值的节点不送 LLM 判定（0 表示不过滤）
+    INSERTBLOCK_CHUNKS_PER_CALL = int(os.getenv("INSERTBLOCK_CHUNKS_PER_CALL", "1"))  # 每次 LLM 调用联合判定的片段数（1 表示逐节点判定）
+    INSERTBLOCK_CACHE_DIR = os.getenv("INSERTBLOCK_CACHE_DIR", "")  # 判定结果磁盘缓存目录（为空表示仅使用内存缓存）
+    INSERTBLOCK_CACHE_TTL = int(os.getenv("INSERTBLOCK_CACHE_TTL", 7 * 24 * 3600))  # 磁盘缓存过期时间(秒)，默认7天
+    INSERTBLOCK_EARLY_STOP_K = int(os.getenv("INSERTBLOCK_EARLY_STOP_K", "0"))  # 收集到 K 个通过节点后提前终止其余判定（0 表示判定全部节点；批量模式下改走逐节点流式路径）
+    INSERTBLOCK_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("INSERTBLOCK_SEMANTIC_CACHE_THRESHOLD", "0"))  # 语义缓存问题相似度阈值（建议0.92，0 表示关闭）
     
     # 数据趋势分析配置
     DATA_ANALYSIS_MAX_LENGTH = 250  # 分析摘要最大字数（默认250字）
@@ -162,7 +174,10 @@ class Settings:
     ENABLE_QUESTION_REWRITE = os.getenv("ENABLE_QUESTION_REWRITE", "false").lower() == "true"  # 默认关闭
     
     # 双库检索策略（当判断为混合问题时）
-    DUAL_KB_STRATEGY = "adaptive"  # adaptive(自适应) 或 fixed(固定比例)
+    DUAL_KB_STRATEGY = "adaptive"  # adaptive(自适应)、fixed(固定比例) 或 rrf(按排名融合)
+    # 自适应策略的比例判定方式：threshold(最高分 0.8/1.2 经验阈值，默认) 或 zscore(按对方库分数分布的 z-score 判定)
+    DUAL_KB_ADAPTIVE_DECISION = os.getenv("DUAL_KB_ADAPTIVE_DECISION", "threshold").lower()
+    DUAL_KB_ZSCORE_THRESHOLD = float(os.getenv("DUAL_KB_ZSCORE_THRESHOLD", "1.0"))  # 一库最高分高出另一库均值的标准差倍数
     
     # ==================== 多库检索数量配置 ====================
     # 各知识库单独检索数量（可通过环境变量配置）
@@ -259,6 +274,11 @@ class Settings:
     SUBQUESTION_SYNTHESIS_TIMEOUT = int(os.getenv("SUBQUESTION_SYNTHESIS_TIMEOUT", "30"))  # 答案合成超时时间（秒）
     SUBQUESTION_ENABLE_ENTITY_CHECK = os.getenv("SUBQUESTION_ENABLE_ENTITY_CHECK", "true").lower() == "true"  # 启用命名实体检测
     SUBQUESTION_MIN_ENTITIES = int(os.getenv("SUBQUESTION_MIN_ENTITIES", "2"))  # 触发分解的最小实体数
+    SUBQUESTION_SPECULATIVE_RETRIEVAL = os.getenv("SUBQUESTION_SPECULATIVE_RETRIEVAL", "false").lower() == "true"  # 分解LLM调用期间预先执行原查询初始检索（不含重排序；回退时省一次检索耗时，分解成功时多一次检索）
+    SUBQUESTION_RETRIEVE_WORKERS = int(os.getenv("SUBQUESTION_RETRIEVE_WORKERS", "4"))  # 预检索共用线程池大小
+    SUBQUESTION_MAX_CONCURRENT_REQUESTS = int(os.getenv("SUBQUESTION_MAX_CONCURRENT_REQUESTS", "16"))  # 预期同时进行子问题分解的请求数（用于计算 LLM 线程池大小）
+    SUBQUESTION_LLM_POOL_SIZE = int(os.getenv("SUBQUESTION_LLM_POOL_SIZE", "0"))  # 分解/历史压缩/子答案/合成 LLM 调用共用线程池大小（0 表示按 并发请求数 × MAX_DEPTH 计算）
+    SUBQUESTION_CONTEXT_MAX_CHARS = int(os.getenv("SUBQUESTION_CONTEXT_MAX_CHARS", "0"))  # 子答案生成时每条参考资料的最大字符数（0 表示不截断）
     
     # 对话历史压缩配置（用于多轮场景）
     SUBQUESTION_HISTORY_COMPRESS_TURNS = int(os.getenv("SUBQUESTION_HISTORY_COMPRESS_TURNS", "5"))  # 压缩最近N轮对话
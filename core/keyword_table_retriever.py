@@ -3,13 +3,12 @@
 Keyword Table 检索器
 基于 LlamaIndex 的 KeywordTableIndex 实现关键词检索
 """
-import jieba
 from typing import List
 from llama_index.core import QueryBundle
 from llama_index.core.schema import NodeWithScore
 from llama_index.core.retrievers import BaseRetriever
 from utils.logger import logger
-from utils.keyword_ranker import keyword_ranker
+from core.retriever import tokenize_query
 
 
 class KeywordTableRetriever(BaseRetriever):
@@ -55,9 +54,8 @@ class KeywordTableRetriever(BaseRetriever):
         Returns:
             检索到的节点列表
         """
-        # 1. 对查询进行分词和停用词过滤
-        all_keywords = jieba.lcut(query_bundle.query_str)
-        filtered_keywords = keyword_ranker.filter_keywords(all_keywords)
+        # 1. 对查询进行分词和停用词过滤（与 BM25 检索共用查询分词缓存）
+        _, filtered_keywords = tokenize_query(query_bundle.query_str)
         
         
         
@@ -93,7 +91,7 @@ class KeywordTableRetriever(BaseRetriever):
                         node.node.metadata['keyword_table_keywords'] = node.node.keywords
                     else:
                         # 使用查询关键词作为匹配关键词
-                        node.node.metadata['keyword_table_keywords'] = filtered_keywords
+                        node.node.metadata['keyword_table_keywords'] = list(filtered_keywords)
                     
                     filtered_nodes.append(node)
                 else:
@@ -3,13 +3,126 @@
 多知识库检索器 V2
 支持三库检索（通用库、免签库、航司库）+ 去重逻辑
 """
-from typing import List
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from operator import attrgetter
+from typing import List, Optional
+import numpy as np
 from llama_index.core import QueryBundle
 from llama_index.core.schema import NodeWithScore
 from config import Settings
 from utils.logger import logger
 
 
+# node.node.metadata 的属性链在分类循环中反复出现，预先构建取值器
+_get_metadata = attrgetter('node.metadata')
+
+# 多库检索共用线程池：各库检索相互独立且以网络 I/O 为主，所有实例共用，避免每个实例各建一个池
+_MULTI_KB_POOL = ThreadPoolExecutor(
+    max_workers=Settings.MULTI_KB_RETRIEVE_WORKERS,
+    thread_name_prefix="multi_kb"
+)
+
+# 通过文件名判断来源库的关键词
+_VISA_FREE_KEYWORDS = ('免签', '签证', 'visa')
+_AIRLINE_KEYWORDS = ('民航', '机组', '航司', 'airline')
+
+
+def _file_names(nodes: List[NodeWithScore]) -> List[str]:
+    """一次性取出所有节点的文件名，供来源分类循环复用"""
+    return [_get_metadata(n).get('file_name') or '' for n in nodes]
+
+
+def _is_visa_free_file(file_name: str) -> bool:
+    """判断文件名是否属于免签库"""
+    return any(keyword in file_name for keyword in _VISA_FREE_KEYWORDS)
+
+
+def _is_airline_file(file_name: str) -> bool:
+    """判断文件名是否属于航司库"""
+    return any(keyword in file_name for keyword in _AIRLINE_KEYWORDS)
+
+
+def _dedup_first_seen(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+    """按 node_id 去重，保留第一次出现的节点（输入已排序时即得分最高的）"""
+    seen = {}
+    for node in nodes:
+        seen.setdefault(node.node.node_id, node)
+    return list(seen.values())
+
+
+def _score_desc(node: NodeWithScore) -> float:
+    """heapq.merge 只支持升序，取负分数实现按分数降序归并"""
+    return -node.score
+
+
+def _score_array(nodes: List[NodeWithScore]) -> np.ndarray:
+    """一次性取出节点得分数组，供分布统计复用"""
+    return np.fromiter((n.score for n in nodes), dtype=np.float64, count=len(nodes))
+
+
+def _zscore_favored(visa_nodes: List[NodeWithScore], general_nodes: List[NodeWithScore]) -> Optional[str]:
+    """
+    按分数分布判定哪个库明显更相关
+
+    z_免签 = (免签最高分 - 通用均值) / 通用标准差，z_通用 同理；
+    超过阈值且高于对方时判定该库更相关，返回 "visa" / "general"，否则返回 None。
+    与 0.8/1.2 绝对阈值不同，z-score 不依赖得分量纲，对不同检索器的分数范围同样适用。
+    """
+    if not general_nodes:
+        return "visa" if visa_nodes else None
+    if not visa_nodes:
+        return "general"
+    
+    scores_v = _score_array(visa_nodes)
+    scores_g = _score_array(general_nodes)
+    z_visa = (scores_v.max() - scores_g.mean()) / (scores_g.std() + 1e-6)
+    z_general = (scores_g.max() - scores_v.mean()) / (scores_v.std() + 1e-6)
+    
+    logger.info(f"[自适应策略] z-score | 免签: {z_visa:.3f} | 通用: {z_general:.3f}")
+    
+    threshold = Settings.DUAL_KB_ZSCORE_THRESHOLD
+    if z_visa > threshold and z_visa > z_general:
+        return "visa"
+    if z_general > threshold and z_general > z_visa:
+        return "general"
+    return None
+
+
+def _threshold_favored(visa_nodes: List[NodeWithScore], general_nodes: List[NodeWithScore]) -> Optional[str]:
+    """按最高分经验阈值（0.8 / 1.2 倍）判定哪个库明显更相关"""
+    visa_max_score = visa_nodes[0].score if visa_nodes else 0.0
+    general_max_score = general_nodes[0].score if general_nodes else 0.0
+    
+    logger.info(f"[自适应策略] 免签最高分: {visa_max_score:.4f} | 通用最高分: {general_max_score:.4f}")
+    
+    if visa_max_score > 0.8 and visa_max_score > general_max_score * 1.2:
+        return "visa"
+    if general_max_score > 0.8 and general_max_score > visa_max_score * 1.2:
+        return "general"
+    return None
+
+
+def _is_sorted_desc(nodes: List[NodeWithScore]) -> bool:
+    """检查节点列表是否已按分数降序排列"""
+    return all(nodes[i].score >= nodes[i + 1].score for i in range(len(nodes) - 1))
+
+
+def _ensure_sorted_desc(nodes: List[NodeWithScore], tag: str, source: str) -> List[NodeWithScore]:
+    """
+    确保节点列表按分数降序排列
+
+    切片与 heapq.merge 归并都依赖输入有序；检索器未排序时记录告警并回退排序，
+    已有序时原样返回，不产生额外拷贝。
+    """
+    if nodes and not _is_sorted_desc(nodes):
+        logger.warning(f"[{tag}] {source}检索结果未按分数降序排列，已重新排序")
+        return sorted(nodes, key=_score_desc)
+    return nodes
+
+
 class MultiKBRetriever:
     """
     多知识库检索器
@@ -23,6 +136,17 @@ class MultiKBRetriever:
     支持三库：通用库、免签库、航司库
     """
     
+    # 属性固定，使用 __slots__ 省去实例 __dict__（新增属性需同步加入）
+    __slots__ = (
+        'general_retriever',
+        'visa_free_retriever',
+        'airline_retriever',
+        'strategy',
+        '_visa_n',
+        '_general_n',
+        '_airline_n',
+    )
+    
     def __init__(
         self,
         general_retriever,
@@ -37,13 +161,16 @@ class MultiKBRetriever:
             general_retriever: 通用知识库检索器
             visa_free_retriever: 免签知识库检索器（可选）
             airline_retriever: 航司知识库检索器（可选）
-            strategy: 合并策略 ("adaptive" 或 "fixed")
+            strategy: 合并策略 ("adaptive"、"fixed" 或 "rrf")
         """
         self.general_retriever = general_retriever
         self.visa_free_retriever = visa_free_retriever
         self.airline_retriever = airline_retriever
         self.strategy = strategy
         
+        # 快照各库检索数量，避免每次检索都访问 Settings 类属性
+        self.reload_settings()
+        
         enabled_libs = []
         if general_retriever:
             enabled_libs.append("通用库")
@@ -54,6 +181,16 @@ class MultiKBRetriever:
         
         logger.info(f"多库检索器初始化完成 | 策略: {strategy} | 已启用: {', '.join(enabled_libs)}")
     
+    def reload_settings(self) -> None:
+        """
+        重新读取各库检索数量配置
+        
+        检索数量在初始化时快照为实例属性；运行期修改 Settings 后需调用此方法生效。
+        """
+        self._visa_n = Settings.VISA_FREE_RETRIEVAL_COUNT
+        self._general_n = Settings.GENERAL_RETRIEVAL_COUNT
+        self._airline_n = Settings.AIRLINE_RETRIEVAL_COUNT
+    
     def retrieve_from_both(
         self,
         query: str,
@@ -71,13 +208,11 @@ class MultiKBRetriever:
         Returns:
             合并后的节点列表（按分数排序，已去重）
         """
-        from llama_index.core import QueryBundle
-        
-        # 使用配置的默认值
+        # 未指定数量时使用配置的默认值（reload_settings 快照的实例属性）
         if visa_count is None:
-            visa_count = Settings.VISA_FREE_RETRIEVAL_COUNT
+            visa_count = self._visa_n
         if general_count is None:
-            general_count = Settings.GENERAL_RETRIEVAL_COUNT
+            general_count = self._general_n
         
         logger.info(f"[双库检索] 查询: {query[:50]}...")
         logger.info(f"[双库检索] 策略: {self.strategy} | 免签:{visa_count}条 | 通用:{general_count}条")
@@ -93,9 +228,8 @@ class MultiKBRetriever:
         else:
             visa_free_nodes = self.visa_free_retriever.retrieve(query_bundle)
             logger.info(f"[双库检索] 免签库检索完成 | 返回 {len(visa_free_nodes)} 条")
-            if visa_free_nodes:
-                visa_scores = [n.score for n in visa_free_nodes[:5]]
-                logger.info(f"[双库检索] 免签库Top5得分: {[f'{s:.4f}' for s in visa_scores]}")
+            if visa_free_nodes and logger.isEnabledFor(logging.INFO):
+                logger.info("[双库检索] 免签库Top5得分: %s", [f'{n.score:.4f}' for n in visa_free_nodes[:5]])
         
         # 2. 独立检索通用库
         logger.info("[双库检索] 步骤2: 检索通用知识库...")
@@ -105,24 +239,26 @@ class MultiKBRetriever:
         else:
             general_nodes = self.general_retriever.retrieve(query_bundle)
             logger.info(f"[双库检索] 通用库检索完成 | 返回 {len(general_nodes)} 条")
-            if general_nodes:
-                general_scores = [n.score for n in general_nodes[:5]]
-                logger.info(f"[双库检索] 通用库Top5得分: {[f'{s:.4f}' for s in general_scores]}")
+            if general_nodes and logger.isEnabledFor(logging.INFO):
+                logger.info("[双库检索] 通用库Top5得分: %s", [f'{n.score:.4f}' for n in general_nodes[:5]])
         
         # 3. 根据策略合并
         if self.strategy == "adaptive":
             merged = self._adaptive_merge(
                 visa_free_nodes, general_nodes, visa_count, general_count
             )
+        elif self.strategy == "rrf":
+            merged = self._rrf_merge(
+                visa_free_nodes, general_nodes, visa_count, general_count
+            )
         else:  # fixed
             merged = self._fixed_merge(
                 visa_free_nodes, general_nodes, visa_count, general_count
             )
         
         logger.info(f"[双库检索] 合并完成 | 最终返回 {len(merged)} 条")
-        if merged:
-            final_scores = [n.score for n in merged[:5]]
-            logger.info(f"[双库检索] 最终Top5得分: {[f'{s:.4f}' for s in final_scores]}")
+        if merged and logger.isEnabledFor(logging.INFO):
+            logger.info("[双库检索] 最终Top5得分: %s", [f'{n.score:.4f}' for n in merged[:5]])
         
         return merged
     
@@ -135,23 +271,26 @@ class MultiKBRetriever:
     ) -> List[NodeWithScore]:
         """
         自适应合并策略：根据得分动态调整比例
+        
+        判定方式由 Settings.DUAL_KB_ADAPTIVE_DECISION 控制：
+        - threshold：比较两库最高分（0.8 / 1.2 经验阈值）
+        - zscore：比较一库最高分相对另一库分数分布的 z-score
         """
         if not visa_nodes and not general_nodes:
             return []
         
-        # 比较最高分
-        visa_max_score = visa_nodes[0].score if visa_nodes else 0.0
-        general_max_score = general_nodes[0].score if general_nodes else 0.0
-        
-        logger.info(f"[自适应策略] 免签最高分: {visa_max_score:.4f} | 通用最高分: {general_max_score:.4f}")
+        if Settings.DUAL_KB_ADAPTIVE_DECISION == "zscore":
+            favored = _zscore_favored(visa_nodes, general_nodes)
+        else:
+            favored = _threshold_favored(visa_nodes, general_nodes)
         
-        # 根据得分调整比例
-        if visa_max_score > 0.8 and visa_max_score > general_max_score * 1.2:
+        # 根据判定结果调整比例
+        if favored == "visa":
             # 免签库得分明显更高
             visa_count = int(visa_count * 1.4)  # 70%
             general_count = int(general_count * 0.6)  # 30%
             logger.info(f"[自适应策略] 免签库得分更高，调整比例 -> 免签:{visa_count} | 通用:{general_count}")
-        elif general_max_score > 0.8 and general_max_score > visa_max_score * 1.2:
+        elif favored == "general":
             # 通用库得分明显更高
             general_count = int(general_count * 1.4)  # 70%
             visa_count = int(visa_count * 0.6)  # 30%
@@ -161,12 +300,63 @@ class MultiKBRetriever:
         
         return self._fixed_merge(visa_nodes, general_nodes, visa_count, general_count)
     
-    def _fixed_merge(
+    def _rrf_merge(
         self,
         visa_nodes: List[NodeWithScore],
         general_nodes: List[NodeWithScore],
         visa_count: int,
         general_count: int
+    ) -> List[NodeWithScore]:
+        """
+        RRF 融合策略：按各库内排名计算 1/(k+rank) 并累加后排序
+        
+        说明：
+        - 只依赖排名，不受两库得分量纲差异影响（无需 0.8/1.2 经验阈值）
+        - 仅用于决定顺序，返回节点保留原始得分
+        """
+        if not visa_nodes and not general_nodes:
+            return []
+        
+        rrf_k = Settings.RRF_K
+        slot_of = {}  # node_id -> 去重后的位置
+        best = []     # 每个位置上得分最高的节点实例
+        fused = []    # 各库的 (位置数组, RRF 分数数组)
+        for nodes in (visa_nodes, general_nodes):
+            if not nodes:
+                continue
+            # node_id 到位置的映射只能逐个查表，RRF 计算与累加交给数组运算
+            slots = np.empty(len(nodes), dtype=np.intp)
+            for i, node in enumerate(nodes):
+                slot = slot_of.setdefault(node.node.node_id, len(best))
+                if slot == len(best):
+                    best.append(node)
+                elif node.score > best[slot].score:
+                    best[slot] = node
+                slots[i] = slot
+            fused.append((slots, 1.0 / (rrf_k + np.arange(1, len(nodes) + 1, dtype=np.float64))))
+        
+        rrf_scores = np.zeros(len(best), dtype=np.float64)
+        for slots, scores in fused:
+            np.add.at(rrf_scores, slots, scores)
+        
+        # 稳定排序，RRF 分数相同时保持首次出现的顺序
+        order = np.argsort(-rrf_scores, kind="stable")[:visa_count + general_count]
+        merged = [best[i] for i in order.tolist()]
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                f"[RRF策略] 合并完成 | 免签库:{len(visa_nodes)}条 + 通用库:{len(general_nodes)}条 | "
+                f"去重后:{len(best)}条 -> 返回{len(merged)}条 (k={rrf_k})"
+            )
+        
+        return merged
+    
+    def _fixed_merge(
+        self,
+        visa_nodes: List[NodeWithScore],
+        general_nodes: List[NodeWithScore],
+        visa_count: int = None,
+        general_count: int = None
     ) -> List[NodeWithScore]:
         """
         固定比例合并策略 + 去重
@@ -175,7 +365,18 @@ class MultiKBRetriever:
         - 前N条：免签库最高分
         - 中N条：通用库最高分
         - 后N条：从剩余文档中综合比较
+        
+        未指定数量时直接读取 reload_settings 快照的 _visa_n / _general_n。
         """
+        if visa_count is None:
+            visa_count = self._visa_n
+        if general_count is None:
+            general_count = self._general_n
+        
+        # 后续切片与归并都依赖输入按分数降序；检索器未排序时记录告警并回退排序
+        visa_nodes = _ensure_sorted_desc(visa_nodes, "固定策略", "免签库")
+        general_nodes = _ensure_sorted_desc(general_nodes, "固定策略", "通用库")
+        
         # 1. 前N条：免签库最高分
         visa_top = visa_nodes[:visa_count] if visa_nodes else []
         
@@ -186,35 +387,36 @@ class MultiKBRetriever:
         visa_remaining = visa_nodes[visa_count:] if len(visa_nodes) > visa_count else []
         general_remaining = general_nodes[general_count:] if len(general_nodes) > general_count else []
         
-        remaining_all = visa_remaining + general_remaining
-        remaining_all.sort(key=lambda x: x.score, reverse=True)
-        remaining_top = remaining_all[:visa_count]  # 后N条
+        # 两路剩余部分各自有序，归并后只取前N条（后N条）
+        remaining_top = list(islice(
+            heapq.merge(visa_remaining, general_remaining, key=_score_desc), visa_count
+        ))
         
-        # 4. 合并所有结果
-        merged_results = visa_top + general_top + remaining_top
+        # 4. 合并所有结果（三路输入均已按分数降序，直接归并即可保持有序）
+        merged_results = list(heapq.merge(visa_top, general_top, remaining_top, key=_score_desc))
         
-        # 5. 去重（按node_id）⭐
-        seen_ids = set()
-        unique_results = []
+        # 5. 去重（按node_id，同一节点保留得分最高的实例）⭐
+        best = {}
         for node in merged_results:
             node_id = node.node.node_id
-            if node_id not in seen_ids:
-                seen_ids.add(node_id)
-                unique_results.append(node)
-        
-        # 6. 按分数重新排序
-        unique_results.sort(key=lambda x: x.score, reverse=True)
+            prev = best.get(node_id)
+            if prev is None or node.score > prev.score:
+                best[node_id] = node
+        unique_results = list(best.values())
         
-        # 统计来源分布
-        visa_count_final = sum(1 for n in unique_results if self._is_visa_free_node(n))
-        general_count_final = len(unique_results) - visa_count_final
+        # 6. merged_results 已有序，去重保持原顺序，无需再次排序
         
-        logger.info(
-            f"[固定策略] 合并完成 | "
-            f"免签库:{len(visa_top)}条 + 通用库:{len(general_top)}条 + 综合:{len(remaining_top)}条 | "
-            f"去重前:{len(merged_results)}条 去重后:{len(unique_results)}条 "
-            f"(免签{visa_count_final} + 通用{general_count_final})"
-        )
+        # 统计来源分布（仅用于日志，INFO 未启用时跳过）
+        if logger.isEnabledFor(logging.INFO):
+            visa_count_final = sum(1 for f in _file_names(unique_results) if _is_visa_free_file(f))
+            general_count_final = len(unique_results) - visa_count_final
+            
+            logger.info(
+                f"[固定策略] 合并完成 | "
+                f"免签库:{len(visa_top)}条 + 通用库:{len(general_top)}条 + 综合:{len(remaining_top)}条 | "
+                f"去重前:{len(merged_results)}条 去重后:{len(unique_results)}条 "
+                f"(免签{visa_count_final} + 通用{general_count_final})"
+            )
         
         return unique_results
     
@@ -227,8 +429,6 @@ class MultiKBRetriever:
         - 中5条：通用库最高分（保底）
         - 后5条：从剩余文档中综合比较
         """
-        from llama_index.core import QueryBundle
-        
         if not self.airline_retriever:
             logger.warning("[航司检索] 航司检索器未初始化")
             return []
@@ -249,9 +449,13 @@ class MultiKBRetriever:
             general_nodes = self.general_retriever.retrieve(query_bundle)
             logger.info(f"[航司检索] 通用库返回 {len(general_nodes)} 条（保底）")
         
+        # 后续切片与归并都依赖输入按分数降序；检索器未排序时记录告警并回退排序
+        airline_nodes = _ensure_sorted_desc(airline_nodes, "航司检索", "航司库")
+        general_nodes = _ensure_sorted_desc(general_nodes, "航司检索", "通用库")
+        
         # 3. 合并策略：航司5条 + 通用5条 + 综合5条 = 15条
-        airline_count = Settings.AIRLINE_RETRIEVAL_COUNT
-        general_count = Settings.GENERAL_RETRIEVAL_COUNT
+        airline_count = self._airline_n
+        general_count = self._general_n
         
         airline_top = airline_nodes[:airline_count]
         general_top = general_nodes[:general_count]
@@ -259,33 +463,27 @@ class MultiKBRetriever:
         # 4. 从剩余文档中再取一些
         airline_remaining = airline_nodes[airline_count:]
         general_remaining = general_nodes[general_count:]
-        remaining_all = airline_remaining + general_remaining
-        remaining_all.sort(key=lambda x: x.score, reverse=True)
-        remaining_top = remaining_all[:airline_count]
+        remaining_top = list(islice(
+            heapq.merge(airline_remaining, general_remaining, key=_score_desc), airline_count
+        ))
         
-        # 5. 合并并去重（按node_id）⭐
-        merged = airline_top + general_top + remaining_top
+        # 5. 合并并去重（按node_id）⭐ 各段均已有序，归并后整体有序
+        merged = list(heapq.merge(airline_top, general_top, remaining_top, key=_score_desc))
         
         # 去重：保留第一次出现的节点（得分最高的）
-        seen_ids = set()
-        unique_merged = []
-        for node in merged:
-            node_id = node.node.node_id
-            if node_id not in seen_ids:
-                seen_ids.add(node_id)
-                unique_merged.append(node)
+        unique_merged = _dedup_first_seen(merged)
         
-        # 6. 按分数排序
-        unique_merged.sort(key=lambda x: x.score, reverse=True)
+        # 6. merged 已有序，去重保持原顺序，无需再次排序
         
-        # 统计来源分布
-        airline_final = sum(1 for n in unique_merged if self._is_airline_node(n))
-        general_final = len(unique_merged) - airline_final
-        
-        logger.info(
-            f"[航司检索] 合并完成 | 去重前:{len(merged)}条 去重后:{len(unique_merged)}条 "
-            f"(航司{airline_final}条 + 通用{general_final}条)"
-        )
+        # 统计来源分布（仅用于日志，INFO 未启用时跳过）
+        if logger.isEnabledFor(logging.INFO):
+            airline_final = sum(1 for f in _file_names(unique_merged) if _is_airline_file(f))
+            general_final = len(unique_merged) - airline_final
+            
+            logger.info(
+                f"[航司检索] 合并完成 | 去重前:{len(merged)}条 去重后:{len(unique_merged)}条 "
+                f"(航司{airline_final}条 + 通用{general_final}条)"
+            )
         
         return unique_merged
     
@@ -303,8 +501,6 @@ class MultiKBRetriever:
         Returns:
             去重后的节点列表（按分数排序，最多30条）
         """
-        from llama_index.core import QueryBundle
-        
         logger.info(f"[三库检索] 查询: {query[:50]}...")
         logger.info("[三库检索] 策略: 航司库 + 免签库 + 通用库（全覆盖）")
         
@@ -338,34 +534,28 @@ class MultiKBRetriever:
         logger.info(f"[三库检索] 按得分排序后取前30条")
         
         # 5. 去重（按node_id）⭐ 关键：避免重复
-        seen_ids = set()
-        unique_merged = []
-        for node in merged:
-            node_id = node.node.node_id
-            if node_id not in seen_ids:
-                seen_ids.add(node_id)
-                unique_merged.append(node)
-        
-        # 6. 按分数排序
-        unique_merged.sort(key=lambda x: x.score, reverse=True)
-        
-        # 统计来源分布（互斥优先级：航司 > 免签 > 通用）
-        airline_final = 0
-        visa_final = 0
-        general_final = 0
-        
-        for node in unique_merged:
-            if self._is_airline_node(node):
-                airline_final += 1
-            elif self._is_visa_free_node(node):
-                visa_final += 1
-            else:
-                general_final += 1
+        unique_merged = _dedup_first_seen(merged)
         
-        logger.info(
-            f"[三库检索] 合并完成 | 去重前:{len(merged)}条 去重后:{len(unique_merged)}条 | "
-            f"航司{airline_final}条 + 免签{visa_final}条 + 通用{general_final}条"
-        )
+        # 6. merged 取自已排序的 all_nodes，去重保持原顺序，无需再次排序
+        
+        # 统计来源分布（互斥优先级：航司 > 免签 > 通用，仅用于日志）
+        if logger.isEnabledFor(logging.INFO):
+            airline_final = 0
+            visa_final = 0
+            general_final = 0
+            
+            for file_name in _file_names(unique_merged):
+                if _is_airline_file(file_name):
+                    airline_final += 1
+                elif _is_visa_free_file(file_name):
+                    visa_final += 1
+                else:
+                    general_final += 1
+            
+            logger.info(
+                f"[三库检索] 合并完成 | 去重前:{len(merged)}条 去重后:{len(unique_merged)}条 | "
+                f"航司{airline_final}条 + 免签{visa_final}条 + 通用{general_final}条"
+            )
         
         return unique_merged
     
@@ -386,50 +576,41 @@ class MultiKBRetriever:
         Returns:
             (专业库节点列表, 通用库节点列表) - 两个列表分别对应不同的检索结果
         """
-        from llama_index.core import QueryBundle
-        
         logger.info(f"[双问题检索] 策略: {strategy}")
         logger.info(f"[双问题检索] 原问题: {original_query[:50]}...")
         logger.info(f"==================================================")
         logger.info(f"[双问题检索] 改写问题: {rewritten_query}")
         logger.info(f"==================================================")
         
-        # 1. 用原问题检索通用库
+        # 1. 构建检索任务：原问题 -> 通用库，改写问题 -> 专业库（免签/航司）
         general_query_bundle = QueryBundle(query_str=original_query)
-        general_nodes = []
-        if self.general_retriever:
-            general_nodes = self.general_retriever.retrieve(general_query_bundle)
-            logger.info(f"[双问题检索] 通用库（原问题）返回 {len(general_nodes)} 条")
-        
-        # 2. 用改写问题检索专业库（免签/航司）
         rewritten_query_bundle = QueryBundle(query_str=rewritten_query)
         
-        airline_nodes = []
-        visa_nodes = []
-        
-        if strategy in ["airline_visa_free", "airline"]:
-            # 检索航司库
-            if self.airline_retriever:
-                airline_nodes = self.airline_retriever.retrieve(rewritten_query_bundle)
-                logger.info(f"[双问题检索] 航司库（改写问题）返回 {len(airline_nodes)} 条")
-        
-        if strategy in ["airline_visa_free", "visa_free", "both"]:
-            # 检索免签库
-            if self.visa_free_retriever:
-                visa_nodes = self.visa_free_retriever.retrieve(rewritten_query_bundle)
-                logger.info(f"[双问题检索] 免签库（改写问题）返回 {len(visa_nodes)} 条")
+        futures = {}
+        if self.general_retriever:
+            futures["general"] = _MULTI_KB_POOL.submit(self.general_retriever.retrieve, general_query_bundle)
+        if strategy in ["airline_visa_free", "airline"] and self.airline_retriever:
+            futures["airline"] = _MULTI_KB_POOL.submit(self.airline_retriever.retrieve, rewritten_query_bundle)
+        if strategy in ["airline_visa_free", "visa_free", "both"] and self.visa_free_retriever:
+            futures["visa"] = _MULTI_KB_POOL.submit(self.visa_free_retriever.retrieve, rewritten_query_bundle)
+        
+        # 2. 三路检索并发执行，一次等待全部完成
+        general_nodes = futures["general"].result() if "general" in futures else []
+        airline_nodes = futures["airline"].result() if "airline" in futures else []
+        visa_nodes = futures["visa"].result() if "visa" in futures else []
+        
+        if "general" in futures:
+            logger.info(f"[双问题检索] 通用库（原问题）返回 {len(general_nodes)} 条")
+        if "airline" in futures:
+            logger.info(f"[双问题检索] 航司库（改写问题）返回 {len(airline_nodes)} 条")
+        if "visa" in futures:
+            logger.info(f"[双问题检索] 免签库（改写问题）返回 {len(visa_nodes)} 条")
         
         # 3. 合并专业库结果（航司 + 免签）
         specialized_nodes = airline_nodes + visa_nodes
         
         # 去重专业库节点
-        seen_ids = set()
-        unique_specialized = []
-        for node in specialized_nodes:
-            node_id = node.node.node_id
-            if node_id not in seen_ids:
-                seen_ids.add(node_id)
-                unique_specialized.append(node)
+        unique_specialized = _dedup_first_seen(specialized_nodes)
         
         # 按分数排序
         unique_specialized.sort(key=lambda x: x.score, reverse=True)
@@ -444,15 +625,13 @@ class MultiKBRetriever:
     
     def _is_visa_free_node(self, node: NodeWithScore) -> bool:
         """判断节点是否来自免签库（通过文件名判断）"""
-        file_name = node.node.metadata.get('file_name', '')
         # 简单判断：包含"免签"、"签证"等关键词
-        return any(keyword in file_name for keyword in ['免签', '签证', 'visa'])
+        return _is_visa_free_file(_get_metadata(node).get('file_name') or '')
     
     def _is_airline_node(self, node: NodeWithScore) -> bool:
         """判断节点是否来自航司库（通过文件名判断）"""
-        file_name = node.node.metadata.get('file_name', '')
         # 简单判断：包含"民航"、"机组"等关键词
-        return any(keyword in file_name for keyword in ['民航', '机组', '航司', 'airline'])
+        return _is_airline_file(_get_metadata(node).get('file_name') or '')
     
     def retrieve(self, query: str) -> List[NodeWithScore]:
         """
@@ -481,5 +660,28 @@ class MultiKBRetriever:
         else:
             # 只有通用库，直接返回通用库结果
             logger.debug(f"[多库检索] 仅使用通用库")
-            from llama_index.core import QueryBundle
             return self.general_retriever.retrieve(QueryBundle(query_str=query))
+    
+    def retrieve_batch(self, queries: List[str], concurrency: int = 16) -> List[List[NodeWithScore]]:
+        """
+        批量检索接口（批量评测等场景）
+        
+        各查询的检索 I/O 并发执行，并发数受 concurrency 限制，
+        避免同时向向量库发起过多请求。
+        
+        Args:
+            queries: 查询文本列表
+            concurrency: 最大并发查询数
+            
+        Returns:
+            与 queries 顺序一致的检索结果列表
+        """
+        if not queries:
+            return []
+        
+        logger.info(f"[批量检索] 查询数: {len(queries)} | 并发数: {concurrency}")
+        with ThreadPoolExecutor(
+            max_workers=min(concurrency, len(queries)),
+            thread_name_prefix="multi_kb_batch"
+        ) as executor:
+            return list(executor.map(self.retrieve, queries))
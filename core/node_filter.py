@@ -3,14 +3,435 @@
 节点过滤器
 用于对检索到的节点进行智能过滤和提取
 """
+import asyncio
+import hashlib
 import json
+import logging
+import os
+import random
+import sqlite3
+import threading
 import time
-from typing import List, Dict, Any, Optional, Callable
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Callable, Tuple, Iterator, AsyncIterator
 from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+import httpx
+import numpy as np
+from llama_index.core.llms import ChatMessage
 from utils import logger
-from prompts import get_insertblock_system_all, get_insertblock_user_all
+from prompts import (
+    get_insertblock_system_all,
+    get_insertblock_user_all,
+    get_insertblock_batch_system_all,
+    get_insertblock_batch_user_all,
+    get_insertblock_batch_regulation,
+)
 from config import Settings
 
+try:
+    from openai import APIConnectionError as _APIConnectionError, APITimeoutError as _APITimeoutError
+except ImportError:
+    _APIConnectionError = _APITimeoutError = TimeoutError
+
+# LLM 请求超时（由 HTTP 客户端按请求超时抛出）
+_LLM_TIMEOUT_ERRORS = (_APITimeoutError, httpx.TimeoutException, TimeoutError)
+
+# 可重试的传输层错误（超时、连接失败/中断）；其余异常只有 429 / 5xx 状态码才重试
+_LLM_TRANSIENT_ERRORS = _LLM_TIMEOUT_ERRORS + (_APIConnectionError, httpx.TransportError)
+
+# 重试退避：指数增长 + 随机抖动，避免所有线程同时重试
+_RETRY_BACKOFF_BASE = 0.5
+_RETRY_BACKOFF_MAX = 8.0
+
+try:
+    # orjson 为可选依赖（C 实现，解析更快），未安装时回退到标准库
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 多片段联合判定时每个片段预留的输出 token 数
+_BATCH_TOKENS_PER_CHUNK = 400
+
+# JSON 模式：要求 OpenAI 兼容服务端直接返回 JSON 对象
+_JSON_MODE_KWARGS = {"response_format": {"type": "json_object"}}
+
+# LLM 判定结果缓存（进程内 LRU）：相同问题 + 相同法规文本的判定结果可直接复用
+_RESPONSE_CACHE_MAX_SIZE = 4096
+_RESPONSE_FIELDS = ("is_relevant", "can_answer", "reasoning", "answer", "key_passage")
+_response_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+# 磁盘响应缓存（sqlite，跨进程重启/重建索引复用判定结果；INSERTBLOCK_CACHE_DIR 为空时不启用）
+_DISK_CACHE_FILE = "insertblock_responses.sqlite3"
+_disk_cache_conn: Optional[sqlite3.Connection] = None
+_disk_cache_failed = False
+_disk_cache_prefix = ""  # 提示词模板指纹，模板变更后旧判定自动失效
+_disk_cache_lock = threading.Lock()
+
+# _prepare_prompt_parts 的结果：(system 片段, user 片段)，每个片段为 (是否需要逐节点 format, 内容)
+_PromptParts = Tuple[Tuple[Tuple[bool, str], ...], Tuple[Tuple[bool, str], ...]]
+
+# 语义缓存：同一法规文本下，问题向量余弦相似度达到阈值即复用判定结果（应对同义改写的问题）
+_SEMANTIC_CACHE_MAX_CONTEXTS = 2048
+_SEMANTIC_CACHE_MAX_PER_CONTEXT = 8
+_semantic_cache: "OrderedDict[str, List[Tuple[np.ndarray, Dict[str, Any]]]]" = OrderedDict()
+_semantic_cache_lock = threading.Lock()
+
+
+@dataclass(slots=True)
+class FilterResult:
+    """
+    单个节点的 InsertBlock 判定结果
+
+    使用 slots 避免每个结果携带 __dict__；同时保留 result['key'] / result.get('key')
+    的字典式访问，调用方无需改动。
+    """
+    node: Any
+    file_name: str
+    is_relevant: bool
+    can_answer: bool
+    reasoning: str
+    answer: str
+    key_passage: Optional[str]
+    initial_score: float
+    reranked_score: float
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为普通字典（不深拷贝 node）"""
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+def _is_retryable(error: Exception) -> bool:
+    """
+    白名单判定是否值得退避重试：超时、连接错误、429 和 5xx
+
+    其余异常（4xx、解析错误、编程错误等）重试也不会成功，直接放弃。
+    """
+    if isinstance(error, _LLM_TRANSIENT_ERRORS):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+def _retry_delay(attempt: int) -> float:
+    """第 attempt 次重试前的等待时间（full jitter 指数退避）"""
+    return random.uniform(0, min(_RETRY_BACKOFF_MAX, _RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+@lru_cache(maxsize=1)
+def _classified_templates() -> Tuple[Tuple[Tuple[bool, bool, str], ...], ...]:
+    """InsertBlock 模板按占位符分类为 (含 {regulations}, 含 {question}, 模板)，进程内只需分类一次"""
+    def classify(templates: List[str]) -> Tuple[Tuple[bool, bool, str], ...]:
+        return tuple(("{regulations}" in template, "{question}" in template, template) for template in templates)
+
+    return classify(get_insertblock_system_all()), classify(get_insertblock_user_all())
+
+
+@lru_cache(maxsize=64)
+def _chat_layout(prompt_parts: _PromptParts) -> Tuple[str, str]:
+    """拼出 (system 提示词, user 模板)，同一问题的所有节点共用，逐节点只需 format 一次"""
+    system_parts, user_parts = prompt_parts
+    system_prompt = "\n\n".join((
+        "\n".join(text for needs_format, text in system_parts if not needs_format),
+        "\n".join(text for needs_format, text in user_parts if not needs_format)
+    ))
+    user_template = "\n".join(
+        text for needs_format, text in (*system_parts, *user_parts) if needs_format
+    )
+    return system_prompt, user_template
+
+
+def _longest_first(item: Tuple[Any, str, str, float, float]) -> int:
+    """按法规文本长度降序排序的 key（LLM 耗时与输入长度正相关）"""
+    return -len(item[2])
+
+
+def _longest_first_group(entry: Tuple[str, List[Tuple[Any, str, str, float, float]]]) -> int:
+    """pending 项 (缓存键, 节点信息列表) 的最长优先排序 key"""
+    return -len(entry[1][0][2])
+
+
+def _highest_score_first_group(entry: Tuple[str, List[Tuple[Any, str, str, float, float]]]) -> float:
+    """pending 项按组内最高重排分数降序排序的 key（提前终止时优先判定最可能通过的节点）"""
+    return -max(item[4] for item in entry[1])
+
+
+def _response_cache_key(llm_id: Optional[str], question: str, regulations: str) -> str:
+    """计算 (模型, 问题, 法规文本) 的缓存键"""
+    raw = f"{llm_id or 'default'}\x00{question}\x00{regulations}".encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _disk_cache() -> Optional[sqlite3.Connection]:
+    """懒加载磁盘响应缓存；未配置或打开失败时返回 None（调用方需持有 _disk_cache_lock）"""
+    global _disk_cache_conn, _disk_cache_failed, _disk_cache_prefix
+    if _disk_cache_conn is not None or _disk_cache_failed or not Settings.INSERTBLOCK_CACHE_DIR:
+        return _disk_cache_conn
+
+    try:
+        os.makedirs(Settings.INSERTBLOCK_CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(
+            os.path.join(Settings.INSERTBLOCK_CACHE_DIR, _DISK_CACHE_FILE),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+    except (OSError, sqlite3.Error) as e:
+        _disk_cache_failed = True
+        logger.warning(f"InsertBlock 磁盘缓存不可用，仅使用内存缓存: {e}")
+        return None
+
+    templates = "\x00".join(get_insertblock_system_all() + get_insertblock_user_all())
+    _disk_cache_prefix = hashlib.blake2b(templates.encode("utf-8"), digest_size=8).hexdigest() + ":"
+    _disk_cache_conn = conn
+    logger.info(f"InsertBlock 磁盘缓存已启用: {Settings.INSERTBLOCK_CACHE_DIR}")
+    return conn
+
+
+def _disk_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with _disk_cache_lock:
+        conn = _disk_cache()
+        if conn is None:
+            return None
+        try:
+            row = conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND expires_at >= ?",
+                (_disk_cache_prefix + key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"InsertBlock 磁盘缓存读取失败: {e}")
+            return None
+    return _json_loads(row[0]) if row else None
+
+
+def _disk_cache_put(key: str, verdict: Dict[str, Any]) -> None:
+    with _disk_cache_lock:
+        conn = _disk_cache()
+        if conn is None:
+            return
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (
+                    _disk_cache_prefix + key,
+                    json.dumps(verdict, ensure_ascii=False),
+                    time.time() + Settings.INSERTBLOCK_CACHE_TTL
+                )
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"InsertBlock 磁盘缓存写入失败: {e}")
+
+
+def _memory_cache_put(key: str, verdict: Dict[str, Any]) -> None:
+    with _response_cache_lock:
+        _response_cache[key] = verdict
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _RESPONSE_CACHE_MAX_SIZE:
+            _response_cache.popitem(last=False)
+
+
+def _semantic_cache_get(context_key: str, q_emb: np.ndarray, threshold: float) -> Optional[Dict[str, Any]]:
+    """在同一法规上下文的历史问题中查找余弦相似度最高且不低于阈值的判定结果"""
+    with _semantic_cache_lock:
+        entries = _semantic_cache.get(context_key)
+        if not entries:
+            return None
+        _semantic_cache.move_to_end(context_key)
+        entries = list(entries)
+
+    similarities = np.stack([emb for emb, _ in entries]) @ q_emb
+    best = int(np.argmax(similarities))
+    return entries[best][1] if similarities[best] >= threshold else None
+
+
+def _semantic_cache_put(context_key: str, q_emb: np.ndarray, verdict: Dict[str, Any]) -> None:
+    with _semantic_cache_lock:
+        entries = _semantic_cache.setdefault(context_key, [])
+        entries.append((q_emb, verdict))
+        if len(entries) > _SEMANTIC_CACHE_MAX_PER_CONTEXT:
+            del entries[0]
+        _semantic_cache.move_to_end(context_key)
+        while len(_semantic_cache) > _SEMANTIC_CACHE_MAX_CONTEXTS:
+            _semantic_cache.popitem(last=False)
+
+
+def _response_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    """先查内存 LRU，未命中再查磁盘缓存（命中后回填内存）"""
+    with _response_cache_lock:
+        cached = _response_cache.get(key)
+        if cached is not None:
+            _response_cache.move_to_end(key)
+            return cached
+
+    cached = _disk_cache_get(key)
+    if cached is not None:
+        _memory_cache_put(key, cached)
+    return cached
+
+
+def _response_cache_put(key: str, result: "FilterResult") -> None:
+    verdict = {field: result.get(field) for field in _RESPONSE_FIELDS}
+    _memory_cache_put(key, verdict)
+    _disk_cache_put(key, verdict)
+
+
+_ASYNC_DONE = object()  # _anext 的结束标记
+
+
+async def _anext(agen: AsyncIterator[Any]) -> Any:
+    """取异步生成器的下一项（包装为协程，可交给 run_coroutine_threadsafe），结束时返回 _ASYNC_DONE"""
+    try:
+        return await agen.__anext__()
+    except StopAsyncIteration:
+        return _ASYNC_DONE
+
+
+class _FilterRun:
+    """
+    一次过滤调用的结果登记：进度回调、按文件统计、失败计数、关键错误判定与统计日志
+
+    线程池 / asyncio / 批量 / 联合判定四条执行路径共用，统计口径与失败阈值保持一致。
+    """
+
+    __slots__ = (
+        'nodes', 'progress_callback', 'max_workers', 'timeout', 'start_time',
+        'filtered_results', 'rejected_nodes', 'file_stats', 'passed_stats',
+        'processed_count', 'timeout_count', 'error_count',
+    )
+
+    def __init__(
+        self,
+        nodes: List[Any],
+        progress_callback: Optional[Callable[[int, int], None]],
+        max_workers: int,
+        timeout: int
+    ):
+        self.nodes = nodes
+        self.progress_callback = progress_callback
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.start_time = time.time()
+        self.filtered_results: List[FilterResult] = []
+        self.rejected_nodes: List[FilterResult] = []  # 记录被拒绝的节点
+        self.file_stats = defaultdict(int)  # 统计每个文件的节点数
+        self.passed_stats = defaultdict(int)  # 统计每个文件通过的节点数
+        self.processed_count = 0  # 已处理节点数
+        self.timeout_count = 0  # 超时节点数
+        self.error_count = 0  # 错误节点数
+
+    def _report_progress(self) -> None:
+        self.processed_count += 1
+        if self.progress_callback:
+            try:
+                self.progress_callback(self.processed_count, len(self.nodes))
+            except Exception as cb_error:
+                logger.warning(f"进度回调失败: {cb_error}")
+
+    def record(self, result: FilterResult) -> bool:
+        """登记一个节点的判定结果，返回是否通过筛选"""
+        self._report_progress()
+        file_name = result.file_name
+        self.file_stats[file_name] += 1
+        if result.can_answer:
+            self.filtered_results.append(result)
+            self.passed_stats[file_name] += 1
+        else:
+            self.rejected_nodes.append(result)
+        self._log_verdict(result, self.file_stats[file_name])
+        return result.can_answer
+
+    def record_all(self, results) -> Iterator[FilterResult]:
+        """逐个登记判定结果，产出其中通过筛选的"""
+        for result in results:
+            if self.record(result):
+                yield result
+
+    def fail(self, group: List[Tuple[Any, str, str, float, float]], error: Optional[BaseException] = None) -> None:
+        """登记一个法规文本分组未获得判定（超时、调用失败，error 为 None 表示模型未给出可解析的结果）"""
+        timed_out = isinstance(error, (asyncio.TimeoutError, TimeoutError))
+        for _, file_name, *_ in group:
+            self._report_progress()
+            if timed_out:
+                self.timeout_count += 1
+                logger.error(f"⏱ 节点处理超时: {file_name} | 超时限制: {self.timeout}s")
+            elif error is None:
+                self.error_count += 1
+                logger.warning(f"节点未获得判定结果: {file_name}")
+            else:
+                self.error_count += 1
+                logger.error(f"处理节点失败: {file_name} | 错误: {error}")
+
+    def critical_error(self) -> Optional[str]:
+        """超过 50% 的节点超时或失败时返回关键错误描述"""
+        limit = len(self.nodes) * 0.5
+        if self.timeout_count > limit:
+            return f"超过50%的节点处理超时 ({self.timeout_count}/{len(self.nodes)})"
+        if self.error_count > limit:
+            return f"超过50%的节点处理失败 ({self.error_count}/{len(self.nodes)})"
+        return None
+
+    def finish(self, critical_error: Optional[str] = None) -> None:
+        """输出统计；存在关键错误时抛出 RuntimeError"""
+        self._log_stats(time.time() - self.start_time)
+        critical_error = critical_error or self.critical_error()
+        if critical_error:
+            logger.error(f"InsertBlock 过滤遇到关键错误: {critical_error}")
+            raise RuntimeError(f"InsertBlock 过滤失败: {critical_error}")
+
+    def _log_stats(self, elapsed_time: float) -> None:
+        """输出 InsertBlock 过滤统计（汇总一行 INFO，按文件明细仅在 DEBUG 级别输出）"""
+        nodes = self.nodes
+        avg_time_per_node = elapsed_time / len(nodes) if nodes else 0
+
+        logger.info(
+            "InsertBlock 过滤完成 | 总节点: %d | 通过: %d | 拒绝: %d | 超时: %d | 错误: %d | "
+            "耗时: %.2fs (平均 %.2fs/节点) | 并发数: %d | 超时限制: %ss | 涉及文件: %d",
+            len(nodes), len(self.filtered_results), len(self.rejected_nodes), self.timeout_count,
+            self.error_count, elapsed_time, avg_time_per_node, self.max_workers, self.timeout,
+            len(self.file_stats)
+        )
+
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+
+        # 按文件输出统计（拒绝数 = 总数 - 通过数）
+        for file_name, count in sorted(self.file_stats.items()):
+            passed = self.passed_stats[file_name]
+            logger.debug("    - %s: %d 个节点 (通过:%d, 拒绝:%d)", file_name, count, passed, count - passed)
+
+    @staticmethod
+    def _log_verdict(result: FilterResult, file_count: int) -> None:
+        """逐节点判定日志（DEBUG 级别，惰性格式化）"""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        if result.can_answer:
+            logger.debug(
+                "✓ 节点通过 [%d] %s | 关键段落: %d 字符 | 推理: %.50s...",
+                file_count, result.file_name, len(result.key_passage or ''), result.reasoning
+            )
+        else:
+            logger.debug(
+                "✗ 节点拒绝 [%d] %s | 推理: %.50s...",
+                file_count, result.file_name, result.reasoning
+            )
+
 
 class InsertBlockFilter:
     """
@@ -18,7 +439,15 @@ class InsertBlockFilter:
     对每个节点判断是否能回答问题，并提取关键段落
     """
 
-    def __init__(self, llm_service, max_workers: int = None, timeout: int = 200, max_retries: int = 1, llm_id: str = None):
+    def __init__(
+        self,
+        llm_service,
+        max_workers: int = None,
+        timeout: int = 200,
+        max_retries: int = 1,
+        llm_id: str = None,
+        embed_model: Any = None
+    ):
         """
         Args:
             llm_service: LLM 服务实例
@@ -26,9 +455,11 @@ class InsertBlockFilter:
             timeout: 单个节点处理超时时间（秒），默认200秒
             max_retries: 失败重试次数
             llm_id: LLM ID，用于针对特定模型优化
+            embed_model: Embedding 模型（语义缓存计算问题向量用，None 时只使用精确缓存）
         """
         self.llm_service = llm_service
         self.llm_id = llm_id
+        self.embed_model = embed_model
         
         # 针对 deepseek-r1 等推理模型的特殊优化
         if llm_id and 'deepseek' in llm_id.lower():
@@ -41,6 +472,27 @@ class InsertBlockFilter:
             self.timeout = timeout
         
         self.max_retries = max_retries
+        # 常驻线程池（按并发数区分，DeepSeek 等降并发的模型使用更小的池），避免每次过滤都创建/销毁线程
+        self._executors: Dict[int, ThreadPoolExecutor] = {}
+        self._executor_lock = threading.Lock()
+        self._get_executor(self.max_workers)
+        # 是否使用 asyncio 处理节点（I/O 密集，单事件循环即可支撑高并发）
+        self.use_async = Settings.INSERTBLOCK_USE_ASYNC
+        # 后端批处理接口（LLMService.chat_batch），存在且开启批量模式时整批下发
+        self._batch_chat = getattr(llm_service, "chat_batch", None)
+        self.use_batch = Settings.INSERTBLOCK_USE_BATCH
+        # 重排分数预过滤阈值：低于该分数的节点不送 LLM 判定（<=0 表示不过滤）
+        self.prefilter_score_min = Settings.INSERTBLOCK_SCORE_MIN
+        # 每次 LLM 调用联合判定的片段数（1 表示逐节点判定）
+        self.chunks_per_call = Settings.INSERTBLOCK_CHUNKS_PER_CALL
+        # 语义缓存相似度阈值（<=0 表示关闭，仅使用精确缓存）
+        self.semantic_cache_threshold = Settings.INSERTBLOCK_SEMANTIC_CACHE_THRESHOLD
+        # 收集到 K 个通过节点后提前终止（<=0 表示判定全部节点）
+        self.early_stop_k = Settings.INSERTBLOCK_EARLY_STOP_K
+        # JSON 模式：服务端保证返回纯 JSON，可跳过 _extract_json；
+        # 某个模型一旦返回非 JSON 或不支持 response_format，本进程内对该模型关闭
+        self.use_json_mode = Settings.INSERTBLOCK_JSON_MODE
+        self._json_mode_disabled = set()
         logger.info(f"InsertBlockFilter 初始化 | 模型: {llm_id or 'default'} | 并发数: {self.max_workers} | 超时: {self.timeout}s | 重试: {max_retries}次")
 
     def filter_nodes(
@@ -48,8 +500,9 @@ class InsertBlockFilter:
         question: str,
         nodes: List[Any],
         llm_id: Optional[str] = None,
-        progress_callback: Optional[Callable[[int, int], None]] = None
-    ) -> List[Dict[str, Any]]:
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        early_stop_k: Optional[int] = None
+    ) -> List[FilterResult]:
         """
         并发处理多个节点，判断每个节点是否能回答问题
 
@@ -57,198 +510,803 @@ class InsertBlockFilter:
             question: 用户问题
             nodes: 重排后的节点列表
             llm_id: 使用的 LLM ID，默认使用 default
+            early_stop_k: 收集到 K 个通过节点后取消其余判定（None 时使用配置，<=0 表示不提前终止）
 
         Returns:
-            过滤后的节点列表，每个包含：
-            {
-                "node": 原始节点,
-                "file_name": 文件名,
-                "is_relevant": 是否相关,
-                "can_answer": 是否能回答,
-                "reasoning": 推理过程,
-                "answer": 答案,
-                "key_passage": 关键段落,
-                "initial_score": 初始分数,
-                "reranked_score": 重排分数
-            }
+            过滤后的 FilterResult 列表（兼容 result['key'] 访问），每个包含：
+                node: 原始节点
+                file_name: 文件名
+                is_relevant: 是否相关
+                can_answer: 是否能回答
+                reasoning: 推理过程
+                answer: 答案
+                key_passage: 关键段落
+                initial_score: 初始分数
+                reranked_score: 重排分数
+        """
+        return list(self.filter_nodes_stream(question, nodes, llm_id, progress_callback, early_stop_k))
+
+    def filter_nodes_stream(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        early_stop_k: Optional[int] = None
+    ) -> Iterator[FilterResult]:
+        """
+        filter_nodes 的流式版本：每个通过筛选的节点在其 LLM 调用完成后立即产出，
+        下游无需等待全部节点处理完毕即可开始处理
+
+        迭代结束时输出统计；超过 50% 节点超时/失败时抛出 RuntimeError。
+        线程池 / 异步 / 联合判定模式按完成顺序产出；批量模式在整批响应返回后依次产出。
+
+        设置 early_stop_k 时按重排分数从高到低提交判定，产出 K 个结果后取消尚未开始的判定
+        （线程池、异步、联合判定模式均生效）。批量模式整批下发、无法中途取消，
+        因此提前终止开启时改走逐节点流式路径（异步开启时为异步，否则为线程池）。
+
+        Args: 与 filter_nodes 相同
+
+        Yields:
+            通过筛选的 FilterResult
         """
+        if early_stop_k is None:
+            early_stop_k = self.early_stop_k
+        if early_stop_k <= 0:
+            yield from self._filter_nodes_stream(question, nodes, llm_id, progress_callback, score_first=False)
+            return
+
+        stream = self._filter_nodes_stream(question, nodes, llm_id, progress_callback, score_first=True)
+        try:
+            for count, result in enumerate(stream, 1):
+                yield result
+                if count >= early_stop_k:
+                    logger.info(f"InsertBlock 已收集 {count} 个通过节点，提前终止其余判定")
+                    break
+        finally:
+            # 关闭内部生成器，取消本次尚未开始的任务
+            stream.close()
+
+    def _filter_nodes_stream(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str],
+        progress_callback: Optional[Callable[[int, int], None]],
+        score_first: bool
+    ) -> Iterator[FilterResult]:
+        """filter_nodes_stream 的实现：预过滤后按配置分派到批量 / 联合判定 / 异步 / 线程池路径"""
+        nodes = self._prefilter(nodes)
         if not nodes:
-            return []
+            return
+
+        # 批量模式：所有提示词一次性交给后端批处理接口（整批下发无法提前终止，score_first 时不走批量）
+        if self.use_batch and self._batch_chat is not None and not score_first:
+            yield from self._filter_batched_stream(question, nodes, llm_id, progress_callback)
+            return
+
+        # 联合判定模式：一次调用判定多个片段（DeepSeek 等推理模型多片段输入时判定质量下降，保持逐节点）
+        if self.chunks_per_call > 1 and not (llm_id and 'deepseek' in llm_id.lower()):
+            yield from self._filter_joint_stream(question, nodes, llm_id, progress_callback, score_first)
+            return
 
+        # 异步模式：单事件循环 + llm.achat，替代线程池
+        if self.use_async:
+            yield from self._iter_async(self._afilter_stream(question, nodes, llm_id, progress_callback, score_first))
+            return
+
+        yield from self._filter_threaded_stream(question, nodes, llm_id, progress_callback, score_first)
+
+    def _filter_threaded_stream(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str],
+        progress_callback: Optional[Callable[[int, int], None]],
+        score_first: bool
+    ) -> Iterator[FilterResult]:
+        """线程池路径：每个法规文本一个任务，按完成顺序产出；score_first 为 True 时按重排分数而非文本长度排序提交"""
         # 根据模型类型动态调整并发数和超时时间
-        max_workers = self.max_workers
-        timeout = self.timeout
-        
-        if llm_id and 'deepseek' in llm_id.lower():
-            # deepseek-r1 推理时间长，降低并发数，增加超时时间
-            max_workers = min(self.max_workers, 3)  # 最多3个并发
-            timeout = max(self.timeout, 300)  # 至少300秒
-            logger.info(f"检测到 DeepSeek 模型 ({llm_id})，应用特殊优化 | 并发数: {max_workers} → 3 | 超时: {timeout}s")
+        max_workers, timeout = self._resolve_limits(llm_id)
 
-        start_time = time.time()
         logger.info(f"开始使用 InsertBlock 过滤器处理 {len(nodes)} 个节点 | 模型: {llm_id or 'default'} | 并发数: {max_workers}")
 
         # 获取 LLM 实例
         llm = self.llm_service.get_client(llm_id)
         if not llm:
             logger.error("无法获取 LLM 实例，返回空结果")
-            return []
+            return
+
+        # 提示词模板只与问题相关，所有节点共用一次预处理结果
+        prompt_parts = self._prepare_prompt_parts(question)
+        json_mode_key = self._json_mode_key(llm_id)
+        run = _FilterRun(nodes, progress_callback, max_workers, timeout)
 
-        filtered_results = []
-        rejected_nodes = []  # 记录被拒绝的节点
-        file_stats = {}  # 统计每个文件的节点数
-        processed_count = 0  # 已处理节点数
-        timeout_count = 0  # 超时节点数
-        error_count = 0  # 错误节点数
+        # 命中缓存的节点直接产出，其余按法规文本去重后调用 LLM
+        cache_hits, pending, q_emb = self._partition_by_cache(question, nodes, llm_id)
+        yield from run.record_all(cache_hits)
 
-        # 使用线程池并发处理
+        # 使用常驻线程池并发处理
         critical_error = None  # 记录关键错误
+        future_to_key = {}
         try:
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # 提交所有任务
-                future_to_node = {
-                    executor.submit(
-                        self._process_single_node_with_retry,
-                        question,
-                        node,
-                        llm,
-                        timeout
-                    ): node
-                    for node in nodes
-                }
-
-                # 收集结果
-                for future in as_completed(future_to_node):
-                    node = future_to_node[future]
-                    processed_count += 1
-                    
-                    # 调用进度回调
-                    if progress_callback:
-                        try:
-                            progress_callback(processed_count, len(nodes))
-                        except Exception as cb_error:
-                            logger.warning(f"进度回调失败: {cb_error}")
-                    
-                    try:
-                        result = future.result(timeout=timeout + 5)  # 额外5秒容错
-                        if result:
-                            file_name = result['file_name']
-                            # 统计文件
-                            file_stats[file_name] = file_stats.get(file_name, 0) + 1
-
-                            if result.get("can_answer"):
-                                filtered_results.append(result)
-                                logger.info(
-                                    f"✓ 节点通过 [{file_stats[file_name]}] {file_name} | "
-                                    f"关键段落: {len(result.get('key_passage', ''))} 字符 | "
-                                    f"推理: {result['reasoning'][:50]}..."
-                                )
-                            else:
-                                rejected_nodes.append(result)
-                                logger.info(
-                                    f"✗ 节点拒绝 [{file_stats[file_name]}] {file_name} | "
-                                    f"推理: {result['reasoning'][:50]}..."
-                                )
-                        else:
-                            file_name = node.node.metadata.get('file_name', '未知')
-                            error_count += 1
-                            logger.warning(f"节点处理返回 None: {file_name}")
-                    except TimeoutError:
-                        file_name = node.node.metadata.get('file_name', '未知')
-                        timeout_count += 1
-                        logger.error(f"⏱ 节点处理超时: {file_name} | 超时限制: {timeout}s")
-                        # 如果超时节点过多，记录为关键错误
-                        if timeout_count > len(nodes) * 0.5:  # 超过50%超时
-                            critical_error = f"超过50%的节点处理超时 ({timeout_count}/{len(nodes)})"
-                    except Exception as e:
-                        file_name = node.node.metadata.get('file_name', '未知')
-                        error_count += 1
-                        logger.error(
-                            f"处理节点失败: {file_name} | "
-                            f"错误: {e}"
-                        )
-                        # 如果错误节点过多，记录为关键错误
-                        if error_count > len(nodes) * 0.5:  # 超过50%失败
-                            critical_error = f"超过50%的节点处理失败 ({error_count}/{len(nodes)})"
+            executor = self._get_executor(max_workers)
+            submitted_at = time.monotonic()
+            # 提交所有任务（每个法规文本只提交一次；默认最长优先，长文本请求先开始以缩短整体尾延迟；
+            # 提前终止时分数优先，尽早凑够 K 个通过节点）
+            order_key = _highest_score_first_group if score_first else _longest_first_group
+            future_to_key = {
+                executor.submit(
+                    self._process_single_node_with_retry,
+                    question,
+                    group[0],
+                    llm,
+                    timeout,
+                    prompt_parts,
+                    json_mode_key,
+                    submitted_at
+                ): key
+                for key, group in sorted(pending.items(), key=order_key)
+            }
+
+            # 收集结果（超时由 HTTP 客户端按请求控制，这里的 future 一定已完成）
+            for future in as_completed(future_to_key):
+                key = future_to_key[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    run.fail(pending[key], e)
+                else:
+                    if result:
+                        yield from self._settle(run, key, pending[key], result, llm_id, q_emb)
+                    else:
+                        run.fail(pending[key])
+                # 超时 / 失败节点过多，记录为关键错误
+                critical_error = run.critical_error()
+                if critical_error:
+                    break
         except Exception as e:
             # 捕获线程池级别的异常
             critical_error = f"线程池执行失败: {str(e)}"
             logger.error(f"InsertBlock 线程池异常: {e}", exc_info=True)
+        finally:
+            # 线程池常驻：关键错误、异常或调用方提前停止迭代时，取消本次尚未开始的任务
+            for future in future_to_key:
+                future.cancel()
 
-        # 计算处理时间
-        elapsed_time = time.time() - start_time
-        avg_time_per_node = elapsed_time / len(nodes) if nodes else 0
+        run.finish(critical_error)
+
+    def _settle(
+        self,
+        run: "_FilterRun",
+        key: str,
+        group: List[Tuple[Any, str, str, float, float]],
+        result: FilterResult,
+        llm_id: Optional[str],
+        q_emb: Optional[np.ndarray]
+    ) -> Iterator[FilterResult]:
+        """写入缓存并把一个法规文本的判定展开到共享该文本的所有节点，产出其中通过筛选的结果"""
+        self._store_verdict(key, llm_id, group[0][2], q_emb, result)
+        yield from run.record_all(
+            result if item is group[0] else self._result_from_verdict(item, result)
+            for item in group
+        )
+
+    def _partition_by_cache(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str]
+    ) -> Tuple[List[FilterResult], Dict[str, List[Tuple[Any, str, str, float, float]]], Optional[np.ndarray]]:
+        """
+        按 (问题, 法规文本) 去重：命中缓存的节点直接复用判定结果，
+        同一批次内重复的法规文本只需调用一次 LLM
+
+        精确缓存未命中时再查语义缓存，问题向量每次过滤只计算一次。
+
+        Returns:
+            (缓存命中的结果列表, {缓存键: 共享该法规文本的节点信息列表}, 问题向量或 None)
+        """
+        cache_hits = []
+        pending = {}
+        q_emb = None
+        embed_pending = self.semantic_cache_threshold > 0
+        for item in map(self._prep_node, nodes):
+            key = _response_cache_key(llm_id, question, item[2])
+            cached = _response_cache_get(key)
+            if cached is None and key not in pending:
+                if embed_pending:
+                    q_emb = self._embed_question(question)
+                    embed_pending = False
+                if q_emb is not None:
+                    cached = _semantic_cache_get(
+                        _response_cache_key(llm_id, "", item[2]), q_emb, self.semantic_cache_threshold
+                    )
+                    if cached is not None:
+                        _memory_cache_put(key, cached)
+            if cached is not None:
+                cache_hits.append(self._result_from_verdict(item, cached))
+            else:
+                pending.setdefault(key, []).append(item)
+
+        if len(pending) < len(nodes):
+            logger.info(
+                f"InsertBlock 去重 | 缓存命中: {len(cache_hits)} | "
+                f"实际调用 LLM: {len(pending)}/{len(nodes)}"
+            )
+        return cache_hits, pending, q_emb
+
+    def _embed_question(self, question: str) -> Optional[np.ndarray]:
+        """用注入的 Embedding 模型计算归一化的问题向量；未提供模型或失败时返回 None"""
+        if self.embed_model is None:
+            return None
+        try:
+            q_emb = np.asarray(self.embed_model.get_text_embedding(question), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"InsertBlock 语义缓存计算问题向量失败: {e}")
+            return None
+        norm = np.linalg.norm(q_emb)
+        return q_emb / norm if norm > 0 else None
+
+    @staticmethod
+    def _store_verdict(
+        key: str,
+        llm_id: Optional[str],
+        regulations: str,
+        q_emb: Optional[np.ndarray],
+        result: FilterResult
+    ) -> None:
+        """写入精确缓存；已计算问题向量时同时写入语义缓存"""
+        _response_cache_put(key, result)
+        if q_emb is not None:
+            _semantic_cache_put(
+                _response_cache_key(llm_id, "", regulations),
+                q_emb,
+                {field: result.get(field) for field in _RESPONSE_FIELDS}
+            )
+
+    def _prefilter(self, nodes: List[Any]) -> List[Any]:
+        """按重排分数预过滤节点，明显不相关的节点不再占用一次 LLM 调用"""
+        score_min = self.prefilter_score_min
+        if score_min <= 0 or not nodes:
+            return nodes
+
+        kept = [n for n in nodes if (n.score or 0.0) >= score_min]
+        if len(kept) < len(nodes):
+            logger.info(
+                f"InsertBlock 预过滤 | 重排分数 < {score_min} 的节点已跳过: "
+                f"{len(nodes) - len(kept)}/{len(nodes)}"
+            )
+        return kept
+
+    def _get_executor(self, max_workers: int) -> ThreadPoolExecutor:
+        """获取指定并发数的常驻线程池（不存在时创建）"""
+        with self._executor_lock:
+            executor = self._executors.get(max_workers)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="insertblock")
+                self._executors[max_workers] = executor
+            return executor
+
+    def close(self) -> None:
+        """关闭常驻线程池"""
+        with self._executor_lock:
+            executors = list(self._executors.values())
+            self._executors.clear()
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def __enter__(self) -> "InsertBlockFilter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _resolve_limits(self, llm_id: Optional[str]) -> Tuple[int, int]:
+        """根据模型类型动态调整并发数和超时时间"""
+        max_workers = self.max_workers
+        timeout = self.timeout
         
-        # 输出详细统计
-        logger.info("=" * 60)
-        logger.info(f"InsertBlock 过滤完成统计:")
-        logger.info(f"  总节点数: {len(nodes)}")
-        logger.info(f"  通过筛选: {len(filtered_results)} 个节点")
-        logger.info(f"  被拒绝: {len(rejected_nodes)} 个节点")
-        logger.info(f"  超时: {timeout_count} 个节点")
-        logger.info(f"  错误: {error_count} 个节点")
-        logger.info(f"  总处理时间: {elapsed_time:.2f} 秒")
-        logger.info(f"  平均每节点: {avg_time_per_node:.2f} 秒")
-        logger.info(f"  并发数: {max_workers} | 超时限制: {timeout}s")
-        logger.info(f"\n  涉及文件数: {len(file_stats)}")
-
-        # 按文件输出统计
-        for file_name, count in sorted(file_stats.items()):
-            passed = sum(1 for r in filtered_results if r['file_name'] == file_name)
-            rejected = sum(1 for r in rejected_nodes if r['file_name'] == file_name)
-            logger.info(f"    - {file_name}: {count} 个节点 (通过:{passed}, 拒绝:{rejected})")
-
-        logger.info("=" * 60)
+        if llm_id and 'deepseek' in llm_id.lower():
+            # deepseek-r1 推理时间长，降低并发数，增加超时时间
+            max_workers = min(self.max_workers, 3)  # 最多3个并发
+            timeout = max(self.timeout, 300)  # 至少300秒
+            logger.info(f"检测到 DeepSeek 模型 ({llm_id})，应用特殊优化 | 并发数: {max_workers} → 3 | 超时: {timeout}s")
         
-        # 如果有关键错误，抛出异常
-        if critical_error:
-            logger.error(f"InsertBlock 过滤遇到关键错误: {critical_error}")
-            raise RuntimeError(f"InsertBlock 过滤失败: {critical_error}")
+        return max_workers, timeout
 
-        return filtered_results
+    def _json_mode_key(self, llm_id: Optional[str]) -> Optional[str]:
+        """返回本次调用使用的 JSON 模式键（模型 ID），未启用或已对该模型关闭时返回 None"""
+        key = llm_id or 'default'
+        if self.use_json_mode and key not in self._json_mode_disabled:
+            return key
+        return None
+
+    def _json_mode_active(self, json_mode_key: Optional[str]) -> bool:
+        return json_mode_key is not None and json_mode_key not in self._json_mode_disabled
+
+    def _disable_json_mode(self, json_mode_key: str, reason: Any) -> None:
+        if json_mode_key not in self._json_mode_disabled:
+            self._json_mode_disabled.add(json_mode_key)
+            logger.warning(f"已对模型 {json_mode_key} 关闭 JSON 模式，回退到文本提取 | 原因: {reason}")
+
+    async def afilter_nodes(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> List[FilterResult]:
+        """
+        filter_nodes 的 asyncio 版本
+
+        所有节点的 LLM 调用在同一个事件循环中并发执行，
+        asyncio.Semaphore 限制在途请求数，asyncio.as_completed 驱动进度回调。
+        与线程池版本共用响应缓存与法规文本去重。
+
+        Args/Returns 与 filter_nodes 相同
+        """
+        nodes = self._prefilter(nodes)
+        if not nodes:
+            return []
+        return [result async for result in self._afilter_stream(question, nodes, llm_id, progress_callback)]
+
+    async def _afilter_stream(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str],
+        progress_callback: Optional[Callable[[int, int], None]],
+        score_first: bool = False
+    ) -> AsyncIterator[FilterResult]:
+        """asyncio 路径：通过筛选的结果按完成顺序产出，生成器关闭时取消尚未完成的任务"""
+        max_workers, timeout = self._resolve_limits(llm_id)
+
+        logger.info(f"开始使用 InsertBlock 过滤器(async)处理 {len(nodes)} 个节点 | 模型: {llm_id or 'default'} | 并发数: {max_workers}")
+
+        llm = self.llm_service.get_client(llm_id)
+        if not llm:
+            logger.error("无法获取 LLM 实例，返回空结果")
+            return
+
+        semaphore = asyncio.Semaphore(max_workers)
+        prompt_parts = self._prepare_prompt_parts(question)
+        json_mode_key = self._json_mode_key(llm_id)
+        run = _FilterRun(nodes, progress_callback, max_workers, timeout)
+
+        async def run_one(key, group):
+            async with semaphore:
+                try:
+                    return key, group, await self._aprocess_single_node(
+                        question, group[0], llm, timeout, prompt_parts, json_mode_key, submitted_at
+                    ), None
+                except Exception as e:
+                    return key, group, None, e
+
+        cache_hits, pending, q_emb = self._partition_by_cache(question, nodes, llm_id)
+        for result in run.record_all(cache_hits):
+            yield result
+
+        # Semaphore 按创建顺序放行：默认最长优先，长文本请求先开始；提前终止时分数优先
+        submitted_at = time.monotonic()
+        order_key = _highest_score_first_group if score_first else _longest_first_group
+        tasks = [
+            asyncio.ensure_future(run_one(key, group))
+            for key, group in sorted(pending.items(), key=order_key)
+        ]
+        critical_error = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                key, group, result, error = await next_done
+                if result:
+                    for item_result in self._settle(run, key, group, result, llm_id, q_emb):
+                        yield item_result
+                    continue
+
+                run.fail(group, error)
+                critical_error = run.critical_error()
+                if critical_error:
+                    break
+        finally:
+            # 取消尚未完成的任务：排队中的不再发起，进行中的 HTTP 请求随协程取消而中断；
+            # 等待取消生效，避免事件循环关闭时遗留挂起的任务
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        run.finish(critical_error)
+
+    async def _aprocess_single_node(
+        self,
+        question: str,
+        item: Tuple[Any, str, str, float, float],
+        llm: Any,
+        timeout: int,
+        prompt_parts: Optional[_PromptParts] = None,
+        json_mode_key: Optional[str] = None,
+        submitted_at: Optional[float] = None
+    ) -> Optional[FilterResult]:
+        """
+        异步处理单个节点（带重试和超时）
+
+        Args:
+            item: _prep_node 生成的节点信息
+            json_mode_key: JSON 模式键（None 表示不使用 JSON 模式）
+            submitted_at: 任务提交时间（time.monotonic），超过 timeout 后不再发起重试
+
+        Raises:
+            asyncio.TimeoutError: 超时且已达最大重试次数
+        """
+        node, file_name, regulations, initial_score, reranked_score = item
+        messages = self._build_messages(question, regulations, prompt_parts)
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0 and submitted_at is not None and time.monotonic() - submitted_at > timeout:
+                logger.error(f"节点处理已超出时限，放弃重试: {file_name}")
+                raise asyncio.TimeoutError(f"节点处理已超出时限 {timeout}s")
+            try:
+                if attempt > 0:
+                    logger.info(f"重试节点 [{attempt}/{self.max_retries}]: {file_name}")
+                json_mode = self._json_mode_active(json_mode_key)
+                response = await asyncio.wait_for(
+                    llm.achat(messages, **(_JSON_MODE_KWARGS if json_mode else {})),
+                    timeout=timeout
+                )
+                result = self._parse_response(
+                    node, file_name, initial_score, reranked_score, response.message.content.strip(),
+                    json_mode_key if json_mode else None
+                )
+                if result:
+                    return result
+            except asyncio.TimeoutError:
+                logger.warning(f"LLM 调用超时: {file_name} | 超时限制: {timeout}s")
+                if attempt >= self.max_retries:
+                    raise
+            except Exception as e:
+                if json_mode:
+                    self._disable_json_mode(json_mode_key, e)
+                logger.warning(f"节点处理失败: {file_name} | 错误: {e}")
+                # 与线程池版本一致：不可重试的错误直接放弃该节点
+                if not (json_mode or _is_retryable(e)):
+                    return None
+                if attempt >= self.max_retries:
+                    raise
+            await asyncio.sleep(_retry_delay(attempt))
+
+        return None
+
+    def filter_nodes_batched(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> List[FilterResult]:
+        """
+        批量版本的节点过滤：一次性构造所有对话消息并整体下发
+
+        - 若 llm_service 提供 chat_batch(messages_list, llm_id=...)，整批交给后端（如 vLLM 连续批处理）
+        - 否则使用 asyncio.gather + llm.achat 并发请求，Semaphore(max_workers) 限制在途请求数
+        与逐节点模式共用响应缓存、法规文本去重、JSON 模式与按模型的并发/超时限制。
+        nodes 应已经过 _prefilter（由 filter_nodes_stream 负责）。
+
+        Args/Returns 与 filter_nodes 相同
+        """
+        if not nodes:
+            return []
+        return list(self._filter_batched_stream(question, nodes, llm_id, progress_callback))
+
+    def _filter_batched_stream(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str],
+        progress_callback: Optional[Callable[[int, int], None]]
+    ) -> Iterator[FilterResult]:
+        """批量路径：整批响应返回后逐个解析并产出通过筛选的结果"""
+        max_workers, timeout = self._resolve_limits(llm_id)
+
+        llm = self.llm_service.get_client(llm_id)
+        if not llm:
+            logger.error("无法获取 LLM 实例，返回空结果")
+            return
+
+        run = _FilterRun(nodes, progress_callback, max_workers, timeout)
+
+        # 1. 命中缓存的节点直接复用，其余按法规文本去重后一次性构造对话消息
+        cache_hits, pending, q_emb = self._partition_by_cache(question, nodes, llm_id)
+        yield from run.record_all(cache_hits)
+
+        prompt_parts = self._prepare_prompt_parts(question)
+        json_mode_key = self._json_mode_key(llm_id)
+        json_mode = self._json_mode_active(json_mode_key)
+        chat_kwargs = _JSON_MODE_KWARGS if json_mode else {}
+        keys = [key for key, _ in sorted(pending.items(), key=_longest_first_group)]
+        messages_list = [self._build_messages(question, pending[key][0][2], prompt_parts) for key in keys]
+
+        # 2. 整批下发
+        if not messages_list:
+            responses = []
+        elif self._batch_chat is not None:
+            logger.info(f"InsertBlock 批量模式 | 使用后端批处理接口 | 请求数: {len(messages_list)} | 在途上限: {max_workers}")
+            responses = self._batch_chat(
+                messages_list, llm_id=llm_id, max_in_flight=max_workers, timeout=timeout, **chat_kwargs
+            )
+        else:
+            logger.info(f"InsertBlock 批量模式 | asyncio 并发 | 请求数: {len(messages_list)} | 在途上限: {max_workers}")
+            responses = self._run_async(self._achat_all(llm, messages_list, max_workers, timeout, chat_kwargs))
+
+        # 3. 逐个解析，写入缓存并展开到共享该法规文本的节点
+        critical_error = None
+        for key, response in zip(keys, responses):
+            group = pending[key]
+            node, file_name, _, initial_score, reranked_score = group[0]
+            if isinstance(response, Exception):
+                if json_mode:
+                    self._disable_json_mode(json_mode_key, response)
+                run.fail(group, response)
+            else:
+                text = response if isinstance(response, str) else response.message.content
+                result = self._parse_response(
+                    node, file_name, initial_score, reranked_score, text.strip(),
+                    json_mode_key if json_mode else None
+                )
+                if result is not None:
+                    yield from self._settle(run, key, group, result, llm_id, q_emb)
+                    continue
+                run.fail(group)
+            critical_error = run.critical_error()
+            if critical_error:
+                break
+
+        run.finish(critical_error)
+
+    def filter_nodes_joint(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> List[FilterResult]:
+        """
+        多片段联合判定：每次 LLM 调用同时判定 chunks_per_call 个节点，
+        分摊系统提示词开销，并让模型对同一问题的多个片段统一判断。
+        与逐节点模式共用响应缓存与法规文本去重。
+
+        Args/Returns 与 filter_nodes 相同
+        """
+        nodes = self._prefilter(nodes)
+        if not nodes:
+            return []
+        return list(self._filter_joint_stream(question, nodes, llm_id, progress_callback))
+
+    def _filter_joint_stream(
+        self,
+        question: str,
+        nodes: List[Any],
+        llm_id: Optional[str],
+        progress_callback: Optional[Callable[[int, int], None]],
+        score_first: bool = False
+    ) -> Iterator[FilterResult]:
+        """联合判定路径：每个批次完成后立即产出其中通过筛选的结果，生成器关闭时取消尚未开始的批次"""
+        max_workers, timeout = self._resolve_limits(llm_id)
+        chunk_size = max(1, self.chunks_per_call)
+
+        logger.info(
+            f"开始使用 InsertBlock 联合判定处理 {len(nodes)} 个节点 | 模型: {llm_id or 'default'} | "
+            f"每次调用片段数: {chunk_size} | 并发数: {max_workers}"
+        )
+
+        llm = self.llm_service.get_client(llm_id)
+        if not llm:
+            logger.error("无法获取 LLM 实例，返回空结果")
+            return
+
+        run = _FilterRun(nodes, progress_callback, max_workers, timeout)
+
+        cache_hits, pending, q_emb = self._partition_by_cache(question, nodes, llm_id)
+        yield from run.record_all(cache_hits)
+
+        # 每个法规文本只判定一次；默认最长优先（长片段集中在前面的批次，先提交先开始），提前终止时分数优先
+        order_key = _highest_score_first_group if score_first else _longest_first_group
+        keys = [key for key, _ in sorted(pending.items(), key=order_key)]
+        chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+
+        executor = self._get_executor(max_workers)
+        critical_error = None
+        future_to_chunk = {}
+        try:
+            future_to_chunk = {
+                executor.submit(self._process_batch, question, [pending[key][0] for key in chunk], llm, timeout): chunk
+                for chunk in chunks
+            }
+
+            for future in as_completed(future_to_chunk):
+                chunk = future_to_chunk[future]
+                error = None
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logger.error(f"联合判定调用失败: {len(chunk)} 个片段 | 错误: {e}")
+                    error = e
+                    results = [None] * len(chunk)
+
+                for key, result in zip(chunk, results):
+                    if result is None:
+                        run.fail(pending[key], error)
+                    else:
+                        yield from self._settle(run, key, pending[key], result, llm_id, q_emb)
+
+                critical_error = run.critical_error()
+                if critical_error:
+                    break
+        finally:
+            # 关键错误或调用方提前停止迭代时，取消尚未开始的批次
+            for future in future_to_chunk:
+                future.cancel()
+
+        run.finish(critical_error)
+
+    def _process_batch(
+        self,
+        question: str,
+        chunk: List[Tuple[Any, str, str, float, float]],
+        llm: Any,
+        timeout: int
+    ) -> List[Optional[FilterResult]]:
+        """
+        一次 LLM 调用联合判定多个节点
+
+        Args:
+            question: 用户问题
+            chunk: _prep_node 生成的节点信息列表
+            llm: LLM 实例
+            timeout: 单次请求超时时间（秒）
+
+        Returns:
+            与 chunk 一一对应的结果，模型未给出判定的位置为 None
+        """
+        regulations_block = "\n\n".join(
+            get_insertblock_batch_regulation().format(index=i, regulations=regulations)
+            for i, (_, _, regulations, _, _) in enumerate(chunk)
+        )
+        user_prompt = "\n".join(get_insertblock_batch_user_all()).format(
+            question=question, regulations_block=regulations_block
+        )
+        messages = [
+            ChatMessage(role="system", content="\n".join(get_insertblock_batch_system_all())),
+            ChatMessage(role="user", content=user_prompt)
+        ]
+
+        # 输出长度随片段数增长，避免 JSON 被截断
+        max_tokens = min(Settings.LLM_MAX_TOKENS, len(chunk) * _BATCH_TOKENS_PER_CHUNK)
+        response = llm.chat(messages, max_tokens=max_tokens, timeout=timeout)
+        response_text = response.message.content.strip()
+
+        try:
+            data = _json_loads(self._extract_json(response_text))
+        except json.JSONDecodeError as e:
+            logger.error(f"联合判定 JSON 解析失败 | 响应: {response_text[:200]} | 错误: {e}")
+            return [None] * len(chunk)
+
+        verdicts = {}
+        for entry in data.get("results", []) if isinstance(data, dict) else []:
+            try:
+                verdicts[int(entry["index"])] = entry
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        return [
+            self._result_from_verdict(item, verdicts[i]) if i in verdicts else None
+            for i, item in enumerate(chunk)
+        ]
+
+    def _run_async(self, coro) -> Any:
+        """
+        执行协程：优先使用 llm_service 的常驻事件循环（共享 AsyncClient 连接池），
+        否则临时创建事件循环
+        """
+        run_coroutine = getattr(self.llm_service, "run_coroutine", None)
+        if run_coroutine is not None:
+            return run_coroutine(coro)
+        return asyncio.run(coro)
+
+    def _iter_async(self, agen: AsyncIterator[Any]) -> Iterator[Any]:
+        """
+        逐个取出异步生成器的产出：每一步都在同一事件循环上执行（优先 llm_service 的常驻事件循环），
+        调用方提前停止迭代时关闭异步生成器，由其取消尚未完成的任务
+        """
+        run_coroutine = getattr(self.llm_service, "run_coroutine", None)
+        loop = None
+        if run_coroutine is None:
+            loop = asyncio.new_event_loop()
+            run_coroutine = loop.run_until_complete
+        try:
+            while True:
+                item = run_coroutine(_anext(agen))
+                if item is _ASYNC_DONE:
+                    return
+                yield item
+        finally:
+            try:
+                run_coroutine(agen.aclose())
+            finally:
+                if loop is not None:
+                    loop.close()
+
+    @staticmethod
+    async def _achat_all(
+        llm: Any,
+        messages_list: List[List[ChatMessage]],
+        max_in_flight: int,
+        timeout: int,
+        chat_kwargs: Dict[str, Any]
+    ) -> List[Any]:
+        """
+        并发调用 llm.achat，返回与 messages_list 顺序一致的响应（失败项为异常对象）
+        """
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def one(messages: List[ChatMessage]):
+            async with semaphore:
+                return await llm.achat(messages, timeout=timeout, **chat_kwargs)
+
+        return await asyncio.gather(*(one(m) for m in messages_list), return_exceptions=True)
 
     def _process_single_node_with_retry(
         self,
         question: str,
-        node: Any,
+        item: Tuple[Any, str, str, float, float],
         llm: Any,
-        timeout: int = None
-    ) -> Optional[Dict[str, Any]]:
+        timeout: int = None,
+        prompt_parts: Optional[_PromptParts] = None,
+        json_mode_key: Optional[str] = None,
+        submitted_at: Optional[float] = None
+    ) -> Optional[FilterResult]:
         """
         带重试的节点处理
         
         Args:
             question: 用户问题
-            node: 节点对象
+            item: _prep_node 生成的节点信息
             llm: LLM 实例
             timeout: 超时时间（秒）
+            prompt_parts: 预处理后的提示词模板
+            json_mode_key: JSON 模式键（None 表示不使用 JSON 模式）
+            submitted_at: 任务提交时间（time.monotonic），超过 timeout 后不再发起重试
             
         Returns:
-            处理结果字典或 None
+            FilterResult 或 None
         """
-        file_name = node.node.metadata.get('file_name', '未知文件')
+        file_name = item[1]
         timeout = timeout or self.timeout
         
         for attempt in range(self.max_retries + 1):
+            if attempt > 0 and submitted_at is not None and time.monotonic() - submitted_at > timeout:
+                logger.error(f"节点处理已超出时限，放弃重试: {file_name}")
+                raise TimeoutError(f"节点处理已超出时限 {timeout}s")
             try:
                 if attempt > 0:
                     logger.info(f"重试节点 [{attempt}/{self.max_retries}]: {file_name}")
                 
-                result = self._process_single_node(question, node, llm, timeout)
+                result = self._process_single_node(question, item, llm, timeout, prompt_parts, json_mode_key)
                 if result:
                     return result
                     
             except TimeoutError:
                 if attempt < self.max_retries:
                     logger.warning(f"节点处理超时，准备重试: {file_name}")
-                    time.sleep(0.5)  # 短暂延迟后重试
+                    time.sleep(_retry_delay(attempt))
                 else:
                     logger.error(f"节点处理超时，已达最大重试次数: {file_name}")
                     raise
             except Exception as e:
+                if not _is_retryable(e):
+                    logger.error(f"节点处理失败（不可重试）: {file_name} | 错误: {e}")
+                    raise
                 if attempt < self.max_retries:
                     logger.warning(f"节点处理失败，准备重试: {file_name} | 错误: {e}")
-                    time.sleep(0.5)
+                    time.sleep(_retry_delay(attempt))
                 else:
                     logger.error(f"节点处理失败，已达最大重试次数: {file_name} | 错误: {e}")
                     raise
@@ -258,104 +1316,212 @@ class InsertBlockFilter:
     def _process_single_node(
         self,
         question: str,
-        node: Any,
+        item: Tuple[Any, str, str, float, float],
         llm: Any,
-        timeout: int = None
-    ) -> Optional[Dict[str, Any]]:
+        timeout: int = None,
+        prompt_parts: Optional[_PromptParts] = None,
+        json_mode_key: Optional[str] = None
+    ) -> Optional[FilterResult]:
         """
         处理单个节点
 
         Args:
             question: 用户问题
-            node: 节点对象
+            item: _prep_node 生成的节点信息
             llm: LLM 实例
             timeout: 超时时间（秒）
+            prompt_parts: 预处理后的提示词模板
+            json_mode_key: JSON 模式键（None 表示不使用 JSON 模式）
 
         Returns:
-            处理结果字典或 None
+            FilterResult 或 None
         """
-        # 初始化变量（用于异常处理）
-        file_name = "未知文件"
-        response_text = ""
+        node, file_name, regulations, initial_score, reranked_score = item
+        json_mode = self._json_mode_active(json_mode_key)
+        actual_timeout = timeout or self.timeout
+
+        # 构造提示词
+        messages = self._build_messages(question, regulations, prompt_parts)
 
         try:
-            # 提取节点信息
-            file_name = node.node.metadata.get('file_name', '未知文件')
-            regulations = node.node.get_content().strip()
-            initial_score = node.node.metadata.get('initial_score', 0.0)
-            reranked_score = node.score
-
-            # 构造提示词
-            system_template = get_insertblock_system_all()
-            user_template = get_insertblock_user_all()
-
-            # 拼接提示词（system 和 user 都是列表）
-            # 先对模板进行 format，再 join
+            # 调用 LLM（超时由 HTTP 客户端按请求控制，超时后连接与线程立即释放）
+            response = llm.chat(
+                messages,
+                timeout=actual_timeout,
+                **(_JSON_MODE_KWARGS if json_mode else {})
+            )
+            response_text = response.message.content.strip()
+        except _LLM_TIMEOUT_ERRORS as e:
+            logger.error(f"LLM 调用超时: {file_name} | 超时限制: {actual_timeout}s")
+            raise TimeoutError(f"LLM 调用超时: {file_name}") from e
+        except Exception as e:
+            logger.error(f"处理节点异常: {file_name} | 错误: {e}")
+            # 服务端不支持 response_format 时关闭 JSON 模式，返回 None 由重试逻辑以普通模式重发
+            if json_mode:
+                self._disable_json_mode(json_mode_key, e)
+                return None
+            # 是否重试由 _process_single_node_with_retry 按 _is_retryable 判定
+            raise
+
+        return self._parse_response(
+            node, file_name, initial_score, reranked_score, response_text,
+            json_mode_key if json_mode else None
+        )
+
+    @staticmethod
+    def _prepare_prompt_parts(question: str) -> _PromptParts:
+        """
+        预处理提示词模板（同一次过滤内所有节点的 question 相同，只需处理一次）
+
+        只含 {question} 的片段在此直接渲染；含 {regulations} 的片段保留原模板，逐节点渲染。
+
+        Args:
+            question: 用户问题
+
+        Returns:
+            (system 片段, user 片段)，每个片段为 (是否需要逐节点 format, 内容)
+        """
+        def prepare(classified: Tuple[Tuple[bool, bool, str], ...]) -> Tuple[Tuple[bool, str], ...]:
             # 注意：只对包含占位符的模板进行 format
-            system_prompt_parts = []
-            for template in system_template:
-                # 检查是否包含占位符
-                if "{question}" in template or "{regulations}" in template:
-                    system_prompt_parts.append(template.format(question=question, regulations=regulations))
-                else:
-                    system_prompt_parts.append(template)
-            system_prompt = "\n".join(system_prompt_parts)
-
-            # user_template 通常不包含需要 format 的占位符
-            user_prompt_parts = []
-            for template in user_template:
-                if "{question}" in template or "{regulations}" in template:
-                    user_prompt_parts.append(template.format(question=question, regulations=regulations))
-                else:
-                    user_prompt_parts.append(template)
-            user_prompt = "\n".join(user_prompt_parts)
+            return tuple(
+                (True, template) if has_regulations
+                else (False, template.format(question=question) if has_question else template)
+                for has_regulations, has_question, template in classified
+            )
 
-            # 组合为单一 prompt
-            full_prompt = f"{system_prompt}\n\n{user_prompt}"
+        system_templates, user_templates = _classified_templates()
+        return prepare(system_templates), prepare(user_templates)
 
-            # 调用 LLM（使用 Future 实现超时控制）
-            from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
-            
-            def call_llm():
-                return llm.complete(full_prompt)
-            
-            # 使用单独的线程池执行 LLM 调用，带超时
-            actual_timeout = timeout or self.timeout
-            with ThreadPoolExecutor(max_workers=1) as llm_executor:
-                future = llm_executor.submit(call_llm)
-                try:
-                    response = future.result(timeout=actual_timeout)
-                    response_text = response.text.strip()
-                except FutureTimeoutError:
-                    logger.error(f"LLM 调用超时: {file_name} | 超时限制: {actual_timeout}s")
-                    raise TimeoutError(f"LLM 调用超时: {file_name}")
-
-            # 解析 JSON 响应
-            # 尝试提取 JSON（可能包含在 markdown 代码块中）
-            json_text = self._extract_json(response_text)
-            result_data = json.loads(json_text)
-
-            # 构造返回结果
-            return {
-                "node": node,
-                "file_name": file_name,
-                "is_relevant": result_data.get("is_relevant", False),
-                "can_answer": result_data.get("can_answer", False),
-                "reasoning": result_data.get("reasoning", ""),
-                "answer": result_data.get("answer", ""),
-                "key_passage": result_data.get("key_passage"),
-                "initial_score": initial_score,
-                "reranked_score": reranked_score
-            }
+    @classmethod
+    def _build_messages(
+        cls,
+        question: str,
+        regulations: str,
+        prompt_parts: Optional[_PromptParts] = None
+    ) -> List[ChatMessage]:
+        """
+        构造单个节点的对话消息
 
-        except json.JSONDecodeError as e:
+        不含 {regulations} 的模板片段全部放入 system 消息，保证同一次过滤内各节点的 system
+        消息逐字节一致（服务端前缀缓存可命中）；含 {regulations} 的输入片段放入 user 消息。
+
+        Args:
+            question: 用户问题
+            regulations: 节点法规内容
+            prompt_parts: _prepare_prompt_parts 的预处理结果（None 时现场计算）
+
+        Returns:
+            [system 消息, user 消息]
+        """
+        if prompt_parts is None:
+            prompt_parts = cls._prepare_prompt_parts(question)
+        system_prompt, user_template = _chat_layout(prompt_parts)
+
+        return [
+            ChatMessage(role="system", content=system_prompt),
+            ChatMessage(role="user", content=user_template.format(question=question, regulations=regulations))
+        ]
+
+    def _parse_response(
+        self,
+        node: Any,
+        file_name: str,
+        initial_score: float,
+        reranked_score: float,
+        response_text: str,
+        json_mode_key: Optional[str] = None
+    ) -> Optional[FilterResult]:
+        """
+        解析 LLM 响应并构造结果
+
+        Args:
+            node: 节点对象
+            file_name: 文件名
+            initial_score: 初始分数
+            reranked_score: 重排分数
+            response_text: LLM 返回的文本
+            json_mode_key: 以 JSON 模式请求时的模型键，响应直接按 JSON 解析
+
+        Returns:
+            FilterResult，JSON 解析失败时返回 None
+        """
+        result_data = None
+        if json_mode_key is not None:
+            try:
+                result_data = _json_loads(response_text)
+            except json.JSONDecodeError as e:
+                # 服务端未遵守 JSON 模式：对该模型关闭，本次回退到文本提取
+                self._disable_json_mode(json_mode_key, e)
+
+        try:
+            if result_data is None:
+                # 尝试提取 JSON（可能包含在 markdown 代码块中）
+                json_text = self._extract_json(response_text)
+                result_data = _json_loads(json_text)
+        except json.JSONDecodeError as e:  # orjson.JSONDecodeError 同为其子类
             logger.error(
                 f"JSON 解析失败: {file_name} | 响应: {response_text[:200]} | 错误: {e}"
             )
             return None
-        except Exception as e:
-            logger.error(f"处理节点异常: {file_name} | 错误: {e}")
-            return None
+
+        # 构造返回结果
+        return FilterResult(
+            node=node,
+            file_name=file_name,
+            is_relevant=result_data.get("is_relevant", False),
+            can_answer=result_data.get("can_answer", False),
+            reasoning=result_data.get("reasoning", ""),
+            answer=result_data.get("answer", ""),
+            key_passage=result_data.get("key_passage"),
+            initial_score=initial_score,
+            reranked_score=reranked_score
+        )
+
+    @staticmethod
+    def _prep_node(node: Any) -> Tuple[Any, str, str, float, float]:
+        """
+        一次性提取节点信息，避免在提交、处理和日志中反复访问 node.node.metadata
+
+        Args:
+            node: 节点对象
+
+        Returns:
+            (节点, 文件名, 法规内容, 初始分数, 重排分数)
+        """
+        inner = node.node
+        metadata = inner.metadata
+        return (
+            node,
+            metadata.get('file_name', '未知文件'),
+            inner.get_content().strip(),
+            metadata.get('initial_score', 0.0),
+            node.score
+        )
+
+    @staticmethod
+    def _result_from_verdict(item: Tuple[Any, str, str, float, float], cached: Any) -> FilterResult:
+        """
+        用已有的 LLM 判定字段为节点构造返回结果（分数取节点自身的值）
+
+        Args:
+            item: _prep_node 生成的节点信息
+            cached: 判定字段（缓存、同一法规文本的其他节点结果或联合判定中的单项）
+
+        Returns:
+            FilterResult
+        """
+        node, file_name, _, initial_score, reranked_score = item
+        return FilterResult(
+            node=node,
+            file_name=file_name,
+            is_relevant=cached.get("is_relevant", False),
+            can_answer=cached.get("can_answer", False),
+            reasoning=cached.get("reasoning", ""),
+            answer=cached.get("answer", ""),
+            key_passage=cached.get("key_passage"),
+            initial_score=initial_score,
+            reranked_score=reranked_score
+        )
 
     @staticmethod
     def _extract_json(text: str) -> str:
@@ -372,22 +1538,20 @@ class InsertBlockFilter:
         # 去除首尾空白
         text = text.strip()
 
-        # 尝试提取 markdown 代码块
-        if "```json" in text:
-            start = text.find("```json") + 7
-            end = text.find("```", start)
-            if end != -1:
-                return text[start:end].strip()
-        elif "```" in text:
-            start = text.find("```") + 3
+        # 均为 str.find / rfind 的单次 C 层扫描，不经过正则回溯
+        # 尝试提取 markdown 代码块（优先 ```json，其次任意 ```）
+        fence = "```json" if "```json" in text else "```"
+        start = text.find(fence)
+        if start != -1:
+            start += len(fence)
             end = text.find("```", start)
             if end != -1:
                 return text[start:end].strip()
 
-        # 尝试查找 JSON 对象
+        # 尝试查找 JSON 对象（第一个 { 到最后一个 }）
         start = text.find("{")
-        end = text.rfind("}") + 1
+        end = text.rfind("}")
         if start != -1 and end > start:
-            return text[start:end]
+            return text[start:end + 1]
 
         return text
@@ -3,123 +3,252 @@
 检索器模块
 实现混合检索（BM25 + 向量检索 + RRF 融合）
 """
+import bm25s
+import hashlib
 import jieba
+import logging
+import numpy as np
 import os
-from typing import List
-from llama_index.core import Document, QueryBundle
+import sqlite3
+import Stemmer
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+from typing import Dict, List, Tuple
+from llama_index.core import QueryBundle
 from llama_index.core.retrievers import AutoMergingRetriever, BaseRetriever
 from llama_index.core.schema import NodeWithScore, TextNode
 from llama_index.core import VectorStoreIndex
-from llama_index.retrievers.bm25 import BM25Retriever as OfficialBM25
 from utils.logger import logger
 from utils.keyword_ranker import keyword_ranker
+from config import Settings as AppSettings
 
-# 加载自定义词典（保留默认词典，只增强自定义词）
+# 自定义词典
 CUSTOM_DICT_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "dict", "custom_dict.txt")
 CUSTOM_WORDS_SET = set()  # 全局变量，用于标记自定义词
 
-if os.path.exists(CUSTOM_DICT_PATH):
-    # 使用 jieba.load_userdict 加载自定义词典（保留默认词典）
-    jieba.load_userdict(CUSTOM_DICT_PATH)
+# jieba 前缀词典构建和自定义词典加载推迟到首次建索引/分词时执行，
+# 只导入 core 包（如 LLMStreamWrapper、测试收集）时不承担约 1s 的初始化开销
+_JIEBA_READY = False
+_JIEBA_LOCK = threading.Lock()
+
+
+def _ensure_jieba_ready() -> None:
+    """初始化 jieba 并加载自定义词典（线程安全，只执行一次）"""
+    global _JIEBA_READY
+    if _JIEBA_READY:
+        return
+    with _JIEBA_LOCK:
+        if _JIEBA_READY:
+            return
+        jieba.initialize()
+        _load_custom_dict()
+        _JIEBA_READY = True
+
+
+def _load_custom_dict() -> None:
+    """加载自定义词典（保留默认词典，只增强自定义词）"""
+    if os.path.exists(CUSTOM_DICT_PATH):
+        # 提取自定义词典的词和权重
+        custom_words = {}
+        lines = Path(CUSTOM_DICT_PATH).read_text(encoding='utf-8').splitlines()
+        line_count = len(lines)
+        empty_lines = 0
+        comment_lines = 0
     
-    # 提取自定义词典的词和权重
-    custom_words = {}
-    line_count = 0
-    empty_lines = 0
-    comment_lines = 0
-    
-    with open(CUSTOM_DICT_PATH, 'r', encoding='utf-8') as f:
-        for line in f:
-            line_count += 1
+        for line_no, line in enumerate(lines, 1):
             line = line.strip()
-            
+        
             if not line:
                 empty_lines += 1
                 continue
-                
+            
             if line.startswith('#'):
                 comment_lines += 1
                 continue
-            
+        
             # 解析词和权重：格式为 "词 权重 词性" 或 "词\t权重\t词性"
             parts = line.split()
             if len(parts) >= 2:
-                word = parts[0]
                 try:
-                    freq = int(parts[1])
-                    custom_words[word] = freq
-                    CUSTOM_WORDS_SET.add(word)
+                    custom_words[parts[0]] = int(parts[1])
                 except ValueError:
-                    custom_words[word] = 100000
-                    CUSTOM_WORDS_SET.add(word)
-                    logger.warning(f"第 {line_count} 行权重解析失败，使用默认值: '{line}'")
-            elif len(parts) == 1:
-                custom_words[parts[0]] = 100000
-                CUSTOM_WORDS_SET.add(parts[0])
+                    custom_words[parts[0]] = 100000
+                    logger.warning(f"第 {line_no} 行权重解析失败，使用默认值: '{line}'")
             else:
-                logger.warning(f"第 {line_count} 行解析失败: '{line}'")
+                custom_words[parts[0]] = 100000
+        CUSTOM_WORDS_SET.update(custom_words)
     
-    # 对自定义词赋予更高权重（不清空默认词典）
-    for word, freq in custom_words.items():
-        jieba.dt.FREQ[word] = freq
+        # 使用 jieba.load_userdict 加载自定义词典（保留默认词典，补齐前缀词典和词性）
+        jieba.load_userdict(CUSTOM_DICT_PATH)
     
-    # 重新计算总词频
-    jieba.dt.total = sum(jieba.dt.FREQ.values())
+        # 对自定义词赋予更高权重（不清空默认词典）：load_userdict 按单空格解析，
+        # "词  权重  词性" 这类双空格行会得到错误的词和权重，这里以上面解析的权重为准。
+        # 覆盖前按每个词的新旧词频差修正总词频，无需对近 50 万词条整体重新求和
+        freq = jieba.dt.FREQ
+        jieba.dt.total += sum(weight - freq.get(word, 0) for word, weight in custom_words.items())
+        freq.update(custom_words)
     
-    logger.info(f"✅ 已加载自定义词典（保留默认词典）: {CUSTOM_DICT_PATH}")
-    logger.info(f"📊 词典统计: 总行数={line_count}, 空行={empty_lines}, 注释行={comment_lines}")
-    logger.info(f"✅ 自定义词条数: {len(custom_words)}")
-    logger.info(f"✅ jieba 总词条数: {len(jieba.dt.FREQ)}")
-    logger.info(f"✅ 自定义词示例（前10个）: {list(custom_words.keys())[:10]}")
-else:
-    logger.warning(f"⚠️ 自定义词典不存在: {CUSTOM_DICT_PATH}")
+        logger.info(f"✅ 已加载自定义词典（保留默认词典）: {CUSTOM_DICT_PATH}")
+        logger.info(f"📊 词典统计: 总行数={line_count}, 空行={empty_lines}, 注释行={comment_lines}")
+        logger.info(f"✅ 自定义词条数: {len(custom_words)}")
+        logger.info(f"✅ jieba 总词条数: {len(jieba.dt.FREQ)}")
+        logger.info(f"✅ 自定义词示例（前10个）: {list(custom_words.keys())[:10]}")
+    else:
+        logger.warning(f"⚠️ 自定义词典不存在: {CUSTOM_DICT_PATH}")
+
+
+# 分词缓存：语料分词结果依赖 jieba 版本和自定义词典，二者任一变化都使缓存整体失效
+_TOKEN_CACHE_FILE = "bm25_tokens.sqlite3"
+
+
+def _tokenizer_fingerprint() -> str:
+    """jieba 版本 + 自定义词典内容的指纹"""
+    digest = hashlib.blake2b(jieba.__version__.encode("utf-8"), digest_size=16)
+    if os.path.exists(CUSTOM_DICT_PATH):
+        with open(CUSTOM_DICT_PATH, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _content_hash(content: str) -> str:
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _open_token_cache() -> sqlite3.Connection:
+    os.makedirs(AppSettings.BM25_TOKEN_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(AppSettings.BM25_TOKEN_CACHE_DIR, _TOKEN_CACHE_FILE))
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tokens "
+        "(node_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, content_hash TEXT NOT NULL, tokens TEXT NOT NULL)"
+    )
+    return conn
+
+
+def _load_token_cache() -> Dict[str, Tuple[str, str]]:
+    """读取语料分词缓存 {node_id: (内容哈希, 分词结果)}；未配置或读取失败时返回空字典"""
+    if not AppSettings.BM25_TOKEN_CACHE_DIR:
+        return {}
+    try:
+        conn = _open_token_cache()
+        try:
+            rows = conn.execute(
+                "SELECT node_id, content_hash, tokens FROM tokens WHERE fingerprint = ?",
+                (_TOKENIZER_FINGERPRINT,)
+            ).fetchall()
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"BM25 分词缓存读取失败，将重新分词: {e}")
+        return {}
+    return {node_id: (content_hash, tokens) for node_id, content_hash, tokens in rows}
+
+
+def _save_token_cache(entries: List[Tuple[str, str, str]]) -> None:
+    """写入新分词的节点 [(node_id, 内容哈希, 分词结果)]，并清理旧词典版本的缓存"""
+    if not AppSettings.BM25_TOKEN_CACHE_DIR or not entries:
+        return
+    try:
+        conn = _open_token_cache()
+        try:
+            with conn:
+                conn.execute("DELETE FROM tokens WHERE fingerprint != ?", (_TOKENIZER_FINGERPRINT,))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tokens (node_id, fingerprint, content_hash, tokens) VALUES (?, ?, ?, ?)",
+                    [(node_id, _TOKENIZER_FINGERPRINT, content_hash, tokens) for node_id, content_hash, tokens in entries]
+                )
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"BM25 分词缓存写入失败: {e}")
+
+
+_TOKENIZER_FINGERPRINT = _tokenizer_fingerprint()
+
+# JSON 序列化的节点对象（元数据误入正文）的开头
+_JSON_NODE_PREFIXES = ('{"id_"', '{"class_name"')
+
+
+def _is_json_node(content_stripped: str) -> bool:
+    """判断内容是否是 JSON 序列化的节点对象；绝大多数正文不以 { 开头，只需一次前缀判断"""
+    if not content_stripped.startswith('{'):
+        return False
+    return (
+        content_stripped.startswith(_JSON_NODE_PREFIXES) or
+        ('"text":' in content_stripped and '"metadata":' in content_stripped)
+    )
+
+
+@lru_cache(maxsize=1024)
+def tokenize_query(query_str: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """
+    查询分词（同一查询重复检索时直接复用，如混合检索、子问题检索和评测）
+
+    Returns:
+        (原始分词, 停用词过滤后的关键词)
+    """
+    _ensure_jieba_ready()
+    all_keywords = tuple(jieba.lcut(query_str))
+    return all_keywords, tuple(keyword_ranker.filter_keywords(all_keywords))
+
+
+# 混合检索共用线程池：向量检索（Qdrant 网络 I/O）在池中执行，与调用线程上的 BM25 检索重叠
+_RETRIEVE_POOL = ThreadPoolExecutor(
+    max_workers=AppSettings.HYBRID_RETRIEVE_WORKERS,
+    thread_name_prefix="hybrid_retrieve"
+)
 
 
 class CleanBM25Retriever(BaseRetriever):
     """清理后的 BM25 检索器（使用 jieba 分词）"""
 
     def __init__(self, nodes: List[TextNode], similarity_top_k: int = 2):
-        self._id_to_original_node = {node.node_id: node for node in nodes}
-
-        # 使用 jieba 分词，并过滤异常节点
+        # 使用 jieba 分词，并过滤异常节点（内容未变的节点直接复用磁盘缓存的分词结果）
+        # 服务启动建索引时完成 jieba 初始化，首个查询无需再承担
+        _ensure_jieba_ready()
         tokenized_corpus = []
         valid_nodes = []
+        valid_contents = []
+        token_cache = _load_token_cache()
+        new_tokens = []
         
         for node in nodes:
             # 获取节点内容
             content = node.get_content() if hasattr(node, 'get_content') else (node.text or "")
             
             # 验证内容是否有效（不是JSON格式的元数据）
-            # 检查是否是 JSON 序列化的节点对象
-            content_stripped = content.strip()
-            is_json_node = (
-                content_stripped.startswith('{"id_"') or 
-                content_stripped.startswith('{"class_name"') or
-                (content_stripped.startswith('{') and '"text":' in content_stripped and '"metadata":' in content_stripped)
-            )
-            
-            if not content or is_json_node:
+            if not content or _is_json_node(content.strip()):
                 logger.warning(f"跳过异常节点 {node.node_id[:8]}...: 内容为空或为元数据格式")
-                logger.debug(f"  内容预览: {content[:100]}...")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"  内容预览: {content[:100]}...")
                 continue
             
-            # 分词，过滤单字即可（保证索引完整性）
-            all_tokens = jieba.lcut(content)
-            filtered_tokens = [token for token in all_tokens if len(token) > 1]
-            tokenized_text = " ".join(filtered_tokens)
-            
-            # 调试：记录第一个节点的分词情况
-            if len(valid_nodes) == 0:
-                logger.info(f"[BM25索引构建-示例] 原始tokens数: {len(all_tokens)}, 过滤后: {len(filtered_tokens)}")
-                logger.info(f"[BM25索引构建-示例] 过滤后tokens示例: {filtered_tokens[:20]}")  # 只显示前20个
+            content_hash = _content_hash(content)
+            cached = token_cache.get(node.node_id)
+            if cached is not None and cached[0] == content_hash:
+                tokenized_text = cached[1]
+            else:
+                # 分词，过滤单字即可（保证索引完整性）
+                all_tokens = jieba.lcut(content)
+                filtered_tokens = [token for token in all_tokens if len(token) > 1]
+                tokenized_text = " ".join(filtered_tokens)
+                new_tokens.append((node.node_id, content_hash, tokenized_text))
+
+                # 调试：记录第一个节点的分词情况
+                if len(valid_nodes) == 0:
+                    logger.info(f"[BM25索引构建-示例] 原始tokens数: {len(all_tokens)}, 过滤后: {len(filtered_tokens)}")
+                    logger.info(f"[BM25索引构建-示例] 过滤后tokens示例: {filtered_tokens[:20]}")  # 只显示前20个
             
             tokenized_corpus.append(tokenized_text)
             valid_nodes.append(node)
-        
-        # 更新映射，只包含有效节点
-        self._id_to_original_node = {node.node_id: node for node in valid_nodes}
+            valid_contents.append(content)
         
         logger.info(f"BM25检索器初始化: 总节点{len(nodes)}个, 有效节点{len(valid_nodes)}个, 跳过{len(nodes)-len(valid_nodes)}个异常节点")
+        if token_cache:
+            logger.info(f"BM25 分词缓存: 复用 {len(valid_nodes) - len(new_tokens)} 个, 新分词 {len(new_tokens)} 个")
+        _save_token_cache(new_tokens)
         
         # 检查是否有有效节点
         if len(valid_nodes) == 0:
@@ -127,33 +256,32 @@ class CleanBM25Retriever(BaseRetriever):
             logger.error("请检查 Qdrant 中的数据是否正确，可能需要重建索引")
             raise ValueError(f"BM25检索器初始化失败: {len(nodes)}个节点全部无效，请重建知识库索引")
         
-        tokenized_docs = [
-            Document(text=text, id_=node.id_)
-            for text, node in zip(tokenized_corpus, valid_nodes)
-        ]
-
-        self._bm25_retriever = OfficialBM25(
-            nodes=tokenized_docs,
-            similarity_top_k=similarity_top_k
+        # 直接使用 bm25s 建索引，分词参数与 llama-index BM25Retriever 相同（英文停用词 + 英文词干，
+        # 对中文分词结果只影响其中的英文词），打分与原实现一致；检索结果按下标对应 valid_nodes，
+        # 省去 Document 包装和每次检索时的节点反序列化；节点内容同样按下标缓存，供关键词匹配直接使用
+        self._nodes = valid_nodes
+        self._contents = valid_contents
+        self._similarity_top_k = similarity_top_k
+        self._stemmer = Stemmer.Stemmer("english")
+        self._bm25 = bm25s.BM25()
+        self._bm25.index(
+            bm25s.tokenize(tokenized_corpus, stopwords="en", stemmer=self._stemmer, show_progress=False),
+            show_progress=False
         )
         super().__init__()
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """执行检索"""
-        # 对查询进行分词
-        all_keywords = jieba.lcut(query_bundle.query_str)
-        
-        # 检索阶段：使用停用词过滤
-        query_keywords_for_retrieval = keyword_ranker.filter_keywords(all_keywords)
-        
-     
+        # 对查询进行分词，检索阶段使用停用词过滤（结果按查询缓存）
+        all_keywords, filtered_keywords = tokenize_query(query_bundle.query_str)
+        query_keywords_for_retrieval = list(filtered_keywords)
         
         # ⭐ 新增：检查是否过度过滤
         if len(query_keywords_for_retrieval) == 0:
             logger.warning(
                 f"[BM25检索-警告] 停用词过滤后查询为空！\n"
                 f"  原始查询: {query_bundle.query_str}\n"
-                f"  原始分词: {all_keywords}\n"
+                f"  原始分词: {list(all_keywords)}\n"
                 f"  建议: 检查停用词表或使用原始分词"
             )
             # 回退到原始分词（只过滤单字）
@@ -161,43 +289,42 @@ class CleanBM25Retriever(BaseRetriever):
           
         
         tokenized_query = " ".join(query_keywords_for_retrieval)
-        tokenized_bundle = QueryBundle(query_str=tokenized_query)
 
         # 检索
-        retrieved_nodes = self._bm25_retriever.retrieve(tokenized_bundle)
+        indexes, scores = self._bm25.retrieve(
+            bm25s.tokenize(tokenized_query, stemmer=self._stemmer, show_progress=False),
+            k=min(self._similarity_top_k, len(self._nodes)),
+            show_progress=False
+        )
+        retrieved = [(int(idx), float(score)) for idx, score in zip(indexes[0], scores[0])]
         
         # ⭐ 新增：记录检索结果分数
-        if retrieved_nodes:
-            bm25_scores = [f"{n.score:.4f}" for n in retrieved_nodes[:5]]
-            logger.info(f"[BM25检索-结果] 返回 {len(retrieved_nodes)} 个节点 | Top5分数: {', '.join(bm25_scores)}")
-        else:
+        if not retrieved:
             logger.warning(f"[BM25检索-结果] 未找到任何匹配节点")
+        elif logger.isEnabledFor(logging.INFO):
+            bm25_scores = [f"{score:.4f}" for _, score in retrieved[:5]]
+            logger.info(f"[BM25检索-结果] 返回 {len(retrieved)} 个节点 | Top5分数: {', '.join(bm25_scores)}")
 
-        # 替换回原始节点，并添加匹配关键词信息
+        # 添加匹配关键词信息
         clean_nodes = []
-        for node_with_score in retrieved_nodes:
-            original_node = self._id_to_original_node.get(
-                node_with_score.node.node_id
+        for idx, score in retrieved:
+            original_node = self._nodes[idx]
+            # 找出文档中匹配的关键词：候选为停用词过滤后的查询关键词（每个查询只过滤一次，
+            # 等价于先匹配全部检索关键词再逐个结果过滤停用词）
+            doc_content = self._contents[idx]
+            matched_keywords = [kw for kw in filtered_keywords if kw in doc_content]
+            
+            # 将匹配的关键词添加到节点元数据（原始节点在并发查询间共享，只写入本次查询的浅拷贝）
+            result_node = original_node.copy(update={"metadata": {
+                **original_node.metadata,
+                'bm25_matched_keywords': matched_keywords,
+                'bm25_query_keywords': query_keywords_for_retrieval,
+                'bm25_relevance_score': score,
+            }})
+            
+            clean_nodes.append(
+                NodeWithScore(node=result_node, score=score)
             )
-            if original_node:
-                # 找出文档中匹配的关键词（使用所有检索关键词）
-                doc_content = original_node.get_content() if hasattr(original_node, 'get_content') else (original_node.text or "")
-                matched_keywords_raw = [kw for kw in query_keywords_for_retrieval if kw in doc_content]
-                
-                # 使用 keyword_ranker 过滤停用词（黑名单）
-                matched_keywords = keyword_ranker.filter_keywords(matched_keywords_raw)
-                
-                
-                # 将匹配的关键词添加到节点元数据
-                original_node.metadata['bm25_matched_keywords'] = matched_keywords
-                original_node.metadata['bm25_query_keywords'] = query_keywords_for_retrieval
-                
-                # Add a new metadata field 'bm25_relevance_score'
-                original_node.metadata['bm25_relevance_score'] = node_with_score.score
-                
-                clean_nodes.append(
-                    NodeWithScore(node=original_node, score=node_with_score.score)
-                )
 
         return clean_nodes
 
@@ -230,100 +357,88 @@ class HybridRetriever(BaseRetriever):
         Returns:
             融合后的检索结果
         """
-        # 1. 分别执行两种检索
-        automerging_nodes = self._automerging.retrieve(query_bundle)
+        # 1. 两种检索相互独立：向量检索提交到线程池，BM25 在当前线程同时执行
+        vector_future = _RETRIEVE_POOL.submit(self._automerging.retrieve, query_bundle)
         bm25_nodes = self._bm25.retrieve(query_bundle)
+        automerging_nodes = vector_future.result()
         
         #  新增：记录向量检索结果
-        if automerging_nodes:
-            vector_scores_display = [f"{n.score:.4f}" for n in automerging_nodes[:5]]
-        else:
+        if not automerging_nodes:
             logger.warning(f"[向量检索-结果] 未找到任何匹配节点")
 
-        # 2. 收集所有唯一节点
-        all_nodes = {n.node.node_id: n.node for n in automerging_nodes}
-        all_nodes.update({n.node.node_id: n.node for n in bm25_nodes})
+        # 2. 收集所有唯一节点（同一节点保留首次出现的位置，节点对象以 BM25 结果为准）
+        all_nodes = {n.node.node_id: n.node for n in chain(automerging_nodes, bm25_nodes)}
 
-        # 3. 计算排名和原始分数
-        vector_ranks = {
-            node.node.node_id: rank
+        # 3. 计算排名和原始分数：(排名, 分数)
+        vector_info = {
+            node.node.node_id: (rank, node.score)
             for rank, node in enumerate(automerging_nodes, 1)
         }
-        bm25_ranks = {
-            node.node.node_id: rank
+        bm25_info = {
+            node.node.node_id: (rank, node.score)
             for rank, node in enumerate(bm25_nodes, 1)
         }
-        vector_scores = {n.node.node_id: n.score for n in automerging_nodes}
-        bm25_scores = {n.node.node_id: n.score for n in bm25_nodes}
 
-        # 4. 计算加权 RRF 分数
-        fused_scores = {}
+        # 4. 计算加权 RRF 分数（按 all_nodes 顺序排成数组，一次数组运算得到整列分数）
         #  修复1: 降低向量分数阈值，避免过度过滤（从 0.01 降到 0.001）
         vector_score_threshold = 0.001  # 向量分数阈值，低于此值视为无效
-        bm25_only_count = 0  # 统计纯BM25结果数量
-        
-        for node_id in all_nodes:
-            score = 0.0
-            vector_score = vector_scores.get(node_id, 0.0)
-            bm25_score = bm25_scores.get(node_id, 0.0)
-            
-            # 判断向量检索是否有效（分数 > 阈值）
-            vector_valid = node_id in vector_ranks and vector_score > vector_score_threshold
-            bm25_valid = node_id in bm25_ranks
-            
-            #  修复2: 改进纯BM25结果的分数计算，使用 RRF 而非原始分数
-            if not vector_valid and bm25_valid:
-                # 纯BM25结果：使用 RRF 公式计算，确保分数在合理范围
-                # 使用 BM25 排名计算 RRF 分数，并乘以权重
-                score = self._bm25_weight * (1.0 / (self._rrf_k + bm25_ranks[node_id]))
-                # 添加一个基础分数，避免分数过低
-                score = max(score, bm25_score * 0.1)  # 至少保留 BM25 分数的 10%
-                bm25_only_count += 1
-            else:
-                # 标准RRF融合
-                if vector_valid:
-                    score += self._vector_weight * (1.0 / (self._rrf_k + vector_ranks[node_id]))
-                if bm25_valid:
-                    score += self._bm25_weight * (1.0 / (self._rrf_k + bm25_ranks[node_id]))
-            
-            fused_scores[node_id] = score
+        node_ids = list(all_nodes)
+        # 排名 0 表示未被该路检索命中
+        missing = (0, 0.0)
+        vector_rank_arr, vector_score_arr = np.array(
+            [vector_info.get(i, missing) for i in node_ids], dtype=np.float64
+        ).reshape(-1, 2).T
+        bm25_rank_arr, bm25_score_arr = np.array(
+            [bm25_info.get(i, missing) for i in node_ids], dtype=np.float64
+        ).reshape(-1, 2).T
+
+        # 判断向量检索是否有效（分数 > 阈值）
+        vector_valid = (vector_rank_arr > 0) & (vector_score_arr > vector_score_threshold)
+        bm25_valid = bm25_rank_arr > 0
+        vector_rrf = np.where(vector_valid, self._vector_weight * (1.0 / (self._rrf_k + vector_rank_arr)), 0.0)
+        bm25_rrf = np.where(bm25_valid, self._bm25_weight * (1.0 / (self._rrf_k + bm25_rank_arr)), 0.0)
+
+        #  修复2: 改进纯BM25结果的分数计算，使用 RRF 而非原始分数
+        # 纯BM25结果：使用 BM25 排名计算 RRF 分数，并至少保留 BM25 分数的 10%，避免分数过低
+        bm25_only = bm25_valid & ~vector_valid
+        fused_score_arr = np.where(bm25_only, np.maximum(bm25_rrf, bm25_score_arr * 0.1), vector_rrf + bm25_rrf)
+        bm25_only_count = int(bm25_only.sum())  # 统计纯BM25结果数量
         
         # 记录纯BM25结果统计
-        if bm25_only_count > 0:
+        if bm25_only_count > 0 and logger.isEnabledFor(logging.INFO):
             logger.info(
                 f"[RRF融合] 检测到 {bm25_only_count} 个纯BM25结果（向量分数 < {vector_score_threshold}），"
                 f"使用改进的 RRF 分数计算"
             )
 
-        # 5. 构建结果并附加元数据
+        # 5. 按 RRF 分数降序构建结果并附加元数据（稳定排序，同分保持原顺序）
         fused_results = []
-        for node_id, score in fused_scores.items():
+        for i in np.argsort(-fused_score_arr, kind="stable").tolist():
+            node_id = node_ids[i]
+            score = float(fused_score_arr[i])
             node_obj = all_nodes[node_id]
-            vector_rank = vector_ranks.get(node_id)
-            bm25_rank = bm25_ranks.get(node_id)
+            vector_rank, vector_score = vector_info.get(node_id, (None, 0.0))
+            bm25_rank, bm25_score = bm25_info.get(node_id, (None, 0.0))
             sources = []
             if vector_rank is not None:
                 sources.append("vector")
             if bm25_rank is not None:
                 sources.append("keyword")
 
-            node_obj.metadata['vector_score'] = vector_scores.get(node_id, 0.0)
-            node_obj.metadata['bm25_score'] = bm25_scores.get(node_id, 0.0)
-            node_obj.metadata['vector_rank'] = vector_rank
-            node_obj.metadata['bm25_rank'] = bm25_rank
-            node_obj.metadata['retrieval_sources'] = sources
-            node_obj.metadata['initial_score'] = score
+            # 检索到的节点可能来自共享的文档存储/BM25 映射，分数写入本次查询的浅拷贝，避免并发查询互相覆盖
+            node_obj = node_obj.copy(update={"metadata": {
+                **node_obj.metadata,
+                'vector_score': vector_score,
+                'bm25_score': bm25_score,
+                'vector_rank': vector_rank,
+                'bm25_rank': bm25_rank,
+                'retrieval_sources': sources,
+                'initial_score': score,
+            }})
 
             fused_results.append(NodeWithScore(node=node_obj, score=score))
 
-        # 6. 按 RRF 分数降序排序
-        sorted_results = sorted(
-            fused_results,
-            key=lambda x: x.score,
-            reverse=True
-        )
-
-        return sorted_results
+        return fused_results
 
 
 class RetrieverFactory:
@@ -366,7 +481,6 @@ class RetrieverFactory:
         )
 
         # 混合检索器（使用配置的权重）
-        from config.settings import Settings as AppSettings
         return HybridRetriever(
             automerging_retriever, 
             bm25_retriever,
@@ -4,11 +4,15 @@
 将复杂查询分解为多个子问题，并整合检索结果
 使用LlamaIndex原生SubQuestionQueryEngine
 """
+import hashlib
+import heapq
 import json
 import re
+import threading
 import time
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
 from llama_index.core.query_engine import SubQuestionQueryEngine
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from llama_index.core import QueryBundle
@@ -17,17 +21,190 @@ from config.settings import Settings as AppSettings
 from prompts import (
     get_subquestion_decomposition_system,
     get_subquestion_decomposition_user,
+    get_subquestion_force_decomposition_system,
+    get_subquestion_force_decomposition_user,
+    get_sub_answer_generation_system,
+    get_sub_answer_generation_user,
     get_subquestion_synthesis_system,
     get_subquestion_synthesis_user,
     get_history_compression_system,
     get_history_compression_user
 )
 
+try:
+    # orjson 为可选依赖（C 实现，解析更快），未安装时回退到标准库
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 实体分隔符（逗号、顿号、"和"、"以及"等），按单字计数
+_ENTITY_INDICATOR_CHARS = "，、和以及与"
+# LLM 响应中的 JSON 片段
+_NEED_DECOMPOSE_JSON_RE = re.compile(r'\{[^{}]*"need_decompose"[^{}]*\}', re.DOTALL)
+_SUB_QUESTIONS_JSON_RE = re.compile(r'\{[^{}]*"sub_questions"[^{}]*\}', re.DOTALL)
+# 按行解析子问题时去除的序号和列表标记
+_LINE_NUMBER_RE = re.compile(r'^\d+[\.\)、]\s*')
+_LINE_BULLET_RE = re.compile(r'^[-*]\s*')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# 近似重复子问题判定：归一化后字符 3-gram 的 Jaccard 相似度阈值
+_SUB_QUESTION_DUP_JACCARD = 0.9
+# 字母数字标记（签证类型、数字等），不同则不视为近似重复
+_ASCII_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# 历史压缩摘要缓存（进程内 LRU）：多轮对话中相同的历史片段不再重复调用 LLM 压缩
+_HISTORY_SUMMARY_CACHE_MAX_SIZE = 256
+_history_summary_cache: "OrderedDict[str, str]" = OrderedDict()
+_history_summary_cache_lock = threading.Lock()
+
+
+def _history_summary_cache_key(llm_id: str, user_prompt: str) -> str:
+    """计算 (模型, 历史压缩提示词) 的缓存键"""
+    raw = f"{llm_id}\x00{user_prompt}".encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _history_summary_cache_get(key: str) -> Optional[str]:
+    with _history_summary_cache_lock:
+        summary = _history_summary_cache.get(key)
+        if summary is not None:
+            _history_summary_cache.move_to_end(key)
+        return summary
+
+
+def _history_summary_cache_put(key: str, summary: str) -> None:
+    with _history_summary_cache_lock:
+        _history_summary_cache[key] = summary
+        _history_summary_cache.move_to_end(key)
+        while len(_history_summary_cache) > _HISTORY_SUMMARY_CACHE_MAX_SIZE:
+            _history_summary_cache.popitem(last=False)
+
+
+# 查询向量缓存（进程内 LRU）：相同查询文本（回退检索、重复提问、重复子问题）不再重复编码
+# 键包含嵌入模型名称，更换嵌入模型后旧向量不会被复用
+_QUERY_EMBEDDING_CACHE_MAX_SIZE = 1024
+_query_embedding_cache: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+_query_embedding_cache_lock = threading.Lock()
+
+
+def _query_bundle(query: str, embed_model=None) -> QueryBundle:
+    """构造带预计算向量的 QueryBundle，向量检索器发现 embedding 已设置时不会再次编码"""
+    if embed_model is None:
+        return QueryBundle(query)
+
+    key = (getattr(embed_model, "model_name", None) or type(embed_model).__name__, query)
+    with _query_embedding_cache_lock:
+        embedding = _query_embedding_cache.get(key)
+        if embedding is not None:
+            _query_embedding_cache.move_to_end(key)
+    if embedding is None:
+        # 使用查询编码（BGE 会拼接检索指令），与检索器内部的编码方式保持一致
+        embedding = embed_model.get_query_embedding(query)
+        with _query_embedding_cache_lock:
+            _query_embedding_cache[key] = embedding
+            _query_embedding_cache.move_to_end(key)
+            while len(_query_embedding_cache) > _QUERY_EMBEDDING_CACHE_MAX_SIZE:
+                _query_embedding_cache.popitem(last=False)
+    return QueryBundle(query_str=query, embedding=embedding)
+
+
+# 子问题答案生成超时（秒）
+_SUB_ANSWER_TIMEOUT = 15
+
+
+class _LLMCall:
+    """
+    提交到共用线程池的一次 LLM 调用
+
+    超时从调用开始执行时算起，在线程池中排队的时间不计入，
+    避免并发请求较多时调用尚未发出就被判定超时
+    """
+    __slots__ = ("future", "started", "started_at")
+
+    def __init__(self):
+        self.future: Optional[Future] = None
+        self.started = threading.Event()
+        self.started_at = 0.0
+
+    def mark_started(self) -> None:
+        self.started_at = time.monotonic()
+        self.started.set()
+
+    def result(self, timeout: float, queue_timeout: float) -> str:
+        """
+        等待调用结果
+
+        Args:
+            timeout: 调用执行超时（秒），从开始执行算起
+            queue_timeout: 最长排队时间（秒），超过后取消尚未开始的调用
+
+        Raises:
+            TimeoutError: 排队或执行超时
+        """
+        if not self.started.wait(timeout=queue_timeout):
+            self.future.cancel()
+            raise TimeoutError(f"LLM调用排队超时 ({queue_timeout:.1f}s)")
+        remaining = self.started_at + timeout - time.monotonic()
+        try:
+            return self.future.result(timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            # 已发出的请求由 HTTP 请求级超时断开，线程随之释放，不阻塞调用方
+            raise TimeoutError(f"LLM调用超时 ({timeout}s)")
+
+
+def _sub_question_signature(sub_question: str) -> Tuple[str, Tuple[str, ...], frozenset]:
+    """
+    子问题签名：(归一化文本, 字母数字标记, 字符 3-gram 集合)
+
+    归一化：去空白和句末标点、小写
+    """
+    key = _WHITESPACE_RE.sub('', str(sub_question).lower()).rstrip('?？。.!！')
+    ascii_tokens = tuple(_ASCII_TOKEN_RE.findall(key))
+    if len(key) < 3:
+        return key, ascii_tokens, frozenset((key,))
+    return key, ascii_tokens, frozenset(key[i:i + 3] for i in range(len(key) - 2))
+
+
+def _dedup_sub_questions(sub_questions: List[str]) -> List[str]:
+    """
+    去除重复或近似重复的子问题，保留首次出现的一条
+
+    近似重复仅在字母数字标记（如签证类型 X1/X2、J1/J2）完全一致时才判定，
+    避免把只差一个签证类型的对比类子问题合并掉
+    """
+    kept = []
+    kept_signatures = []
+    for sub_question in sub_questions:
+        key, ascii_tokens, ngrams = _sub_question_signature(sub_question)
+        duplicate_of = next(
+            (
+                kept[i] for i, (other_key, other_tokens, other_ngrams) in enumerate(kept_signatures)
+                if key == other_key or (
+                    ascii_tokens == other_tokens
+                    and len(ngrams & other_ngrams) >= _SUB_QUESTION_DUP_JACCARD * len(ngrams | other_ngrams)
+                )
+            ),
+            None
+        )
+        if duplicate_of is not None:
+            logger.info(f"[子问题分解] 去除重复子问题: {sub_question} | 保留: {duplicate_of}")
+            continue
+        kept.append(sub_question)
+        kept_signatures.append((key, ascii_tokens, ngrams))
+    return kept
+
+
+def _node_content(node, max_chars: int = 0) -> str:
+    """取节点正文，max_chars > 0 时只保留前 max_chars 个字符"""
+    content = node.node.get_content()
+    return content[:max_chars] if max_chars > 0 else content
+
 
 class SubQuestionDecomposer:
     """子问题分解器（基于LlamaIndex）"""
     
-    def __init__(self, llm_service, retriever, reranker, index=None):
+    def __init__(self, llm_service, retriever, reranker, index=None, embed_model=None):
         """
         初始化子问题分解器
         
@@ -36,10 +213,12 @@ class SubQuestionDecomposer:
             retriever: 检索器实例
             reranker: 重排序器实例
             index: VectorStoreIndex实例（用于创建QueryEngine）
+            embed_model: 嵌入模型（用于预计算并缓存查询向量，None 时由检索器自行编码）
         """
         self.llm_service = llm_service
         self.retriever = retriever
         self.reranker = reranker
+        self.embed_model = embed_model
         self.index = index
         self.enabled = AppSettings.ENABLE_SUBQUESTION_DECOMPOSITION
         self.engine_type = AppSettings.SUBQUESTION_ENGINE_TYPE  # custom 或 llamaindex
@@ -53,6 +232,28 @@ class SubQuestionDecomposer:
                 logger.warning(f"初始化SubQuestionQueryEngine失败: {e}，将回退到自定义流程")
                 self.engine_type = "custom"  # 回退到自定义模式
         
+        # 系统提示词运行期不变，初始化时拼接一次
+        self._sys_decomposition = "\n".join(get_subquestion_decomposition_system())
+        self._sys_force_decomposition = "\n".join(get_subquestion_force_decomposition_system())
+        self._sys_history_compression = "\n".join(get_history_compression_system())
+        self._sys_sub_answer = "\n".join(get_sub_answer_generation_system())
+        self._sys_synthesis = "\n".join(get_subquestion_synthesis_system())
+        
+        # 预检索线程池：分解 LLM 调用期间并行执行原查询的标准检索
+        self._retrieve_executor = ThreadPoolExecutor(
+            max_workers=AppSettings.SUBQUESTION_RETRIEVE_WORKERS,
+            thread_name_prefix="subquestion_retrieve"
+        )
+        # LLM 调用线程池：超时保护共用，避免每次调用创建/销毁线程池；
+        # 单个请求最多同时发出 MAX_DEPTH 个子答案调用，池大小按 并发请求数 × MAX_DEPTH 配置
+        llm_pool_size = AppSettings.SUBQUESTION_LLM_POOL_SIZE or (
+            AppSettings.SUBQUESTION_MAX_CONCURRENT_REQUESTS * max(AppSettings.SUBQUESTION_MAX_DEPTH, 1)
+        )
+        self._llm_executor = ThreadPoolExecutor(
+            max_workers=llm_pool_size,
+            thread_name_prefix="subquestion_llm"
+        )
+        
         # 健康度指标
         self.metrics = {
             'total_queries': 0,
@@ -122,7 +323,7 @@ class SubQuestionDecomposer:
         # 检查命名实体数量（简单启发式：检测关键词数量）
         if AppSettings.SUBQUESTION_ENABLE_ENTITY_CHECK:
             # 简单的实体检测：统计逗号、顿号、"和"、"以及"等分隔符
-            entity_indicators = len(re.findall(r'[，、和以及与及]', query))
+            entity_indicators = sum(map(query.count, _ENTITY_INDICATOR_CHARS))
             if entity_indicators < AppSettings.SUBQUESTION_MIN_ENTITIES:
                 logger.debug(f"实体数量不足，跳过分解 | 实体指标: {entity_indicators}")
                 return False
@@ -177,7 +378,7 @@ class SubQuestionDecomposer:
             logger.info(f"[子问题分解] 智能判断模式 | 查询: {query[:50]}...")
             
             # 构建提示词
-            system_prompt = "\n".join(get_subquestion_decomposition_system())
+            system_prompt = self._sys_decomposition
             user_prompt = get_subquestion_decomposition_user(query, conversation_summary)
             
             # 调用LLM进行分解
@@ -319,13 +520,30 @@ class SubQuestionDecomposer:
         Returns:
             (检索节点列表, 元数据字典)
         """
+        # 需要调用 LLM 分解时（秒级），可同时预先执行原查询的初始检索（不含重排序）：
+        # 无需分解或回退时直接复用，节省一次检索耗时；分解成功（该路径的常见情况）时检索结果被丢弃，
+        # 白白多一次向量 + BM25 检索。重排序（GPU）只在确定使用标准检索后执行，默认关闭
+        speculative = None
+        if AppSettings.SUBQUESTION_SPECULATIVE_RETRIEVAL and self.should_decompose(query):
+            speculative = self._retrieve_executor.submit(self._initial_retrieve, query, active_retriever)
+        
+        def standard_retrieve() -> List:
+            if speculative is not None:
+                return self._rerank(query, speculative.result(), rerank_top_n)
+            return self._standard_retrieve(query, rerank_top_n, active_retriever)
+        
         # 尝试分解
-        need_decompose, sub_questions = self.decompose_query(query, conversation_history)
+        try:
+            need_decompose, sub_questions = self.decompose_query(query, conversation_history)
+        except Exception:
+            if speculative is not None:
+                speculative.cancel()
+            raise
         
         # 如果不需要分解，使用标准检索
         if not need_decompose or not sub_questions:
             logger.info("[子问题检索] 使用标准检索流程")
-            nodes = self._standard_retrieve(query, rerank_top_n, active_retriever)
+            nodes = standard_retrieve()
             metadata = {
                 'decomposed': False,
                 'sub_questions': [],
@@ -346,7 +564,7 @@ class SubQuestionDecomposer:
                 f"空结果数: {empty_count}/{len(sub_results)}"
             )
             self.metrics['fallback_count'] += 1
-            nodes = self._standard_retrieve(query, rerank_top_n, active_retriever)
+            nodes = standard_retrieve()
             metadata = {
                 'decomposed': False,
                 'sub_questions': sub_questions,
@@ -355,6 +573,10 @@ class SubQuestionDecomposer:
             }
             return nodes, metadata
         
+        # 分解检索成功，预检索结果不再使用（已开始执行的无法取消）
+        if speculative is not None:
+            speculative.cancel()
+        
         # 合并子问题结果
         merged_nodes = self._merge_subquestion_results(sub_results, rerank_top_n)
         
@@ -362,15 +584,10 @@ class SubQuestionDecomposer:
         sub_answers = []
         logger.info(f"[子问题答案生成] 开始为 {len(sub_results)} 个子问题生成答案")
         
-        for result in sub_results:
+        generated_answers = self._generate_sub_answers(sub_results)
+        for result, sub_answer in zip(sub_results, generated_answers):
             if result['nodes']:
                 try:
-                    # 调用 LLM 生成答案
-                    sub_answer = self._generate_sub_answer(
-                        sub_question=result['sub_question'],
-                        nodes=result['nodes'][:3]  # 使用 top 3 节点作为上下文
-                    )
-                    
                     if sub_answer:
                         sub_answers.append({
                             'sub_question': result['sub_question'],
@@ -379,7 +596,7 @@ class SubQuestionDecomposer:
                         logger.info(f"[子问题答案] 生成成功: {result['sub_question'][:30]}... | 长度: {len(sub_answer)}")
                     else:
                         # LLM 返回空，使用检索片段
-                        fallback_answer = result['nodes'][0].node.get_content()[:200]
+                        fallback_answer = _node_content(result['nodes'][0], 200)
                         sub_answers.append({
                             'sub_question': result['sub_question'],
                             'answer': fallback_answer
@@ -389,7 +606,7 @@ class SubQuestionDecomposer:
                 except Exception as e:
                     logger.error(f"[子问题答案] 生成失败: {result['sub_question'][:30]}... | 错误: {e}")
                     # 回退到检索片段
-                    fallback_answer = result['nodes'][0].node.get_content()[:200]
+                    fallback_answer = _node_content(result['nodes'][0], 200)
                     sub_answers.append({
                         'sub_question': result['sub_question'],
                         'answer': fallback_answer
@@ -443,12 +660,21 @@ class SubQuestionDecomposer:
                 return ""
             
             # 构建提示词
-            system_prompt = "\n".join(get_history_compression_system())
+            system_prompt = self._sys_history_compression
             user_prompt = get_history_compression_user(truncated_history)
             
+            # 相同历史（提示词一致）直接复用已压缩的摘要
+            cache_key = _history_summary_cache_key(AppSettings.SUBQUESTION_DECOMP_LLM_ID, user_prompt)
+            summary = _history_summary_cache_get(cache_key)
+            if summary is not None:
+                logger.debug(f"[历史压缩] 命中摘要缓存 | 截断后轮数: {len(truncated_history)}")
+                return summary
+            
             # 调用LLM
             llm = self.llm_service.get_client(AppSettings.SUBQUESTION_DECOMP_LLM_ID)
             summary = self._call_llm_with_timeout(llm, system_prompt, user_prompt, timeout=5)
+            if summary:
+                _history_summary_cache_put(cache_key, summary)
             
             logger.debug(
                 f"[历史压缩] 压缩完成 | "
@@ -481,7 +707,7 @@ class SubQuestionDecomposer:
         truncated = []
         total_chars = 0
         
-        # 从最新的对话开始累加
+        # 从最新的对话开始累加（倒序追加，结束后整体反转一次）
         for turn in reversed(history):
             content = turn.get('content', '')
             turn_chars = len(content)
@@ -492,11 +718,12 @@ class SubQuestionDecomposer:
                 if remaining_chars > 50:  # 至少保留50字符
                     truncated_turn = turn.copy()
                     truncated_turn['content'] = content[:remaining_chars] + "..."
-                    truncated.insert(0, truncated_turn)
+                    truncated.append(truncated_turn)
                 break
             
-            truncated.insert(0, turn)
+            truncated.append(turn)
             total_chars += turn_chars
+        truncated.reverse()
         
         if len(truncated) < len(history):
             logger.debug(
@@ -520,9 +747,7 @@ class SubQuestionDecomposer:
         """
         try:
             # 使用强制分解提示词
-            from prompts import get_subquestion_force_decomposition_system, get_subquestion_force_decomposition_user
-            
-            system_prompt = "\n".join(get_subquestion_force_decomposition_system())
+            system_prompt = self._sys_force_decomposition
             user_prompt = get_subquestion_force_decomposition_user(query, conversation_summary)
             
             # 调用LLM
@@ -554,14 +779,14 @@ class SubQuestionDecomposer:
         """
         try:
             # 尝试提取JSON
-            json_match = re.search(r'\{[^{}]*"sub_questions"[^{}]*\}', response, re.DOTALL)
+            json_match = _SUB_QUESTIONS_JSON_RE.search(response)
             if json_match:
-                data = json.loads(json_match.group())
+                data = _json_loads(json_match.group())
                 sub_questions = data.get('sub_questions', [])
                 
-                # 过滤和验证
+                # 过滤、去重和验证
                 sub_questions = [q.strip() for q in sub_questions if q and len(q.strip()) > 5]
-                sub_questions = sub_questions[:AppSettings.SUBQUESTION_MAX_DEPTH]
+                sub_questions = _dedup_sub_questions(sub_questions)[:AppSettings.SUBQUESTION_MAX_DEPTH]
                 
                 return sub_questions
             
@@ -570,14 +795,12 @@ class SubQuestionDecomposer:
             sub_questions = []
             for line in lines:
                 # 移除序号和标记
-                line = re.sub(r'^\d+[\.\)、]\s*', '', line)
-                line = re.sub(r'^[-*]\s*', '', line)
+                line = _LINE_NUMBER_RE.sub('', line)
+                line = _LINE_BULLET_RE.sub('', line)
                 if len(line) > 5 and '?' in line or '？' in line:
                     sub_questions.append(line)
-                    if len(sub_questions) >= AppSettings.SUBQUESTION_MAX_DEPTH:
-                        break
             
-            return sub_questions
+            return _dedup_sub_questions(sub_questions)[:AppSettings.SUBQUESTION_MAX_DEPTH]
             
         except Exception as e:
             logger.error(f"[子问题分解] 解析强制分解响应失败: {e}")
@@ -602,23 +825,27 @@ class SubQuestionDecomposer:
         Returns:
             LLM响应文本
         """
-        from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+        # 排队时间单独限制为 timeout，执行超时从调用开始时算起
+        return self._submit_llm(llm, system_prompt, user_prompt, timeout).result(timeout, queue_timeout=timeout)
+    
+    def _submit_llm(self, llm, system_prompt: str, user_prompt: str, timeout: float) -> _LLMCall:
+        """提交LLM调用到共用线程池"""
         from llama_index.core.llms import ChatMessage, MessageRole
         
+        call = _LLMCall()
+        
         def _call():
+            call.mark_started()
             messages = [
                 ChatMessage(role=MessageRole.SYSTEM, content=system_prompt),
                 ChatMessage(role=MessageRole.USER, content=user_prompt)
             ]
-            response = llm.chat(messages)
+            # 同时设置 HTTP 请求级超时：调用方超时返回后，挂起的请求也会及时断开并释放线程
+            response = llm.chat(messages, timeout=timeout)
             return response.message.content
         
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(_call)
-            try:
-                return future.result(timeout=timeout)
-            except FutureTimeoutError:
-                raise TimeoutError(f"LLM调用超时 ({timeout}s)")
+        call.future = self._llm_executor.submit(_call)
+        return call
     
     def _parse_decomposition_response(self, response: str) -> Tuple[bool, List[str]]:
         """
@@ -632,15 +859,15 @@ class SubQuestionDecomposer:
         """
         try:
             # 尝试提取JSON
-            json_match = re.search(r'\{[^{}]*"need_decompose"[^{}]*\}', response, re.DOTALL)
+            json_match = _NEED_DECOMPOSE_JSON_RE.search(response)
             if json_match:
                 json_str = json_match.group(0)
-                data = json.loads(json_str)
+                data = _json_loads(json_str)
             else:
-                data = json.loads(response)
+                data = _json_loads(response)
             
             need_decompose = data.get('need_decompose', False)
-            sub_questions = data.get('sub_questions', [])
+            sub_questions = _dedup_sub_questions(data.get('sub_questions', []))
             
             # 限制子问题数量
             if len(sub_questions) > AppSettings.SUBQUESTION_MAX_DEPTH:
@@ -668,20 +895,21 @@ class SubQuestionDecomposer:
         Returns:
             检索节点列表
         """
-        from llama_index.core import QueryBundle
-        
+        return self._rerank(query, self._initial_retrieve(query, retriever), rerank_top_n)
+    
+    def _initial_retrieve(self, query: str, retriever=None) -> List:
+        """标准检索的初始检索阶段（向量 + BM25，不含重排序）"""
         # 使用传入的retriever或默认retriever
         active_retriever = retriever if retriever is not None else self.retriever
-        
-        # 初始检索
-        retrieved_nodes = active_retriever.retrieve(query)
-        
-        # 重排序
+        return active_retriever.retrieve(_query_bundle(query, self.embed_model))
+    
+    def _rerank(self, query: str, retrieved_nodes: List, rerank_top_n: int) -> List:
+        """标准检索的重排序阶段"""
         reranker_input = retrieved_nodes[:AppSettings.RERANKER_INPUT_TOP_N]
         if reranker_input:
             reranked_nodes = self.reranker.postprocess_nodes(
                 reranker_input,
-                query_bundle=QueryBundle(query)
+                query_bundle=_query_bundle(query, self.embed_model)
             )
             return reranked_nodes[:rerank_top_n]
         
@@ -704,33 +932,32 @@ class SubQuestionDecomposer:
         Returns:
             子问题检索结果列表
         """
-        results = []
+        # 结果按子问题原始顺序就位写入，无需事后排序
+        results = [None] * len(sub_questions)
         
         # 使用线程池并行检索
         with ThreadPoolExecutor(max_workers=min(len(sub_questions), 3)) as executor:
             futures = {
-                executor.submit(self._retrieve_single_subquestion, sq, rerank_top_n, retriever): sq
-                for sq in sub_questions
+                executor.submit(self._retrieve_single_subquestion, sq, rerank_top_n, retriever): (i, sq)
+                for i, sq in enumerate(sub_questions)
             }
             
             for future in as_completed(futures):
-                sub_q = futures[future]
+                i, sub_q = futures[future]
                 try:
                     nodes = future.result()
-                    results.append({
+                    results[i] = {
                         'sub_question': sub_q,
                         'nodes': nodes
-                    })
+                    }
                     logger.debug(f"[子问题检索] 完成: {sub_q} | 节点数: {len(nodes)}")
                 except Exception as e:
                     logger.error(f"[子问题检索] 失败: {sub_q} | 错误: {e}")
-                    results.append({
+                    results[i] = {
                         'sub_question': sub_q,
                         'nodes': []
-                    })
+                    }
         
-        # 按原始顺序排序
-        results.sort(key=lambda x: sub_questions.index(x['sub_question']))
         return results
     
     def _retrieve_single_subquestion(self, sub_question: str, rerank_top_n: int, retriever=None) -> List:
@@ -762,82 +989,103 @@ class SubQuestionDecomposer:
         Returns:
             合并后的节点列表
         """
-        all_nodes = []
-        seen_ids = set()
-        
-        # 收集所有节点，去重
+        # 收集所有节点，去重：同一节点被多个子问题检索到时保留分数最高的一份
+        best: Dict[str, Tuple[Any, str]] = {}
         for result in sub_results:
             for node in result['nodes']:
                 node_id = node.node.node_id
-                if node_id not in seen_ids:
-                    seen_ids.add(node_id)
-                    # 添加子问题标记
-                    node.node.metadata['sub_question'] = result['sub_question']
-                    all_nodes.append(node)
-        
-        # 按分数排序
-        all_nodes.sort(key=lambda x: x.score, reverse=True)
-        
-        # 过滤低分节点
-        filtered_nodes = [
-            n for n in all_nodes 
-            if n.score >= AppSettings.SUBQUESTION_MIN_SCORE
+                kept = best.get(node_id)
+                if kept is None or node.score > kept[0].score:
+                    best[node_id] = (node, result['sub_question'])
+        
+        # 过滤低分节点，按分数取前 N（与完整排序后截断等价，同分保持先出现的顺序）
+        filtered = [
+            entry for entry in best.values()
+            if entry[0].score >= AppSettings.SUBQUESTION_MIN_SCORE
         ]
+        top_entries = heapq.nlargest(final_top_n, filtered, key=lambda entry: entry[0].score)
+        
+        # 添加子问题标记（只标记最终返回的节点）
+        merged_nodes = []
+        for node, sub_question in top_entries:
+            node.node.metadata['sub_question'] = sub_question
+            merged_nodes.append(node)
         
         logger.info(
-            f"[结果合并] 总节点: {len(all_nodes)} | "
-            f"过滤后: {len(filtered_nodes)} | "
-            f"返回: {min(len(filtered_nodes), final_top_n)}"
+            f"[结果合并] 总节点: {len(best)} | "
+            f"过滤后: {len(filtered)} | "
+            f"返回: {len(merged_nodes)}"
         )
         
-        return filtered_nodes[:final_top_n]
+        return merged_nodes
+    
+    def _generate_sub_answers(self, sub_results: List[Dict]) -> List[str]:
+        """
+        为各子问题并行生成答案（基于检索上下文）
+        
+        所有子问题的 LLM 调用同时提交到共用线程池，按原始顺序收集，
+        总耗时约为最慢的一次调用而非各次之和
+        
+        Args:
+            sub_results: 子问题检索结果列表
+            
+        Returns:
+            与 sub_results 一一对应的答案列表（无节点、超时或失败时为空字符串）
+        """
+        # 各子问题同时提交：排队共用同一截止时间，执行超时各自从开始执行时算起
+        calls = [self._submit_sub_answer(r['sub_question'], r['nodes'][:3]) for r in sub_results]
+        queue_deadline = time.monotonic() + _SUB_ANSWER_TIMEOUT
+        
+        answers = []
+        for result, call in zip(sub_results, calls):
+            if call is None:
+                answers.append("")
+                continue
+            try:
+                answer = call.result(_SUB_ANSWER_TIMEOUT, queue_timeout=max(queue_deadline - time.monotonic(), 0))
+                answers.append(answer.strip())
+            except TimeoutError:
+                logger.warning(f"[子问题答案] 生成超时: {result['sub_question'][:50]}...")
+                answers.append("")
+            except Exception as e:
+                logger.error(f"[子问题答案] 生成失败: {e}")
+                answers.append("")
+        return answers
     
-    def _generate_sub_answer(self, sub_question: str, nodes: List) -> str:
+    def _submit_sub_answer(self, sub_question: str, nodes: List) -> Optional[_LLMCall]:
         """
-        为单个子问题生成答案（基于检索上下文）
+        构建单个子问题的答案生成提示词并提交 LLM 调用
         
         Args:
             sub_question: 子问题
             nodes: 检索到的节点列表
             
         Returns:
-            LLM 生成的答案
+            已提交的 LLM 调用（无节点或构建失败时为 None）
         """
         if not nodes:
-            return ""
+            return None
         
         try:
             # 构建上下文
             context_parts = []
             for i, node in enumerate(nodes[:3], 1):
-                content = node.node.get_content()
+                content = _node_content(node, AppSettings.SUBQUESTION_CONTEXT_MAX_CHARS)
                 context_parts.append(f"[参考资料{i}]\n{content}\n")
             
             context = "\n".join(context_parts)
             
             # 构建提示词
-            from prompts import get_sub_answer_generation_system, get_sub_answer_generation_user
-            
-            system_prompt = "\n".join(get_sub_answer_generation_system())
+            system_prompt = self._sys_sub_answer
             user_prompt = get_sub_answer_generation_user(sub_question, context)
             
-            # 调用 LLM（使用较短超时）
+            # 提交 LLM 调用（超时由 _generate_sub_answers 统一控制）
             llm = self.llm_service.get_client(AppSettings.SUBQUESTION_DECOMP_LLM_ID)
-            answer = self._call_llm_with_timeout(
-                llm,
-                system_prompt,
-                user_prompt,
-                timeout=15  # 15秒超时
-            )
-            
-            return answer.strip()
+            return self._submit_llm(llm, system_prompt, user_prompt, _SUB_ANSWER_TIMEOUT)
             
-        except TimeoutError:
-            logger.warning(f"[子问题答案] 生成超时: {sub_question[:50]}...")
-            return ""
         except Exception as e:
             logger.error(f"[子问题答案] 生成失败: {e}")
-            return ""
+            return None
     
     def synthesize_answer(self, original_query: str, sub_answers: List[Dict]) -> str:
         """
@@ -855,7 +1103,7 @@ class SubQuestionDecomposer:
         
         try:
             # 构建提示词
-            system_prompt = "\n".join(get_subquestion_synthesis_system())
+            system_prompt = self._sys_synthesis
             user_prompt = get_subquestion_synthesis_user(original_query, sub_answers)
             
             # 调用LLM合成答案
@@ -912,3 +1160,8 @@ class SubQuestionDecomposer:
             f"超时: {metrics['timeout_count']} | "
             f"错误: {metrics['error_count']}"
         )
+    
+    def close(self) -> None:
+        """关闭常驻线程池，取消尚未开始的检索与 LLM 调用"""
+        self._llm_executor.shutdown(wait=False, cancel_futures=True)
+        self._retrieve_executor.shutdown(wait=False, cancel_futures=True)
@@ -4,6 +4,7 @@ Prompt 配置文件（函数式写法）
 所有的提示词模板都定义在这里
 支持函数式和字典式两种访问方式
 """
+from functools import lru_cache
 
 
 # ==================== Judge Option Prompts ====================
@@ -374,6 +375,7 @@ def HyDE_prompt():
 
 
 # ==================== InsertBlock Prompts ====================
+@lru_cache(maxsize=1)
 def get_insertblock_system_all():
     """InsertBlock系统提示词"""
     return [
@@ -383,6 +385,7 @@ def get_insertblock_system_all():
     ]
 
 
+@lru_cache(maxsize=1)
 def get_insertblock_user_all():
     """InsertBlock用户提示词"""
     return [
@@ -421,6 +424,63 @@ def get_insertblock_user_all():
     ]
 
 
+@lru_cache(maxsize=1)
+def get_insertblock_batch_system_all():
+    """InsertBlock多片段联合判定系统提示词（不含占位符，可被服务端前缀缓存复用）"""
+    return [
+        "# 角色\n你是一位精通中国出入境边防检查各项业务的专家，具备强大的信息提炼和逻辑推理能力。",
+        "",
+        "# 任务\n你的任务是接收一个业务场景下的\"问题\"和若干条带编号的\"法规片段\"。请你基于专业的判断，对每一条法规片段分别完成以下分析：",
+        "1.  判断该法规片段是否与问题直接相关。",
+        "2.  判断能否依据此法规片段为问题提供一个明确的答案。",
+        "3.  如果能提供答案，请从该法规片段原文中，提炼出能够直接支持答案的、最核心、最精简的文字作为关键段落。",
+        "",
+        "# 输出要求\n请严格按照以下JSON格式返回你的分析结果，每条法规片段对应 results 中的一项，不要添加任何额外的解释或说明。",
+        "",
+        "```json",
+        "{",
+        "  \"results\": [",
+        "    {",
+        "      \"index\": <法规片段编号>,",
+        "      \"is_relevant\": <布尔值>,",
+        "      \"can_answer\": <布尔值>,",
+        "      \"reasoning\": \"<字符串>\",",
+        "      \"answer\": \"<字符串>\",",
+        "      \"key_passage\": \"<字符串 | null>\"",
+        "    }",
+        "  ]",
+        "}",
+        "```",
+        "",
+        "# 字段说明",
+        "- `index`: 整数。对应输入中\"法规片段 N\"的编号 N。",
+        "- `is_relevant`: 布尔值。该法规片段是否与问题所描述的场景相关。",
+        "- `can_answer`: 布尔值。该法规片段是否提供了足够的信息来完整地、确定地回答这个问题。如果 `is_relevant` 为 `false`，则此项也应为 `false`。",
+        "- `reasoning`: 字符串。**必须根据当前问题和该法规片段的实际内容**，用一句话简要说明判断的核心理由。",
+        "- `answer`: 字符串。能回答时直接回答用户的问题；不能回答时说明原因。",
+        "- `key_passage`: 字符串或null。能回答时从该法规片段原文中**一字不差地**提取最关键的一句话或一个片段，否则为 `null`。",
+        "",
+        "# 注意事项",
+        "- 每条法规片段必须独立判断，results 必须覆盖输入中的全部编号。",
+        "- 确保输出的是有效的 JSON 格式，不要添加任何多余的文字。"
+    ]
+
+
+@lru_cache(maxsize=1)
+def get_insertblock_batch_user_all():
+    """InsertBlock多片段联合判定用户提示词"""
+    return [
+        "# 输入\n- **问题**: {question}",
+        "",
+        "{regulations_block}"
+    ]
+
+
+def get_insertblock_batch_regulation():
+    """InsertBlock多片段联合判定中单条法规片段的格式"""
+    return "### 法规片段 {index}\n{regulations}"
+
+
 # ==================== Conversation Prompts ====================
 def get_conversation_system_rag_with_history():
     """多轮对话RAG模式系统提示词（使用知识问答的高级提示词）"""
@@ -803,10 +863,12 @@ PROMPTS = {
     },
     "insertBlock": {
         "system": {
-            "all": get_insertblock_system_all()
+            "all": get_insertblock_system_all(),
+            "batch_all": get_insertblock_batch_system_all()
         },
         "user": {
-            "all": get_insertblock_user_all()
+            "all": get_insertblock_user_all(),
+            "batch_all": get_insertblock_batch_user_all()
         }
     },
     "conversation": {
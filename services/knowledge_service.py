@@ -199,7 +199,8 @@ class KnowledgeService:
                 llm_service=llm_service,
                 retriever=self.retriever,
                 reranker=reranker,
-                index=self.index  # 传递index用于LlamaIndex原生引擎
+                index=self.index,  # 传递index用于LlamaIndex原生引擎
+                embed_model=Settings.embed_model
             )
             logger.info("✓ 子问题分解器创建成功")
             return self.sub_question_decomposer
@@ -737,3 +738,9 @@ class KnowledgeService:
         )
         logger.info(" Keyword Table 检索器创建成功")
         return self.keyword_retriever
+
+    def close(self):
+        """释放服务持有的常驻资源（服务停止时调用）"""
+        if self.sub_question_decomposer is not None:
+            self.sub_question_decomposer.close()
+            self.sub_question_decomposer = None
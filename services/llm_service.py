@@ -3,10 +3,12 @@
 LLM 服务层
 负责 LLM 客户端的初始化和管理
 """
+import asyncio
+import threading
 import httpx
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Union
 from llama_index.llms.openai import OpenAI
-from llama_index.core.llms import LLMMetadata
+from llama_index.core.llms import ChatMessage, LLMMetadata
 from config import Settings
 from utils.logger import logger
 
@@ -129,6 +131,10 @@ class LLMService:
     def __init__(self):
         self.clients: Dict[str, CustomOpenAILike] = {}
         self.http_client = None
+        self.async_http_client = None
+        # 异步调用统一跑在这个常驻事件循环上（AsyncClient 的连接池绑定在创建它的事件循环）
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
 
     def initialize(self) -> Dict[str, CustomOpenAILike]:
         """
@@ -143,6 +149,10 @@ class LLMService:
             verify=False,
             timeout=Settings.LLM_REQUEST_TIMEOUT
         )
+        self.async_http_client = httpx.AsyncClient(
+            verify=False,
+            timeout=Settings.LLM_REQUEST_TIMEOUT
+        )
 
         for model_id, config in Settings.LLM_ENDPOINTS.items():
             logger.info(
@@ -157,6 +167,7 @@ class LLMService:
                 api_key=api_key,
                 api_base=config["api_base_url"],
                 http_client=self.http_client,
+                async_http_client=self.async_http_client,
                 is_chat_model=True,
                 context_window=Settings.LLM_CONTEXT_WINDOW
             )
@@ -191,3 +202,66 @@ class LLMService:
             model_id = Settings.DEFAULT_LLM_ID
 
         return self.clients[model_id]
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """获取（必要时启动）后台常驻事件循环"""
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="llm_service_loop", daemon=True
+                ).start()
+                self._loop = loop
+            return self._loop
+
+    def run_coroutine(self, coro) -> Any:
+        """
+        在后台常驻事件循环中执行协程并阻塞等待结果
+
+        所有 acomplete 调用都应经由此处，保证共享的 AsyncClient 始终在同一事件循环中使用
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    def chat_batch(
+        self,
+        messages_list: List[List[ChatMessage]],
+        llm_id: Optional[str] = None,
+        max_in_flight: Optional[int] = None,
+        timeout: Optional[float] = None,
+        **chat_kwargs: Any
+    ) -> List[Union[str, Exception]]:
+        """
+        批量对话：所有请求在同一事件循环中并发下发
+
+        OpenAI 兼容服务端（如 vLLM）会对同时在途的请求做连续批处理，
+        因此整批并发下发即可获得后端批处理的吞吐。
+
+        Args:
+            messages_list: 每个请求的对话消息列表
+            llm_id: 模型 ID
+            max_in_flight: 最大在途请求数（默认 INSERTBLOCK_MAX_WORKERS）
+            timeout: 单个请求超时时间（秒），由 HTTP 客户端按请求控制；默认使用客户端的 LLM_REQUEST_TIMEOUT
+            **chat_kwargs: 透传给 achat 的参数（如 response_format）
+
+        Returns:
+            与 messages_list 一一对应的响应文本；失败的位置为异常对象
+        """
+        if not messages_list:
+            return []
+
+        llm = self.get_client(llm_id)
+        limit = max_in_flight or Settings.INSERTBLOCK_MAX_WORKERS
+        if timeout:
+            chat_kwargs["timeout"] = timeout
+
+        async def run_all():
+            semaphore = asyncio.Semaphore(limit)
+
+            async def one(messages: List[ChatMessage]) -> str:
+                async with semaphore:
+                    response = await llm.achat(messages, **chat_kwargs)
+                    return response.message.content
+
+            return await asyncio.gather(*(one(m) for m in messages_list), return_exceptions=True)
+
+        return self.run_coroutine(run_all())
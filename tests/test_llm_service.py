@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+LLM 服务测试：客户端构造与共享 HTTP 连接池
+"""
+import sys
+import os
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+pytest.importorskip("llama_index.llms.openai")
+
+from config import Settings
+from services.llm_service import CustomOpenAILike, LLMService
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(Settings, "LLM_ENDPOINTS", {
+        "test": {"api_base_url": "http://127.0.0.1:1/v1", "llm_model_name": "test-model"},
+    })
+    llm_service = LLMService()
+    llm_service.initialize()
+    yield llm_service
+    llm_service.http_client.close()
+
+
+def test_clients_share_sync_and_async_http_clients(service):
+    """构造出的客户端同步、异步请求分别复用服务级 httpx 连接池"""
+    client = service.get_client("test")
+
+    assert isinstance(client, CustomOpenAILike)
+    assert client._get_client()._client is service.http_client
+    assert client._get_aclient()._client is service.async_http_client
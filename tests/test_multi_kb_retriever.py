@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+多库检索器测试：合并策略的有序性与去重
+"""
+import sys
+import os
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from core.multi_kb_retriever import MultiKBRetriever
+
+
+class _ListRetriever:
+    """按给定顺序返回固定节点的检索器"""
+
+    def __init__(self, nodes):
+        self._nodes = nodes
+
+    def retrieve(self, query_bundle):
+        return list(self._nodes)
+
+
+def _nodes(prefix, scores, file_name):
+    return [
+        NodeWithScore(node=TextNode(id_=f"{prefix}{i}", text="t", metadata={"file_name": file_name}), score=score)
+        for i, score in enumerate(scores)
+    ]
+
+
+def _scores(nodes):
+    return [n.score for n in nodes]
+
+
+@pytest.fixture
+def retriever_factory():
+    def factory(general, visa=None, airline=None, strategy="fixed"):
+        return MultiKBRetriever(
+            _ListRetriever(general),
+            visa_free_retriever=_ListRetriever(visa) if visa is not None else None,
+            airline_retriever=_ListRetriever(airline) if airline is not None else None,
+            strategy=strategy,
+        )
+    return factory
+
+
+def test_fixed_merge_falls_back_to_sort_for_unsorted_input(retriever_factory):
+    """检索结果未按分数降序时固定策略应回退排序，输出仍整体有序"""
+    visa = _nodes("v", [0.2, 0.9, 0.5, 0.7], "免签.docx")
+    general = _nodes("g", [0.3, 0.8, 0.1, 0.6], "通用.docx")
+    retriever = retriever_factory(general, visa=visa)
+
+    merged = retriever._fixed_merge(visa, general, visa_count=2, general_count=2)
+
+    assert _scores(merged) == sorted(_scores(merged), reverse=True)
+    # 前两条取自各库排序后的最高分
+    assert {n.node.node_id for n in merged[:2]} == {"v1", "g1"}
+    assert len(merged) == 6
+
+
+def test_fixed_merge_dedups_shared_nodes(retriever_factory):
+    """同一节点同时出现在两库时只保留得分最高的一次"""
+    visa = _nodes("v", [0.9, 0.4], "免签.docx")
+    general = _nodes("g", [0.8, 0.3], "通用.docx")
+    shared = NodeWithScore(node=visa[0].node, score=0.85)
+    general = [general[0], shared, general[1]]
+    general.sort(key=lambda n: n.score, reverse=True)
+    retriever = retriever_factory(general, visa=visa)
+
+    merged = retriever._fixed_merge(visa, general, visa_count=2, general_count=2)
+
+    ids = [n.node.node_id for n in merged]
+    assert len(ids) == len(set(ids))
+    assert next(n for n in merged if n.node.node_id == "v0").score == 0.9
+
+
+def test_airline_only_falls_back_to_sort_for_unsorted_input(retriever_factory):
+    """航司检索同样不依赖检索器返回有序结果"""
+    airline = _nodes("a", [0.1, 0.95, 0.4, 0.6, 0.3], "航司.docx")
+    general = _nodes("g", [0.5, 0.2, 0.9, 0.05], "通用.docx")
+    retriever = retriever_factory(general, airline=airline)
+    retriever._airline_n = 2
+    retriever._general_n = 2
+
+    merged = retriever.retrieve_airline_only("航班机组入境")
+
+    assert _scores(merged) == sorted(_scores(merged), reverse=True)
+    assert [n.node.node_id for n in merged[:2]] == ["a1", "g2"]
+    assert len(merged) == 6
+
+
+def test_fixed_merge_reads_counts_after_reload(retriever_factory, monkeypatch):
+    """固定策略默认数量取自 reload_settings 快照，修改配置并重载后立即生效"""
+    from config import Settings
+
+    visa = _nodes("v", [0.9, 0.8, 0.7, 0.6, 0.5, 0.4], "免签.docx")
+    general = _nodes("g", [0.85, 0.75, 0.65, 0.55, 0.45, 0.35], "通用.docx")
+    retriever = retriever_factory(general, visa=visa)
+
+    monkeypatch.setattr(Settings, "VISA_FREE_RETRIEVAL_COUNT", 1)
+    monkeypatch.setattr(Settings, "GENERAL_RETRIEVAL_COUNT", 1)
+    retriever.reload_settings()
+    assert len(retriever.retrieve_from_both("免签停留多久")) == 3
+
+    monkeypatch.setattr(Settings, "VISA_FREE_RETRIEVAL_COUNT", 2)
+    monkeypatch.setattr(Settings, "GENERAL_RETRIEVAL_COUNT", 2)
+    retriever.reload_settings()
+    assert len(retriever._fixed_merge(visa, general)) == 6
+    assert len(retriever.retrieve_from_both("免签停留多久")) == 6
+
+
+def test_rrf_merge_sums_ranks_across_libraries(retriever_factory, monkeypatch):
+    """RRF 融合按排名累加，两库都命中的节点排在前面且保留最高原始得分"""
+    from config import Settings
+
+    monkeypatch.setattr(Settings, "RRF_K", 5.0)
+    visa = _nodes("v", [0.9, 0.8, 0.7], "免签.docx")
+    general = _nodes("g", [0.6, 0.5], "通用.docx")
+    shared = NodeWithScore(node=visa[2].node, score=0.95)
+    general = [shared] + general
+    retriever = retriever_factory(general, visa=visa, strategy="rrf")
+
+    merged = retriever._rrf_merge(visa, general, visa_count=2, general_count=2)
+
+    # v2: 1/8 + 1/6 最高，其次 v0 为 1/6；v1 与 g0 同为 1/7，按首次出现顺序
+    assert [n.node.node_id for n in merged] == ["v2", "v0", "v1", "g0"]
+    assert merged[0].score == 0.95
+
+
+def test_adaptive_merge_zscore_decision(retriever_factory, monkeypatch):
+    """z-score 判定按对方库分数分布比较，不依赖 0.8 绝对阈值"""
+    from config import Settings
+
+    # 两库最高分都低于 0.8，经验阈值判定保持默认比例
+    visa = _nodes("v", [0.6, 0.2, 0.18, 0.15, 0.1], "免签.docx")
+    general = _nodes("g", [0.3, 0.28, 0.25, 0.22, 0.2], "通用.docx")
+    retriever = retriever_factory(general, visa=visa)
+    calls = []
+    monkeypatch.setattr(
+        retriever.__class__, "_fixed_merge",
+        lambda self, v, g, visa_count=None, general_count=None: calls.append((visa_count, general_count)) or [],
+    )
+
+    monkeypatch.setattr(Settings, "DUAL_KB_ADAPTIVE_DECISION", "threshold")
+    retriever._adaptive_merge(visa, general, 10, 5)
+    monkeypatch.setattr(Settings, "DUAL_KB_ADAPTIVE_DECISION", "zscore")
+    monkeypatch.setattr(Settings, "DUAL_KB_ZSCORE_THRESHOLD", 1.0)
+    retriever._adaptive_merge(visa, general, 10, 5)
+
+    assert calls == [(10, 5), (14, 3)]
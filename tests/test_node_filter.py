@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+InsertBlock 节点过滤器测试
+"""
+import sys
+import os
+import asyncio
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import pytest
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from config import Settings
+from core import node_filter
+from core.node_filter import FilterResult, InsertBlockFilter, _is_retryable
+
+
+def _verdict(passed):
+    return {
+        "is_relevant": passed,
+        "can_answer": passed,
+        "reasoning": "依据该法规可以回答" if passed else "法规与问题无关",
+        "answer": "可以" if passed else "",
+        "key_passage": "关键段落" if passed else None,
+    }
+
+
+def _reply(content):
+    return SimpleNamespace(message=SimpleNamespace(content=content))
+
+
+class _FakeLLM:
+    """法规文本含 PASS 即判定通过的 LLM；记录调用次数，前 fail_times 次调用抛出 error"""
+
+    def __init__(self, fail_times=0, error=None, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+        self.async_calls = 0
+        self.fail_times = fail_times
+        self.error = error
+        self._lock = threading.Lock()
+
+    def _answer(self, messages):
+        with self._lock:
+            self.calls += 1
+            failing = self.calls <= self.fail_times
+        if failing:
+            raise self.error
+        user = messages[-1].content
+        pieces = re.findall(r"### 法规片段 (\d+)\n(.*)", user)
+        if pieces:
+            results = [dict(_verdict("PASS" in text), index=int(index)) for index, text in pieces]
+            return _reply(json.dumps({"results": results}, ensure_ascii=False))
+        return _reply("判定如下：\n```json\n" + json.dumps(_verdict("PASS" in user), ensure_ascii=False) + "\n```")
+
+    def chat(self, messages, **kwargs):
+        time.sleep(self.delay)
+        return self._answer(messages)
+
+    async def achat(self, messages, **kwargs):
+        self.async_calls += 1
+        await asyncio.sleep(self.delay)
+        return self._answer(messages)
+
+
+class _FakeService:
+    """只提供 get_client；batch=True 时额外提供 chat_batch 后端批处理接口"""
+
+    def __init__(self, llm, batch=False):
+        self.llm = llm
+        self.batch_calls = 0
+        if batch:
+            self.chat_batch = self._chat_batch
+
+    def get_client(self, llm_id):
+        return self.llm
+
+    def _chat_batch(self, messages_list, llm_id=None, max_in_flight=None, timeout=None, **chat_kwargs):
+        self.batch_calls += 1
+        responses = []
+        for messages in messages_list:
+            try:
+                responses.append(self.llm.chat(messages).message.content)
+            except Exception as e:
+                responses.append(e)
+        return responses
+
+
+def _nodes(count=6, prefix="n"):
+    """偶数编号的节点含 PASS（通过），重排分数按编号递减"""
+    return [
+        NodeWithScore(
+            node=TextNode(
+                id_=f"{prefix}{i}",
+                text=f"PASS 条文{i}" if i % 2 == 0 else f"无关条文{i}",
+                metadata={"file_name": f"f{i % 3}.docx", "initial_score": 0.1 * i},
+            ),
+            score=1.0 - 0.1 * i,
+        )
+        for i in range(count)
+    ]
+
+
+def _ids(results):
+    return sorted(r.node.node.node_id for r in results)
+
+
+@pytest.fixture(autouse=True)
+def isolated_filter_state(monkeypatch):
+    """各测试使用默认配置与空缓存，互不影响"""
+    for name, value in {
+        "INSERTBLOCK_USE_ASYNC": False,
+        "INSERTBLOCK_USE_BATCH": False,
+        "INSERTBLOCK_JSON_MODE": False,
+        "INSERTBLOCK_SCORE_MIN": 0.0,
+        "INSERTBLOCK_CHUNKS_PER_CALL": 1,
+        "INSERTBLOCK_CACHE_DIR": "",
+        "INSERTBLOCK_EARLY_STOP_K": 0,
+        "INSERTBLOCK_SEMANTIC_CACHE_THRESHOLD": 0.0,
+    }.items():
+        monkeypatch.setattr(Settings, name, value)
+    monkeypatch.setattr(node_filter, "_disk_cache_conn", None)
+    monkeypatch.setattr(node_filter, "_disk_cache_failed", False)
+    monkeypatch.setattr(node_filter, "_retry_delay", lambda attempt: 0)
+    node_filter._response_cache.clear()
+    node_filter._semantic_cache.clear()
+    yield
+    if node_filter._disk_cache_conn is not None:
+        node_filter._disk_cache_conn.close()
+    node_filter._response_cache.clear()
+    node_filter._semantic_cache.clear()
+
+
+@pytest.fixture
+def make_filter():
+    filters = []
+
+    def factory(llm=None, batch=False, **attrs):
+        llm = llm or _FakeLLM()
+        service = _FakeService(llm, batch=batch)
+        init = {"max_workers": 4, "timeout": 5, **attrs.pop("init", {})}
+        node_filter_ = InsertBlockFilter(service, **init)
+        for name, value in attrs.items():
+            setattr(node_filter_, name, value)
+        filters.append(node_filter_)
+        return node_filter_, llm, service
+
+    yield factory
+    for node_filter_ in filters:
+        node_filter_.close()
+
+
+def test_filter_result_dict_access():
+    """FilterResult 保留字典式访问，缺失键抛出 KeyError"""
+    result = FilterResult(
+        node="node", file_name="a.docx", is_relevant=True, can_answer=True, reasoning="r",
+        answer="a", key_passage="kp", initial_score=0.5, reranked_score=0.9,
+    )
+
+    assert result["file_name"] == "a.docx"
+    assert result.get("key_passage") == "kp"
+    assert result.get("missing", "默认值") == "默认值"
+    with pytest.raises(KeyError):
+        result["missing"]
+    assert result.to_dict()["reranked_score"] == 0.9
+    assert not hasattr(result, "__dict__")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('```json\n{"a": 1}\n```', '{"a": 1}'),
+    ('说明\n```\n{"a": {"b": 2}}\n```\n以上', '{"a": {"b": 2}}'),
+    ('好的，结果是 {"a": {"b": 2}} 。', '{"a": {"b": 2}}'),
+    ('  {"a": 1}  ', '{"a": 1}'),
+    ("没有 JSON", "没有 JSON"),
+])
+def test_extract_json(text, expected):
+    """优先提取代码块，其次取第一个 { 到最后一个 }"""
+    assert InsertBlockFilter._extract_json(text) == expected
+
+
+_MODES = {
+    "thread": {},
+    "async": {"use_async": True},
+    "batch": {"use_batch": True},
+    "joint": {"chunks_per_call": 4},
+}
+
+
+@pytest.mark.parametrize("mode", sorted(_MODES))
+def test_filter_modes_agree(make_filter, mode):
+    """四种执行路径给出相同的通过节点、完整的进度回调与相同的调用次数"""
+    node_filter_, llm, service = make_filter(batch=mode == "batch", **_MODES[mode])
+    progress = []
+
+    results = node_filter_.filter_nodes("X1签证如何办理", _nodes(), progress_callback=lambda done, total: progress.append((done, total)))
+
+    assert _ids(results) == ["n0", "n2", "n4"]
+    assert all(r.key_passage == "关键段落" for r in results)
+    assert progress[-1] == (6, 6)
+    assert llm.calls == (2 if mode == "joint" else 6)
+    assert llm.async_calls == (6 if mode == "async" else 0)
+    assert service.batch_calls == (1 if mode == "batch" else 0)
+
+
+def test_batched_without_backend_uses_asyncio(make_filter):
+    """未提供 chat_batch 时批量路径退回 asyncio 并发"""
+    node_filter_, llm, _ = make_filter()
+
+    results = node_filter_.filter_nodes_batched("X1签证如何办理", _nodes())
+
+    assert _ids(results) == ["n0", "n2", "n4"]
+    assert llm.async_calls == 6
+
+
+def test_joint_keeps_per_node_for_deepseek(make_filter):
+    """DeepSeek 模型不走联合判定，逐节点调用"""
+    node_filter_, llm, _ = make_filter(chunks_per_call=4)
+
+    results = node_filter_.filter_nodes("X1签证如何办理", _nodes(), llm_id="deepseek-r1")
+
+    assert _ids(results) == ["n0", "n2", "n4"]
+    assert llm.calls == 6
+
+
+@pytest.mark.parametrize("mode", sorted(_MODES))
+def test_duplicate_regulations_call_llm_once(make_filter, mode):
+    """法规文本相同的节点只调用一次 LLM，判定展开到每个节点并保留各自分数"""
+    node_filter_, llm, _ = make_filter(batch=mode == "batch", **_MODES[mode])
+    nodes = _nodes(2)
+    duplicate = NodeWithScore(
+        node=TextNode(id_="dup", text=nodes[0].node.text, metadata={"file_name": "dup.docx"}), score=0.3
+    )
+
+    results = node_filter_.filter_nodes("X1签证如何办理", nodes + [duplicate])
+
+    assert _ids(results) == ["dup", "n0"]
+    assert next(r for r in results if r.file_name == "dup.docx").reranked_score == 0.3
+    assert llm.calls == (1 if mode == "joint" else 2)
+
+
+def test_memory_cache_reuses_verdicts(make_filter):
+    """相同问题与法规文本命中进程内 LRU 缓存，不再调用 LLM"""
+    node_filter_, llm, _ = make_filter()
+    node_filter_.filter_nodes("X1签证如何办理", _nodes())
+
+    results = node_filter_.filter_nodes("X1签证如何办理", _nodes())
+
+    assert _ids(results) == ["n0", "n2", "n4"]
+    assert llm.calls == 6
+
+
+def test_memory_cache_is_bounded(monkeypatch):
+    """超出容量时淘汰最久未使用的条目"""
+    monkeypatch.setattr(node_filter, "_RESPONSE_CACHE_MAX_SIZE", 2)
+    node_filter._memory_cache_put("a", {"v": 1})
+    node_filter._memory_cache_put("b", {"v": 2})
+    assert node_filter._response_cache_get("a") == {"v": 1}
+    node_filter._memory_cache_put("c", {"v": 3})
+
+    assert list(node_filter._response_cache) == ["a", "c"]
+
+
+def test_disk_cache_survives_memory_reset(make_filter, monkeypatch, tmp_path):
+    """磁盘缓存在内存缓存清空（进程重启）后仍可复用判定结果"""
+    monkeypatch.setattr(Settings, "INSERTBLOCK_CACHE_DIR", str(tmp_path))
+    node_filter_, llm, _ = make_filter()
+    node_filter_.filter_nodes("X1签证如何办理", _nodes())
+    node_filter._response_cache.clear()
+
+    results = node_filter_.filter_nodes("X1签证如何办理", _nodes())
+
+    assert (tmp_path / node_filter._DISK_CACHE_FILE).exists()
+    assert _ids(results) == ["n0", "n2", "n4"]
+    assert llm.calls == 6
+
+
+def test_disk_cache_expires(make_filter, monkeypatch, tmp_path):
+    """过期的磁盘缓存条目不再命中"""
+    monkeypatch.setattr(Settings, "INSERTBLOCK_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(Settings, "INSERTBLOCK_CACHE_TTL", -1)
+    node_filter_, llm, _ = make_filter()
+    node_filter_.filter_nodes("X1签证如何办理", _nodes())
+    node_filter._response_cache.clear()
+
+    node_filter_.filter_nodes("X1签证如何办理", _nodes())
+
+    assert llm.calls == 12
+
+
+class _FakeEmbedding:
+    """按问题查表返回向量的 Embedding 模型"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def get_text_embedding(self, text):
+        return self.vectors[text]
+
+
+def test_semantic_cache_reuses_similar_questions(make_filter):
+    """同义改写的问题命中语义缓存，语义不同的问题仍调用 LLM"""
+    embed_model = _FakeEmbedding({
+        "X1签证如何办理": [1.0, 0.0, 0.0],
+        "怎么办理X1签证": [0.99, 0.05, 0.0],
+        "免签停留多久": [0.0, 1.0, 0.0],
+    })
+    node_filter_, llm, _ = make_filter(init={"embed_model": embed_model}, semantic_cache_threshold=0.95)
+    node_filter_.filter_nodes("X1签证如何办理", _nodes())
+
+    results = node_filter_.filter_nodes("怎么办理X1签证", _nodes())
+    assert _ids(results) == ["n0", "n2", "n4"]
+    assert llm.calls == 6
+
+    node_filter_.filter_nodes("免签停留多久", _nodes())
+    assert llm.calls == 12
+
+
+@pytest.mark.parametrize("mode", ["thread", "async"])
+def test_transient_error_is_retried(make_filter, mode):
+    """传输层错误退避重试后成功"""
+    llm = _FakeLLM(fail_times=1, error=httpx.ConnectError("connection reset"))
+    node_filter_, _, _ = make_filter(llm=llm, **_MODES[mode])
+
+    results = node_filter_.filter_nodes("X1签证如何办理", _nodes(1))
+
+    assert _ids(results) == ["n0"]
+    assert llm.calls == 2
+
+
+@pytest.mark.parametrize("mode", ["thread", "async"])
+def test_non_retryable_error_fails_fast(make_filter, mode):
+    """不可重试的错误不再重试；超过半数节点失败时抛出 RuntimeError"""
+    llm = _FakeLLM(fail_times=2, error=ValueError("bad request"))
+    node_filter_, _, _ = make_filter(llm=llm, **_MODES[mode])
+
+    with pytest.raises(RuntimeError, match="InsertBlock 过滤失败"):
+        node_filter_.filter_nodes("X1签证如何办理", _nodes(2))
+    assert llm.calls == 2
+
+
+@pytest.mark.parametrize("mode", ["batch", "joint"])
+def test_failed_calls_count_towards_critical_error(make_filter, mode):
+    """批量与联合判定的失败同样计入关键错误判定"""
+    llm = _FakeLLM(fail_times=10, error=httpx.ConnectError("connection reset"))
+    node_filter_, _, _ = make_filter(llm=llm, batch=mode == "batch", **_MODES[mode])
+
+    with pytest.raises(RuntimeError, match="InsertBlock 过滤失败"):
+        node_filter_.filter_nodes("X1签证如何办理", _nodes(4))
+
+
+def test_prefilter_skips_low_scores(make_filter):
+    """重排分数低于阈值的节点不送 LLM 判定"""
+    node_filter_, llm, _ = make_filter(prefilter_score_min=0.75)
+
+    results = node_filter_.filter_nodes("X1签证如何办理", _nodes())
+
+    assert _ids(results) == ["n0", "n2"]
+    assert llm.calls == 3
+
+
+class _StatusError(Exception):
+    """带 HTTP 状态码的服务端错误"""
+
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize("error", [
+    TimeoutError("timeout"),
+    httpx.ReadTimeout("read timeout"),
+    httpx.ConnectError("connection refused"),
+    httpx.RemoteProtocolError("server disconnected"),
+    _StatusError(429),
+    _StatusError(500),
+    _StatusError(503),
+])
+def test_is_retryable_transient_errors(error):
+    """超时、传输层错误、429 与 5xx 可重试"""
+    assert _is_retryable(error)
+
+
+@pytest.mark.parametrize("error", [
+    _StatusError(400),
+    _StatusError(401),
+    _StatusError(404),
+    ValueError("bad json"),
+    KeyError("message"),
+    AttributeError("'NoneType' object has no attribute 'content'"),
+])
+def test_is_retryable_rejects_everything_else(error):
+    """白名单之外的异常（4xx、解析与编程错误）不重试"""
+    assert not _is_retryable(error)
+
+
+def test_is_retryable_openai_connection_errors():
+    """openai SDK 的连接错误与超时错误可重试"""
+    openai = pytest.importorskip("openai")
+    request = httpx.Request("POST", "http://127.0.0.1/v1/chat/completions")
+
+    assert _is_retryable(openai.APIConnectionError(request=request))
+    assert _is_retryable(openai.APITimeoutError(request=request))
+
+
+@pytest.mark.parametrize("mode", sorted(_MODES))
+def test_early_stop_saves_llm_calls_in_every_mode(make_filter, mode):
+    """提前终止在各模式下都按分数优先判定并取消其余调用；批量模式改走逐节点流式路径"""
+    llm = _FakeLLM(delay=0.05)
+    attrs = {"chunks_per_call": 2} if mode == "joint" else _MODES[mode]
+    node_filter_, _, service = make_filter(llm=llm, batch=mode == "batch", init={"max_workers": 2}, **attrs)
+
+    results = node_filter_.filter_nodes("X1签证如何办理", _nodes(12), early_stop_k=1)
+
+    assert _ids(results) == ["n0"]
+    assert service.batch_calls == 0
+    assert llm.calls < (6 if mode == "joint" else 12)
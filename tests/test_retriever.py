@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+检索器测试：BM25 排序与混合检索 RRF 融合
+"""
+import sys
+import os
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jieba
+import pytest
+from llama_index.core import Document, QueryBundle
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from core.retriever import CleanBM25Retriever, HybridRetriever, tokenize_query
+
+
+CORPUS = [
+    ("n1", "X1签证入境后需要在三十日内办理居留许可。"),
+    ("n2", "J1签证持有人办理居留许可需要提交工作证明和护照。"),
+    ("n3", "免签入境的外国人可以在境内停留十五日。"),
+    ("n4", "口岸签证需要向出入境边防检查机关申请。"),
+    ("n5", "X2签证入境后无需办理居留许可，停留期限不超过一百八十日。"),
+    ("n6", '{"text": "x", "metadata": {}}'),
+]
+QUERIES = ["X1签证办理居留许可", "免签停留多久", "口岸签证 申请"]
+
+
+def _corpus_nodes():
+    return [TextNode(id_=node_id, text=text, metadata={"file_name": f"{node_id}.txt"}) for node_id, text in CORPUS]
+
+
+class _FixedRetriever(BaseRetriever):
+    """返回固定结果的检索器"""
+
+    def __init__(self, results):
+        self._results = results
+        super().__init__()
+
+    def _retrieve(self, query_bundle):
+        return list(self._results)
+
+
+def test_bm25_ranking_is_pinned():
+    """固定语料上的 BM25 排序、分数和匹配关键词"""
+    retriever = CleanBM25Retriever(_corpus_nodes(), similarity_top_k=3)
+
+    results = retriever.retrieve("X1签证办理居留许可")
+    assert [n.node.node_id for n in results] == ["n1", "n5", "n2"]
+    assert [n.score for n in results] == pytest.approx([1.2987, 0.5957, 0.5957], abs=1e-4)
+    assert results[0].node.metadata["bm25_matched_keywords"] == ["X1签证", "办理", "居留", "许可"]
+    assert results[0].node.metadata["bm25_relevance_score"] == results[0].score
+
+    results = retriever.retrieve("免签停留多久")
+    assert [n.node.node_id for n in results][:2] == ["n3", "n5"]
+    assert [n.score for n in results][:2] == pytest.approx([0.9781, 0.3225], abs=1e-4)
+
+    results = retriever.retrieve("口岸签证 申请")
+    assert results[0].node.node_id == "n4"
+    assert results[0].score == pytest.approx(1.7, abs=1e-4)
+
+
+def test_bm25_skips_json_nodes_and_keeps_originals_untouched():
+    """元数据格式的异常节点不入索引；检索结果是浅拷贝，原始节点元数据不被修改"""
+    nodes = _corpus_nodes()
+    retriever = CleanBM25Retriever(nodes, similarity_top_k=10)
+
+    results = retriever.retrieve("X1签证办理居留许可")
+    assert "n6" not in {n.node.node_id for n in results}
+    assert all("bm25_matched_keywords" not in node.metadata for node in nodes)
+
+
+def test_bm25_matches_llama_index_bm25_retriever():
+    """与 llama-index 官方 BM25Retriever（原实现）的排序和分数一致"""
+    bm25_module = pytest.importorskip("llama_index.retrievers.bm25")
+    nodes = _corpus_nodes()
+    retriever = CleanBM25Retriever(nodes, similarity_top_k=3)
+
+    valid_nodes = [node for node in nodes if node.node_id != "n6"]
+    reference = bm25_module.BM25Retriever(
+        nodes=[
+            Document(
+                text=" ".join(token for token in jieba.lcut(node.get_content()) if len(token) > 1),
+                id_=node.node_id
+            )
+            for node in valid_nodes
+        ],
+        similarity_top_k=3
+    )
+
+    for query in QUERIES:
+        _, filtered_keywords = tokenize_query(query)
+        expected = reference.retrieve(QueryBundle(" ".join(filtered_keywords)))
+        results = retriever.retrieve(query)
+        assert [n.node.node_id for n in results] == [n.node.node_id for n in expected]
+        assert [n.score for n in results] == pytest.approx([n.score for n in expected])
+
+
+def test_hybrid_fusion_order_and_metadata():
+    """加权 RRF 融合的顺序、分数与附加元数据"""
+    node_a, node_b, node_c, node_d = (TextNode(id_=i, text=i, metadata={"file_name": f"{i}.txt"}) for i in "abcd")
+    vector_results = [
+        NodeWithScore(node=node_a, score=0.9),
+        NodeWithScore(node=node_b, score=0.5),
+        NodeWithScore(node=node_c, score=0.0005),  # 低于向量分数阈值，视为无效
+    ]
+    bm25_node_b = node_b.copy(update={"metadata": {**node_b.metadata, "bm25_matched_keywords": ["b"]}})
+    bm25_results = [
+        NodeWithScore(node=bm25_node_b, score=3.0),
+        NodeWithScore(node=node_d, score=2.0),
+        NodeWithScore(node=node_c, score=1.0),
+    ]
+    retriever = HybridRetriever(_FixedRetriever(vector_results), _FixedRetriever(bm25_results))
+
+    results = retriever.retrieve("q")
+
+    # d/c 为纯 BM25 结果：max(BM25 RRF, BM25 分数 * 0.1)；b 为两路 RRF 之和；a 仅有向量 RRF
+    assert [n.node.node_id for n in results] == ["d", "c", "b", "a"]
+    assert [n.score for n in results] == pytest.approx([0.2, 0.1, 0.7 / 62 + 0.3 / 61, 0.7 / 61])
+
+    by_id = {n.node.node_id: n.node.metadata for n in results}
+    assert by_id["d"]["retrieval_sources"] == ["keyword"]
+    assert (by_id["d"]["vector_rank"], by_id["d"]["bm25_rank"]) == (None, 2)
+    assert by_id["c"]["retrieval_sources"] == ["vector", "keyword"]
+    assert (by_id["c"]["vector_rank"], by_id["c"]["vector_score"]) == (3, 0.0005)
+    assert (by_id["b"]["vector_score"], by_id["b"]["bm25_score"]) == (0.5, 3.0)
+    assert by_id["a"]["retrieval_sources"] == ["vector"]
+    assert all(metadata["initial_score"] == n.score for n, metadata in zip(results, by_id.values()))
+
+    # 节点对象以 BM25 结果为准；分数写入浅拷贝，输入节点不被修改
+    assert by_id["b"]["bm25_matched_keywords"] == ["b"]
+    assert "initial_score" not in node_b.metadata and "initial_score" not in bm25_node_b.metadata
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+子问题分解器辅助函数测试
+"""
+import sys
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from config.settings import Settings as AppSettings
+from core.sub_question_decomposer import SubQuestionDecomposer, _dedup_sub_questions
+
+
+@pytest.fixture
+def decomposer():
+    decomposer = SubQuestionDecomposer(llm_service=None, retriever=None, reranker=None)
+    yield decomposer
+    decomposer.close()
+
+
+def test_dedup_exact_duplicates():
+    """仅空白、大小写和句末标点不同的子问题视为重复"""
+    sub_questions = [
+        "Q2签证可以停留多久？",
+        "q2签证 可以停留多久?",
+        "Q2签证可以停留多久",
+    ]
+    assert _dedup_sub_questions(sub_questions) == ["Q2签证可以停留多久？"]
+
+
+def test_dedup_keeps_different_visa_types():
+    """只差签证类型的对比类子问题不能被合并"""
+    template = "{}签证入境后需要在多少天内办理居留许可，办理时需要携带哪些材料到出入境管理部门？"
+    for first, second in (("X1", "X2"), ("J1", "J2")):
+        sub_questions = [template.format(first), template.format(second)]
+        assert _dedup_sub_questions(sub_questions) == sub_questions
+
+
+def test_dedup_near_duplicates_with_same_tokens():
+    """字母数字标记一致且高度相似的子问题视为近似重复"""
+    sub_questions = [
+        "X1签证入境后需要在多少天内办理居留许可，办理时需要携带哪些材料到出入境管理部门？",
+        "X1签证入境后需要在多少天内办理居留许可，办理时需要携带哪些材料到出入境管理部门呢？",
+    ]
+    assert _dedup_sub_questions(sub_questions) == sub_questions[:1]
+
+
+def test_truncate_history_keeps_latest_turns_in_order(decomposer):
+    """按字符预算从最新一轮向前保留，保持原有顺序；放不下的一轮截断到剩余预算"""
+    history = [
+        {"role": "user", "content": "甲" * 100},
+        {"role": "assistant", "content": "乙" * 100},
+        {"role": "user", "content": "丙" * 30},
+    ]
+    # 100 token ≈ 200 字符：后两轮共 130 字符，第一轮只剩 70 字符
+    truncated = decomposer._truncate_history_by_tokens(history, 100)
+    assert [turn["role"] for turn in truncated] == ["user", "assistant", "user"]
+    assert truncated[0]["content"] == "甲" * 70 + "..."
+    assert truncated[1:] == history[1:]
+    assert history[0]["content"] == "甲" * 100
+
+    # 剩余预算不足 50 字符时整轮丢弃
+    assert decomposer._truncate_history_by_tokens(history, 80) == history[1:]
+    assert decomposer._truncate_history_by_tokens(history, 1000) == history
+
+
+def _scored(node_id, score):
+    return NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=score)
+
+
+def test_merge_keeps_highest_scoring_copy(decomposer, monkeypatch):
+    """同一节点被两个子问题检索到时保留分数最高的一份，并标记对应子问题"""
+    monkeypatch.setattr(AppSettings, "SUBQUESTION_MIN_SCORE", 0.1)
+    sub_results = [
+        {"sub_question": "子问题一", "nodes": [_scored("shared", 0.4), _scored("a", 0.6)]},
+        {"sub_question": "子问题二", "nodes": [_scored("shared", 0.9), _scored("low", 0.05)]},
+    ]
+
+    merged = decomposer._merge_subquestion_results(sub_results, final_top_n=10)
+
+    assert [(n.node.node_id, n.score) for n in merged] == [("shared", 0.9), ("a", 0.6)]
+    assert merged[0].node.metadata["sub_question"] == "子问题二"
+    assert merged[1].node.metadata["sub_question"] == "子问题一"
+    # 被淘汰的低分副本不打标记
+    assert "sub_question" not in sub_results[0]["nodes"][0].node.metadata
+
+
+def test_merge_top_n_keeps_first_seen_order_on_ties(decomposer, monkeypatch):
+    """同分节点按首次出现的顺序返回，截断与完整排序后取前 N 一致"""
+    monkeypatch.setattr(AppSettings, "SUBQUESTION_MIN_SCORE", 0.0)
+    sub_results = [
+        {"sub_question": "子问题一", "nodes": [_scored("a", 0.5), _scored("b", 0.7)]},
+        {"sub_question": "子问题二", "nodes": [_scored("c", 0.5), _scored("d", 0.5)]},
+    ]
+
+    merged = decomposer._merge_subquestion_results(sub_results, final_top_n=3)
+
+    assert [n.node.node_id for n in merged] == ["b", "a", "c"]
+
+
+class _SlowLLM:
+    """每次调用耗时固定的 LLM"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.timeouts = []
+
+    def chat(self, messages, timeout=None):
+        self.timeouts.append(timeout)
+        time.sleep(self.delay)
+        return SimpleNamespace(message=SimpleNamespace(content="ok"))
+
+
+def test_llm_timeout_excludes_queue_time(decomposer):
+    """线程池排队的时间不计入调用超时；请求级超时透传给 llm.chat"""
+    decomposer._llm_executor.shutdown(wait=True)
+    decomposer._llm_executor = ThreadPoolExecutor(max_workers=1)
+    llm = _SlowLLM(0.3)
+
+    first = decomposer._submit_llm(llm, "sys", "user", 1)
+    # 第二个调用需排队约 0.3s，执行 0.3s，执行超时 0.5s 内仍可完成
+    assert decomposer._call_llm_with_timeout(llm, "sys", "user", timeout=0.5) == "ok"
+    assert first.result(1, queue_timeout=1) == "ok"
+    assert llm.timeouts == [1, 0.5]
+
+
+def test_llm_timeout_raises_when_execution_is_slow(decomposer):
+    """执行超过超时时间时抛出 TimeoutError"""
+    with pytest.raises(TimeoutError):
+        decomposer._call_llm_with_timeout(_SlowLLM(0.5), "sys", "user", timeout=0.1)